@@ -1,5 +1,6 @@
 import streamlit as st
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 import hashlib
 import os
@@ -10,6 +11,25 @@ from plotly.subplots import make_subplots
 import calendar
 from datetime import timedelta
 import locale
+import re
+import json
+import gzip
+import select
+import sys
+import threading
+import time
+import multiprocessing
+import socket
+import bisect
+import cProfile
+import pstats
+import tracemalloc
+import marshal
+import importlib
+import linecache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import urlparse
 
 # Configuração de locale para formatação de valores em português
@@ -29,8 +49,83 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Conexão com registro das instruções preparadas nela (ver executar_preparado)
+class ConexaoRegistrada(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+        self.emprestimos = 0
+        # Marcada quando a conexão pode ter ficado num estado que o rollback
+        # não limpa (ex.: COPY interrompido); o pool a fecha em vez de reusar
+        self.descartar = False
+
+def parametros_conexao(url):
+    # Parse da URL do banco de dados
+    result = urlparse(url)
+    return {
+        'dbname': result.path[1:],
+        'user': result.username,
+        'password': result.password,
+        'host': result.hostname,
+        'port': result.port,
+        'connection_factory': ConexaoRegistrada
+    }
+
+def conectar(url):
+    return psycopg2.connect(**parametros_conexao(url))
+
+# Um pool por URL (primário e réplica), compartilhado pelas sessões do processo
+@st.cache_resource
+def get_pool(url):
+    tamanho = int(os.environ.get('DATABASE_POOL_SIZE', '10'))
+    return psycopg2.pool.ThreadedConnectionPool(1, tamanho, **parametros_conexao(url))
+
+# Leituras na réplica (DATABASE_READ_URL) podem estar até
+# DATABASE_READ_MAX_LAG segundos atrasadas. get_connection marca a thread que
+# leu da réplica para em_cache guardar o resultado só por esse tempo.
+ATRASO_MAXIMO_REPLICA = float(os.environ.get('DATABASE_READ_MAX_LAG', '5'))
+leitura_replica = threading.local()
+
+# Processos de tarefas em segundo plano (ver executar_tarefa): fora do
+# Streamlit o st.cache_resource não guarda o pool, e todas as consultas da
+# tarefa precisam usar a mesma conexão
+pool_processo = None
+
+class ConexaoPool:
+    # Conexão emprestada do pool: close() devolve ao pool em vez de fechar.
+    # Usar com "with get_connection() as conn:": uma exceção no meio da
+    # consulta também devolve a conexão (sem isso o pool se esgota e todas as
+    # chamadas passam a abrir conexões avulsas, sem instruções preparadas)
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *excecao):
+        self.close()
+    
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._pool is None:
+            conn.close()
+            return
+        try:
+            # Descartar transação deixada aberta por consultas de leitura
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            conn.descartar = True
+        self._pool.putconn(conn, close=bool(conn.closed or conn.descartar))
+
 # Função para conectar ao banco de dados
-def get_connection():
+def get_connection(somente_leitura=False, username=None):
     # Usar DATABASE_URL do Streamlit
     DATABASE_URL = os.environ.get('DATABASE_URL')
     
@@ -38,27 +133,546 @@ def get_connection():
         st.error("Variável de ambiente DATABASE_URL não configurada!")
         st.stop()
     
-    # Parse da URL do banco de dados
-    result = urlparse(DATABASE_URL)
-    username = result.username
-    password = result.password
-    database = result.path[1:]
-    hostname = result.hostname
-    port = result.port
+    # Consultas somente leitura podem ir para a réplica (DATABASE_READ_URL),
+    # exceto logo após uma escrita do próprio usuário (ler o que acabou de gravar)
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+    if somente_leitura and DATABASE_READ_URL and pool_processo is None:
+        ultima_escrita = get_ultimas_escritas().get(username, 0) if username else 0
+        if time.time() - ultima_escrita > ATRASO_MAXIMO_REPLICA:
+            DATABASE_URL = DATABASE_READ_URL
+            leitura_replica.usada = True
     
-    return psycopg2.connect(
-        dbname=database,
-        user=username,
-        password=password,
-        host=hostname,
-        port=port
-    )
+    pool = pool_processo or get_pool(DATABASE_URL)
+    try:
+        conn = pool.getconn()
+        if conn.closed:
+            # Conexão perdida (ex.: reinício do servidor); descartar e abrir outra
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+    except psycopg2.pool.PoolError:
+        if pool_processo is not None:
+            # A tarefa tem uma conexão só (a do pid registrado, com o tempo
+            # limite): um segundo empréstimo ao mesmo tempo é erro do código
+            raise
+        # Pool esgotado: usar uma conexão avulsa, fechada no close()
+        contar_metrica('app_financas_conexoes_avulsas_total')
+        return ConexaoPool(None, medir_conexao(conectar(DATABASE_URL)))
+    return ConexaoPool(pool, medir_conexao(conn))
 
-# Funções para autenticação e banco de dados
-def init_db():
-    conn = get_connection()
+def medir_conexao(conn):
+    # O primeiro empréstimo de uma conexão conta como abertura e os seguintes
+    # como reuso do pool. A conexão em LISTEN do ouvinte do cache fica de fora:
+    # é aberta numa thread sem o contexto do Streamlit.
+    conn.emprestimos += 1
+    if conn.emprestimos > 1:
+        contar_metrica('app_financas_conexoes_reutilizadas_total')
+    elif get_metricas():
+        conn.cursor_factory = CursorMedido
+        contar_metrica('app_financas_conexoes_abertas_total')
+    return conn
+
+# Instruções preparadas: cada modelo de consulta (que já inclui o nome das
+# tabelas do usuário) é preparado uma vez por conexão do pool; as chamadas
+# seguintes usam EXECUTE e não repetem parse e análise da consulta
+PLACEHOLDERS = re.compile(r"%%|%s|%\((\w+)\)s")
+LIMITE_PREPARADAS_POR_CONEXAO = 500
+
+@st.cache_resource
+def get_estatisticas_preparadas():
+    # Atualizado pelas threads de todas as sessões do processo: usar a trava
+    return {'preparos': 0, 'acertos': 0, 'tempo_preparo': 0.0, 'tempo_economizado': 0.0, 'custos': {},
+            'trava': threading.Lock()}
+
+def converter_placeholders(query):
+    # Troca %s / %(nome)s do psycopg2 por $1, $2... e devolve a ordem dos parâmetros
+    ordem = []
+    posicional = [0]
+    
+    def trocar(m):
+        if m.group(0) == '%%':
+            return '%'
+        if m.group(1):
+            if m.group(1) not in ordem:
+                ordem.append(m.group(1))
+            return f"${ordem.index(m.group(1)) + 1}"
+        ordem.append(posicional[0])
+        posicional[0] += 1
+        return f"${len(ordem)}"
+    
+    return PLACEHOLDERS.sub(trocar, query), ordem
+
+def executar_preparado(cur, query, params=()):
+    estatisticas = get_estatisticas_preparadas()
+    conn = cur.connection
+    nome = 'p_' + hashlib.md5(query.encode()).hexdigest()[:24]
+    sql, ordem = converter_placeholders(query)
+    
+    if nome in conn.preparadas:
+        # Cada reuso economiza só o parse e a análise medidos no servidor: a
+        # ida ao servidor continua no EXECUTE e o plano só deixa de ser refeito
+        # quando o PostgreSQL passa a usar o plano genérico
+        with estatisticas['trava']:
+            estatisticas['acertos'] += 1
+            estatisticas['tempo_economizado'] += estatisticas['custos'].get(nome, 0.0)
+    else:
+        if len(conn.preparadas) >= LIMITE_PREPARADAS_POR_CONEXAO:
+            cur.execute("DEALLOCATE ALL")
+            conn.preparadas.clear()
+        # statement_timestamp() é o recebimento da mensagem: a diferença para
+        # clock_timestamp() é o tempo gasto pelo servidor no PREPARE
+        inicio = time.perf_counter()
+        cur.execute(f"PREPARE {nome} AS {sql}; "
+                    "SELECT EXTRACT(EPOCH FROM clock_timestamp() - statement_timestamp())")
+        custo = float(cur.fetchone()[0])
+        duracao = time.perf_counter() - inicio
+        conn.preparadas.add(nome)
+        with estatisticas['trava']:
+            estatisticas['preparos'] += 1
+            estatisticas['tempo_preparo'] += duracao
+            estatisticas['custos'][nome] = custo
+    
+    valores = [params[k] for k in ordem]
+    if valores:
+        cur.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(valores))})", valores)
+    else:
+        cur.execute(f"EXECUTE {nome}")
+
+def ler_preparado(conn, query, params=()):
+    # Equivalente a pd.read_sql_query usando instrução preparada
     cur = conn.cursor()
+    executar_preparado(cur, query, params)
+    colunas = [coluna[0] for coluna in cur.description]
+    return pd.DataFrame.from_records(cur.fetchall(), columns=colunas, coerce_float=True)
+
+# Leitura em massa: COPY (consulta) TO STDOUT envia o resultado como CSV em
+# fluxo e o parser em C do pandas monta as colunas direto do texto, sem criar
+# uma tupla Python por linha. Compensa em períodos longos e exportações;
+# consultas pequenas continuam com ler_preparado.
+NULO_COPY = '\\N'
+
+def ler_copy(conn, query, params=(), tipos=None, datas=None):
+    cur = conn.cursor()
+    # COPY não aceita parâmetros: a consulta é montada no cliente com os
+    # valores já escapados pelo psycopg2
+    sql = cur.mogrify(query, params if isinstance(params, dict) else list(params)).decode(psycopg2.extensions.encodings[conn.encoding])
+    comando = f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{NULO_COPY}')"
+
+    # O COPY escreve em um pipe enquanto o pandas lê a outra ponta, então o
+    # resultado nunca fica inteiro em memória como texto
+    leitura, escrita = os.pipe()
+    erros = []
+
+    def enviar():
+        with open(escrita, 'wb') as saida:
+            try:
+                cur.copy_expert(comando, saida)
+            except Exception as e:
+                erros.append(e)
+
+    envio = threading.Thread(target=enviar, daemon=True)
+    envio.start()
+    try:
+        with open(leitura, 'rb') as entrada:
+            # Só o marcador do COPY vira nulo: texto vazio continua texto vazio
+            dados = pd.read_csv(entrada, dtype=tipos, parse_dates=datas or False,
+                                na_values=[NULO_COPY], keep_default_na=False)
+    except Exception:
+        envio.join()
+        # O COPY pode ter parado no meio: a conexão não volta para o pool
+        cur.connection.descartar = True
+        if erros and not isinstance(erros[0], BrokenPipeError):
+            raise erros[0]
+        raise
+    envio.join()
+    if erros:
+        cur.connection.descartar = True
+        raise erros[0]
+    return dados
+
+# Horário da última escrita de cada usuário, usado no roteamento para a réplica
+@st.cache_resource
+def get_ultimas_escritas():
+    return {}
+
+# Cache compartilhado entre as sessões do processo: {username: {chave: valor}}.
+# st.cache_resource mantém o dicionário vivo entre reruns do script. Os dois
+# níveis são LRU: usuários que só leem nunca invalidam as próprias entradas,
+# então cada período consultado ficaria guardado para sempre.
+LIMITE_CACHE_POR_USUARIO = 20
+LIMITE_USUARIOS_CACHE = 1000
+
+@st.cache_resource
+def get_cache_usuarios():
+    return OrderedDict()
+
+# Geração do cache de cada usuário ({username: n}; None vale para todos),
+# incrementada a cada invalidação. em_cache só guarda um resultado se a
+# geração não mudou durante o cálculo: a remoção local em
+# notificar_alteracao acontece antes do commit, e uma leitura concorrente
+# ainda veria os dados antigos. O aviso do NOTIFY, entregue depois do commit,
+# incrementa a geração de novo e remove o que tiver sido guardado antes dele.
+@st.cache_resource
+def get_geracoes_cache():
+    return {}
+
+def geracao_cache(geracoes, username):
+    return geracoes.get(None, 0), geracoes.get(username, 0)
+
+def remover_do_cache(cache, geracoes, username, chave=None):
+    # chave=None remove tudo do usuário; senão remove a chave e as chaves
+    # em tupla que começam por ela, ex.: ('movimentacoes', 'dashboard', ...)
+    geracoes[username] = geracoes.get(username, 0) + 1
+    if chave is None:
+        cache.pop(username, None)
+        return
+    entradas = cache.get(username, {})
+    for k in list(entradas):
+        if k == chave or (isinstance(k, tuple) and k[0] == chave):
+            entradas.pop(k, None)
+
+def invalidar_cache_usuario(username, chave=None):
+    remover_do_cache(get_cache_usuarios(), get_geracoes_cache(), username, chave)
+
+def em_cache(username, chave, calcular):
+    # Resultado de consulta guardado no cache do usuário até a próxima
+    # alteração que invalide a chave (ver notificar_alteracao). Se o cálculo
+    # leu da réplica, a entrada expira em ATRASO_MAXIMO_REPLICA segundos: a
+    # réplica pode não ter recebido uma escrita que já foi notificada.
+    # O ouvinte do cache remove entradas em outra thread: KeyError nas
+    # operações abaixo só quer dizer que a entrada já saiu
+    cache = get_cache_usuarios()
+    entradas = cache.setdefault(username, OrderedDict())
+    rotulo = chave if isinstance(chave, str) else '/'.join(str(parte) for parte in chave[:2])
+    try:
+        cache.move_to_end(username)
+        valor, expira = entradas[chave]
+        if expira is not None and time.time() > expira:
+            raise KeyError(chave)
+        entradas.move_to_end(chave)
+        contar_metrica('app_financas_cache_total', chave=rotulo, resultado='acerto')
+        return valor
+    except KeyError:
+        pass
     
+    contar_metrica('app_financas_cache_total', chave=rotulo, resultado='falha')
+    geracoes = get_geracoes_cache()
+    geracao = geracao_cache(geracoes, username)
+    # Chamadas aninhadas de em_cache também marcam a leitura de fora
+    leu_replica = getattr(leitura_replica, 'usada', False)
+    leitura_replica.usada = False
+    try:
+        valor = calcular()
+    finally:
+        usou_replica = leitura_replica.usada
+        leitura_replica.usada = leu_replica or usou_replica
+    if geracao_cache(geracoes, username) != geracao:
+        # Invalidado durante o cálculo: o valor pode ser anterior à alteração
+        return valor
+    entradas[chave] = (valor, time.time() + ATRASO_MAXIMO_REPLICA if usou_replica else None)
+    try:
+        while len(entradas) > LIMITE_CACHE_POR_USUARIO:
+            entradas.popitem(last=False)
+        while len(cache) > LIMITE_USUARIOS_CACHE:
+            cache.popitem(last=False)
+    except KeyError:
+        pass
+    return valor
+
+# Invalidação entre processos: cada alteração publica um NOTIFY (entregue no
+# commit) e cada processo mantém uma thread em LISTEN que limpa o seu cache
+CANAL_CACHE = 'app_financas_cache'
+
+def notificar_alteracao(cur, username, chave=None):
+    cur.execute("SELECT pg_notify(%s, %s)",
+                (CANAL_CACHE, json.dumps({'username': username, 'chave': chave})))
+    invalidar_cache_usuario(username, chave)
+    get_ultimas_escritas()[username] = time.time()
+
+def ouvir_alteracoes(cache, geracoes, ultimas_escritas):
+    while True:
+        conn = None
+        try:
+            # Conexão dedicada, fora do pool, pois fica presa em LISTEN
+            conn = conectar(os.environ['DATABASE_URL'])
+            conn.set_session(autocommit=True)
+            conn.cursor().execute(f"LISTEN {CANAL_CACHE}")
+            # Avisos perdidos enquanto a conexão estava fora não podem ser recuperados
+            cache.clear()
+            geracoes[None] = geracoes.get(None, 0) + 1
+            
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    aviso = json.loads(conn.notifies.pop(0).payload)
+                    remover_do_cache(cache, geracoes, aviso['username'], aviso.get('chave'))
+                    # Escritas feitas em outros processos também contam para a réplica
+                    ultimas_escritas[aviso['username']] = time.time()
+        except (psycopg2.Error, OSError, ValueError, KeyError):
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+@st.cache_resource
+def iniciar_ouvinte_cache():
+    # Uma thread por processo, iniciada no primeiro rerun
+    ouvinte = threading.Thread(target=ouvir_alteracoes,
+                               args=(get_cache_usuarios(), get_geracoes_cache(), get_ultimas_escritas()),
+                               name="ouvinte-cache", daemon=True)
+    ouvinte.start()
+    return ouvinte
+
+# Métricas no formato texto do Prometheus, lidas pelo textfile collector do
+# node_exporter. O processo do servidor soma os valores em memória e uma
+# thread grava METRICAS_DIR/app_financas_<worker>.prom a cada
+# METRICAS_INTERVALO segundos. Os rótulos são estáveis: worker vem de
+# METRICAS_WORKER (um nome por processo do Streamlit, ex.: web-1; padrão: o
+# nome da máquina) e processo é "servidor" ou "tarefas". Os processos de
+# tarefa duram uma tarefa só: cada um deixa os seus valores num arquivo em
+# app_financas_<worker>_tarefas.d/ e a thread do servidor os soma num total
+# guardado em disco (app_financas_<worker>_tarefas.json), publicado com
+# processo="tarefas". Assim nem pids nem reinícios criam séries novas, e os
+# contadores das tarefas não voltam a zero. Sem METRICAS_DIR as métricas
+# ficam desligadas.
+DIRETORIO_METRICAS = os.environ.get('METRICAS_DIR')
+INTERVALO_METRICAS = float(os.environ.get('METRICAS_INTERVALO', '15'))
+WORKER_METRICAS = os.environ.get('METRICAS_WORKER') or socket.gethostname()
+FAIXAS_CONSULTA = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAIXAS_RERUN = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# nome: (tipo, ajuda, faixas do histograma)
+METRICAS = {
+    'app_financas_conexoes_abertas_total': ('counter', 'Conexões abertas com o PostgreSQL.', None),
+    'app_financas_conexoes_reutilizadas_total': ('counter', 'Conexões do pool emprestadas de novo.', None),
+    'app_financas_conexoes_avulsas_total': ('counter', 'Conexões abertas fora do pool por ele estar esgotado.', None),
+    'app_financas_consulta_segundos': ('histogram', 'Duração das consultas por função de dados.', FAIXAS_CONSULTA),
+    'app_financas_linhas_lidas_total': ('counter', 'Linhas recebidas do banco por função de dados.', None),
+    'app_financas_rerun_segundos': ('histogram', 'Duração dos reruns por página.', FAIXAS_RERUN),
+    'app_financas_logins_total': ('counter', 'Tentativas de login por resultado.', None),
+    'app_financas_cache_total': ('counter', 'Consultas ao cache de usuários por chave e resultado.', None),
+}
+
+# Funções que abrem cursores em nome de quem as chamou
+FUNCOES_AUXILIARES_SQL = {'executar_preparado', 'ler_preparado', 'ler_copy'}
+
+class Metricas:
+    # Valores do processo: {(nome, rótulos): número} nos contadores e
+    # {(nome, rótulos): [contagem por faixa..., soma]} nos histogramas
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.valores = {}
+    
+    def contar(self, nome, valor, rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.trava:
+            self.valores[chave] = self.valores.get(chave, 0) + valor
+    
+    def observar(self, nome, valor, rotulos):
+        faixas = METRICAS[nome][2]
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self.trava:
+            serie = self.valores.get(chave)
+            if serie is None:
+                serie = self.valores[chave] = [0] * (len(faixas) + 1) + [0.0]
+            serie[bisect.bisect_left(faixas, valor)] += 1
+            serie[-1] += valor
+    
+    def copiar(self):
+        with self.trava:
+            return {chave: list(valor) if isinstance(valor, list) else valor
+                    for chave, valor in self.valores.items()}
+    
+    def exportar(self):
+        # Valores em JSON: [[nome, [[rótulo, valor], ...], valor], ...]
+        return [[nome, [list(par) for par in rotulos], valor] for (nome, rotulos), valor in self.copiar().items()]
+    
+    def somar(self, exportados):
+        with self.trava:
+            for nome, rotulos, valor in exportados:
+                if nome not in METRICAS:
+                    continue
+                chave = (nome, tuple(tuple(par) for par in rotulos))
+                atual = self.valores.get(chave)
+                if atual is None:
+                    self.valores[chave] = valor
+                elif isinstance(atual, list):
+                    self.valores[chave] = [a + b for a, b in zip(atual, valor)]
+                else:
+                    self.valores[chave] = atual + valor
+    
+    def texto(self, processo):
+        # Cópia sob a trava; a formatação fica fora dela
+        valores = self.copiar()
+        
+        linhas = []
+        for nome, (tipo, ajuda, faixas) in METRICAS.items():
+            series = sorted((rotulos, valor) for (serie, rotulos), valor in valores.items() if serie == nome)
+            if not series:
+                continue
+            linhas.append(f"# HELP {nome} {ajuda}")
+            linhas.append(f"# TYPE {nome} {tipo}")
+            for rotulos, valor in series:
+                rotulos = (('worker', WORKER_METRICAS), ('processo', processo)) + rotulos
+                if tipo == 'counter':
+                    linhas.append(f"{nome}{formatar_rotulos(rotulos)} {valor}")
+                    continue
+                acumulado = 0
+                for limite, contagem in zip(faixas + ('+Inf',), valor):
+                    acumulado += contagem
+                    linhas.append(f"{nome}_bucket{formatar_rotulos(rotulos + (('le', str(limite)),))} {acumulado}")
+                linhas.append(f"{nome}_sum{formatar_rotulos(rotulos)} {valor[-1]}")
+                linhas.append(f"{nome}_count{formatar_rotulos(rotulos)} {acumulado}")
+        return "\n".join(linhas) + "\n"
+
+def formatar_rotulos(rotulos):
+    pares = []
+    for nome, valor in rotulos:
+        # Escapes exigidos pelo formato texto nos valores dos rótulos
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pares.append(f'{nome}="{valor}"')
+    return '{' + ','.join(pares) + '}'
+
+def caminho_metricas(sufixo=''):
+    return os.path.join(DIRETORIO_METRICAS, f"app_financas_{WORKER_METRICAS}{sufixo}")
+
+def gravar_arquivo_metricas(caminho, conteudo):
+    # O arquivo é trocado de uma vez (os.replace), então o coletor nunca lê
+    # um arquivo pela metade; o temporário não termina em .prom nem .json
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as arquivo:
+        arquivo.write(conteudo)
+    os.replace(caminho + '.tmp', caminho)
+
+def escrever_metricas(metricas):
+    try:
+        os.makedirs(DIRETORIO_METRICAS, exist_ok=True)
+        gravar_arquivo_metricas(caminho_metricas('.prom'), metricas.texto('servidor'))
+    except OSError:
+        pass
+
+def entregar_metricas_tarefa(metricas):
+    # Fim do processo de uma tarefa: os valores vão para a thread do servidor
+    # que iniciou a tarefa (ver somar_metricas_tarefas)
+    pendentes = caminho_metricas('_tarefas.d')
+    try:
+        os.makedirs(pendentes, exist_ok=True)
+        gravar_arquivo_metricas(os.path.join(pendentes, f"{os.getpid()}.json"), json.dumps(metricas.exportar()))
+    except OSError:
+        pass
+
+def somar_metricas_tarefas(tarefas):
+    # Só a thread do servidor lê e apaga os arquivos das tarefas, então não há
+    # disputa entre processos. O total é gravado antes de apagar os arquivos
+    # somados: uma queda no meio repete uma tarefa, não perde nenhuma.
+    pendentes = caminho_metricas('_tarefas.d')
+    try:
+        arquivos = [os.path.join(pendentes, nome) for nome in os.listdir(pendentes) if nome.endswith('.json')]
+    except OSError:
+        arquivos = []
+    try:
+        for caminho in arquivos:
+            with open(caminho, encoding='utf-8') as arquivo:
+                tarefas.somar(json.load(arquivo))
+        if arquivos or not os.path.exists(caminho_metricas('_tarefas.prom')):
+            gravar_arquivo_metricas(caminho_metricas('_tarefas.json'), json.dumps(tarefas.exportar()))
+            gravar_arquivo_metricas(caminho_metricas('_tarefas.prom'), tarefas.texto('tarefas'))
+        for caminho in arquivos:
+            os.remove(caminho)
+    except (OSError, ValueError):
+        pass
+
+def exportar_metricas(metricas):
+    tarefas = Metricas()
+    try:
+        with open(caminho_metricas('_tarefas.json'), encoding='utf-8') as arquivo:
+            tarefas.somar(json.load(arquivo))
+    except (OSError, ValueError):
+        pass
+    while True:
+        time.sleep(INTERVALO_METRICAS)
+        escrever_metricas(metricas)
+        somar_metricas_tarefas(tarefas)
+
+@st.cache_resource
+def iniciar_metricas():
+    metricas = Metricas()
+    threading.Thread(target=exportar_metricas, args=(metricas,), name="exportador-metricas", daemon=True).start()
+    return metricas
+
+# Fora do servidor do Streamlit (tarefas em segundo plano, scripts) o
+# st.cache_resource não guarda o registro, então ele fica nesta variável, sem
+# thread de gravação: executar_tarefa entrega os valores ao fim da tarefa
+metricas_processo = None
+
+def get_metricas():
+    global metricas_processo
+    if not DIRETORIO_METRICAS:
+        return None
+    if st.runtime.exists():
+        return iniciar_metricas()
+    if metricas_processo is None:
+        metricas_processo = Metricas()
+    return metricas_processo
+
+def contar_metrica(nome, valor=1, **rotulos):
+    metricas = get_metricas()
+    if metricas:
+        metricas.contar(nome, valor, rotulos)
+
+def observar_metrica(nome, valor, **rotulos):
+    metricas = get_metricas()
+    if metricas:
+        metricas.observar(nome, valor, rotulos)
+
+def funcao_de_dados(frame):
+    # Primeira função deste arquivo na pilha, pulando os auxiliares de leitura
+    # e o código do pandas (pd.read_sql_query)
+    while frame is not None and (frame.f_code.co_filename != __file__
+                                 or frame.f_code.co_name in FUNCOES_AUXILIARES_SQL):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'desconhecida'
+
+class CursorMedido(psycopg2.extensions.cursor):
+    # Cursor das conexões quando as métricas estão ligadas: registra duração
+    # e linhas lidas na função de dados que abriu o cursor. O registro é
+    # guardado na criação porque o COPY de ler_copy roda em outra thread.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.funcao = funcao_de_dados(sys._getframe(1))
+        self.metricas = get_metricas()
+    
+    def execute(self, query, vars=None):
+        return self.medir(super().execute, query, vars)
+    
+    def executemany(self, query, vars_list):
+        return self.medir(super().executemany, query, vars_list)
+    
+    def copy_expert(self, sql, file, size=8192):
+        return self.medir(super().copy_expert, sql, file, size)
+    
+    def medir(self, executar, comando, *args):
+        rotulos = {'funcao': self.funcao}
+        inicio = time.perf_counter()
+        try:
+            resultado = executar(comando, *args)
+        finally:
+            self.metricas.observar('app_financas_consulta_segundos', time.perf_counter() - inicio, rotulos)
+        # Cursores do lado do cliente recebem o resultado inteiro na execução
+        if self.rowcount > 0 and (self.description is not None or 'TO STDOUT' in comando):
+            self.metricas.contar('app_financas_linhas_lidas_total', self.rowcount, rotulos)
+        return resultado
+
+# Funções para autenticação e banco de dados
+# Migrações de esquema. A versão de cada escopo ('global' e 'usuario:<nome>')
+# fica em schema_version e só as migrações seguintes são aplicadas. Migrações
+# já publicadas não devem ser alteradas: mudanças de esquema entram como uma
+# nova função no fim da lista. As primeiras versões usam IF NOT EXISTS porque
+# as instalações anteriores já têm essas tabelas.
+CHAVE_MIGRACAO = 'app_financas_migracoes'
+LOTE_MIGRACAO = 50
+
+def migracao_global_1(cur):
     # Banco de dados principal para autenticação
     cur.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -77,14 +691,222 @@ def init_db():
         hashed_password = hashlib.sha256('admin123'.encode()).hexdigest()
         cur.execute("INSERT INTO users (username, password, is_admin, is_active) VALUES (%s, %s, 1, 1)", 
                  ('admin', hashed_password))
-    
-    conn.commit()
-    conn.close()
 
-def init_user_db(username):
-    conn = get_connection()
-    cur = conn.cursor()
-    
+def migracao_global_2(cur):
+    # Extensões para a busca por descrição (sem acentos e aproximada).
+    # unaccent() não é IMMUTABLE, por isso o índice usa a função f_unaccent.
+    cur.execute("SAVEPOINT extensoes")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+        cur.execute("SELECT to_regprocedure('f_unaccent(text)')")
+        if cur.fetchone()[0] is None:
+            cur.execute("""
+            CREATE FUNCTION f_unaccent(text) RETURNS text AS
+            $$ SELECT public.unaccent('public.unaccent', $1) $$
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+            """)
+    except psycopg2.Error:
+        # Sem permissão para criar extensões; a busca ficará indisponível
+        cur.execute("ROLLBACK TO SAVEPOINT extensoes")
+
+def migracao_global_3(cur):
+    # Contadores de gastos por categoria e mês (gastos_mensais_<usuário>),
+    # mantidos por triggers na mesma transação de cada escrita. O usuário
+    # chega em TG_ARGV[0]; nomes sem aspas ficam em minúsculas no catálogo.
+    # Os valores são REAL e somas em REAL deixam resíduos (um orçamento
+    # apareceria estourado por centavos): cada valor entra arredondado em
+    # centavos num total NUMERIC, via float8, que preserva os dígitos do REAL.
+    # Assim a exclusão desconta exatamente o que a inclusão somou.
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION somar_gasto_mensal(usuario text, categoria integer, dia date, valor numeric)
+    RETURNS void AS $$
+    BEGIN
+        EXECUTE format('INSERT INTO %1$I (categoria_id, mes, total) VALUES ($1, $2, $3)
+                        ON CONFLICT (categoria_id, mes) DO UPDATE SET total = %1$I.total + EXCLUDED.total',
+                       'gastos_mensais_' || lower(usuario))
+        USING categoria, date_trunc('month', dia)::date, valor;
+    END $$ LANGUAGE plpgsql
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION gasto_movimentacao() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.tipo = 'saida' THEN
+            PERFORM somar_gasto_mensal(TG_ARGV[0], OLD.categoria_id, OLD.data,
+                                       -round(OLD.valor::float8::numeric, 2));
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.tipo = 'saida' THEN
+            PERFORM somar_gasto_mensal(TG_ARGV[0], NEW.categoria_id, NEW.data,
+                                       round(NEW.valor::float8::numeric, 2));
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """)
+    # Planos: cada parcela não cancelada conta no mês em que cai (ver
+    # sql_movimentacoes). Uma única instrução por alteração do plano: as
+    # parcelas antigas (negativas) e as novas somadas por mês; os meses em que
+    # nada muda (ex.: só a descrição foi editada) não são gravados.
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION gasto_parcelamento() RETURNS trigger AS $$
+    BEGIN
+        EXECUTE format($sql$
+            INSERT INTO %1$I (categoria_id, mes, total)
+            SELECT p.categoria_id, date_trunc('month', p.data_inicio + (g.parcela - 1) * 30)::date,
+                   SUM(p.sinal * round((p.valor_total / p.total_parcelas)::real::float8::numeric, 2))
+            FROM (
+                SELECT ($1).categoria_id, ($1).data_inicio, ($1).valor_total, ($1).total_parcelas,
+                       ($1).parcelas_canceladas, -1 AS sinal
+                WHERE ($1).tipo = 'saida'
+                UNION ALL
+                SELECT ($2).categoria_id, ($2).data_inicio, ($2).valor_total, ($2).total_parcelas,
+                       ($2).parcelas_canceladas, 1
+                WHERE ($2).tipo = 'saida'
+            ) p
+            CROSS JOIN LATERAL generate_series(1, p.total_parcelas) AS g(parcela)
+            WHERE g.parcela <> ALL(p.parcelas_canceladas)
+            GROUP BY 1, 2
+            HAVING SUM(p.sinal * round((p.valor_total / p.total_parcelas)::real::float8::numeric, 2)) <> 0
+            ON CONFLICT (categoria_id, mes) DO UPDATE SET total = %1$I.total + EXCLUDED.total
+        $sql$, 'gastos_mensais_' || lower(TG_ARGV[0]))
+        USING OLD, NEW;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """)
+
+def migracao_global_4(cur):
+    # Registro de alterações (somente inserção) com os valores antes e depois
+    # de cada linha. Gravado por triggers de instrução na mesma transação da
+    # escrita: uma alteração em massa vira um único INSERT ... SELECT.
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS alteracoes (
+        id BIGSERIAL PRIMARY KEY,
+        momento TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        usuario TEXT NOT NULL,
+        autor TEXT NOT NULL,
+        tabela TEXT NOT NULL,
+        operacao TEXT NOT NULL,
+        antes JSONB,
+        depois JSONB
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_alteracoes_usuario ON alteracoes (usuario, id)")
+    # Última escrita de cada usuário (estatísticas da Administração)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_alteracoes_usuario_momento ON alteracoes (usuario, momento)")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION bloquear_alteracao_registro() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'O registro de alterações não pode ser modificado';
+    END $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS somente_insercao ON alteracoes")
+    cur.execute("""
+        CREATE TRIGGER somente_insercao BEFORE UPDATE OR DELETE OR TRUNCATE ON alteracoes
+        FOR EACH STATEMENT EXECUTE FUNCTION bloquear_alteracao_registro()
+    """)
+
+    # Argumentos: usuário dono da tabela ('' em users: o dono é a própria
+    # linha), nome da tabela no registro e coluna que identifica a linha.
+    # O autor vem de app.autor (ações do admin) ou é o próprio usuário; o
+    # hash da senha nunca é gravado, apenas o fato de ter sido alterado.
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION registrar_alteracoes() RETURNS trigger AS $$
+    DECLARE
+        autor_sessao text := NULLIF(current_setting('app.autor', true), '');
+    BEGIN
+        -- Cargas e arquivamentos gravam uma linha de resumo no lugar das linhas
+        IF current_setting('app.auditoria', true) = 'desligada' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO alteracoes (usuario, autor, tabela, operacao, depois)
+            SELECT u.usuario, COALESCE(autor_sessao, u.usuario), TG_ARGV[1], TG_OP, r.depois
+            FROM (SELECT to_jsonb(n) - 'password' AS depois FROM novas n) r
+            CROSS JOIN LATERAL (SELECT COALESCE(NULLIF(TG_ARGV[0], ''), r.depois->>'username') AS usuario) u;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO alteracoes (usuario, autor, tabela, operacao, antes)
+            SELECT u.usuario, COALESCE(autor_sessao, u.usuario), TG_ARGV[1], TG_OP, a.antes
+            FROM (SELECT to_jsonb(o) - 'password' AS antes FROM antigas o) a
+            CROSS JOIN LATERAL (SELECT COALESCE(NULLIF(TG_ARGV[0], ''), a.antes->>'username') AS usuario) u;
+        ELSE
+            INSERT INTO alteracoes (usuario, autor, tabela, operacao, antes, depois)
+            SELECT u.usuario, COALESCE(autor_sessao, u.usuario), TG_ARGV[1], TG_OP, a.antes,
+                   CASE WHEN a.senha IS DISTINCT FROM r.senha
+                        THEN r.depois || '{"senha_alterada": true}' ELSE r.depois END
+            FROM (SELECT to_jsonb(o) - 'password' AS antes, to_jsonb(o)->'password' AS senha FROM antigas o) a
+            JOIN (SELECT to_jsonb(n) - 'password' AS depois, to_jsonb(n)->'password' AS senha FROM novas n) r
+              ON r.depois->TG_ARGV[2] = a.antes->TG_ARGV[2]
+            CROSS JOIN LATERAL (SELECT COALESCE(NULLIF(TG_ARGV[0], ''), r.depois->>'username') AS usuario) u
+            WHERE a.antes <> r.depois OR a.senha IS DISTINCT FROM r.senha;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """)
+    criar_triggers_alteracoes(cur, 'users', 'users', '', 'id')
+
+def criar_triggers_alteracoes(cur, tabela, nome, username, chave):
+    # Tabelas de transição só são aceitas em triggers de um único evento
+    for evento, transicao in [('INSERT', 'NEW TABLE AS novas'),
+                              ('UPDATE', 'OLD TABLE AS antigas NEW TABLE AS novas'),
+                              ('DELETE', 'OLD TABLE AS antigas')]:
+        cur.execute(f"DROP TRIGGER IF EXISTS alteracoes_{evento.lower()} ON {tabela}")
+        cur.execute(f"""
+            CREATE TRIGGER alteracoes_{evento.lower()}
+            AFTER {evento} ON {tabela} REFERENCING {transicao}
+            FOR EACH STATEMENT EXECUTE FUNCTION registrar_alteracoes('{username}', '{nome}', '{chave}')
+        """)
+
+def migracao_global_5(cur):
+    # Relatórios executados em segundo plano (ver executar_tarefa). pid é o
+    # processo do PostgreSQL que executa a tarefa, usado no cancelamento.
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS tarefas (
+        id SERIAL PRIMARY KEY,
+        usuario TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        parametros JSONB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendente',
+        progresso REAL NOT NULL DEFAULT 0,
+        mensagem TEXT,
+        pid INTEGER,
+        arquivo TEXT,
+        criada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        iniciada_em TIMESTAMP,
+        concluida_em TIMESTAMP
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_usuario ON tarefas (usuario, id)")
+
+def migracao_global_6(cur):
+    # Captura de perfil dos reruns de um usuário (ver capturar_perfil):
+    # quantos reruns ainda capturar e o resultado de cada um
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS capturas_perfil (
+        usuario TEXT PRIMARY KEY,
+        restantes INTEGER NOT NULL,
+        solicitada_por TEXT NOT NULL,
+        solicitada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS perfis (
+        id SERIAL PRIMARY KEY,
+        usuario TEXT NOT NULL,
+        pagina TEXT,
+        momento TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        duracao REAL NOT NULL,
+        memoria_pico BIGINT,
+        funcoes JSONB NOT NULL,
+        alocacoes JSONB NOT NULL,
+        estatisticas BYTEA NOT NULL,
+        pilhas TEXT NOT NULL
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_perfis_usuario ON perfis (usuario, id)")
+
+MIGRACOES_GLOBAIS = [migracao_global_1, migracao_global_2, migracao_global_3, migracao_global_4,
+                     migracao_global_5, migracao_global_6]
+
+def migracao_usuario_1(cur, username):
     # Tabela para categorias
     cur.execute(f'''
     CREATE TABLE IF NOT EXISTS categorias_{username} (
@@ -109,359 +931,1972 @@ def init_user_db(username):
         FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id)
     )
     ''')
+
+def migracao_usuario_2(cur, username):
+    # Tabela para planos de parcelamento (uma linha por compra parcelada)
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS parcelamentos_{username} (
+        id SERIAL PRIMARY KEY,
+        categoria_id INTEGER NOT NULL,
+        valor_total REAL NOT NULL,
+        data_inicio DATE NOT NULL,
+        tipo TEXT NOT NULL,
+        descricao TEXT,
+        total_parcelas INTEGER NOT NULL,
+        parcelas_canceladas INTEGER[] NOT NULL DEFAULT '{{}}',
+        FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id)
+    )
+    ''')
+
+    # Converte grupos de parcelas gravados linha a linha em planos de parcelamento.
+    # Grupos antigos são os que ainda não possuem um plano com o mesmo id.
+    cur.execute(f"""
+        SELECT m.id, m.id_grupo_parcela, m.categoria_id, m.valor, m.data, m.tipo,
+               m.descricao, m.parcela, m.total_parcelas
+        FROM movimentacoes_{username} m
+        WHERE m.id_grupo_parcela IS NOT NULL AND m.total_parcelas > 1
+          AND NOT EXISTS (SELECT 1 FROM parcelamentos_{username} p WHERE p.id = m.id_grupo_parcela)
+        ORDER BY m.id_grupo_parcela, m.parcela
+    """)
+    linhas = cur.fetchall()
+
+    planos = []
+    ids_convertidos = []
+    grupos = {}
+    for linha in linhas:
+        grupos.setdefault(linha[1], []).append(linha)
+
+    for id_grupo, parcelas in grupos.items():
+        # A primeira parcela existente define os valores do plano
+        _, _, categoria_id, valor, data, tipo, descricao, parcela, total = parcelas[0]
+        data_inicio = data - datetime.timedelta(days=(parcela - 1) * 30)
+        descricao_base = re.sub(r" \(\d+/\d+\)$", "", descricao or "")
+
+        convertidas = set()
+        for id_mov, _, c_id, v, d, t, desc, p, _ in parcelas:
+            esperado = (
+                c_id == categoria_id and t == tipo and abs(v - valor) < 0.005
+                and d == data_inicio + datetime.timedelta(days=(p - 1) * 30)
+                and (desc or "") == f"{descricao_base} ({p}/{total})"
+                and p not in convertidas
+            )
+            if esperado:
+                convertidas.add(p)
+                ids_convertidos.append(id_mov)
+
+        # Parcelas excluídas ou editadas individualmente continuam fora do plano
+        canceladas = [i for i in range(1, total + 1) if i not in convertidas]
+        planos.append((id_grupo, categoria_id, valor * total, data_inicio, tipo,
+                       descricao_base, total, canceladas))
+
+    if planos:
+        cur.executemany(f"""
+            INSERT INTO parcelamentos_{username}
+            (id, categoria_id, valor_total, data_inicio, tipo, descricao, total_parcelas, parcelas_canceladas)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, planos)
+        cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id = ANY(%s)", (ids_convertidos,))
+        cur.execute(f"""
+            SELECT setval(pg_get_serial_sequence('parcelamentos_{username}', 'id'),
+                          (SELECT MAX(id) FROM parcelamentos_{username}))
+        """)
+        notificar_alteracao(cur, username, 'movimentacoes')
+
+def migracao_usuario_3(cur, username):
+    # Índice trigram sobre a descrição normalizada (minúsculas e sem acentos)
+    cur.execute("SAVEPOINT busca")
+    try:
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_movimentacoes_{username}_descricao_trgm
+            ON movimentacoes_{username} USING gin (f_unaccent(lower(descricao)) gin_trgm_ops)
+        """)
+    except psycopg2.Error:
+        # Extensões indisponíveis (ver migracao_global_2)
+        cur.execute("ROLLBACK TO SAVEPOINT busca")
+
+def migracao_usuario_4(cur, username):
+    # Arquivo dos anos encerrados: tabela sem índice trigram nem chave primária,
+    # páginas cheias (fillfactor 100) e índice BRIN sobre a data, já que as
+    # linhas entram em ordem cronológica. O resumo mensal mantém os totais.
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS movimentacoes_arquivo_{username} (
+        id INTEGER NOT NULL,
+        categoria_id INTEGER NOT NULL,
+        valor REAL NOT NULL,
+        data DATE NOT NULL,
+        tipo TEXT NOT NULL,
+        descricao TEXT,
+        parcela INTEGER DEFAULT 0,
+        total_parcelas INTEGER DEFAULT 0,
+        FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id)
+    ) WITH (fillfactor = 100)
+    ''')
+    cur.execute(f'''
+    CREATE INDEX IF NOT EXISTS idx_movimentacoes_arquivo_{username}_data
+    ON movimentacoes_arquivo_{username} USING brin (data)
+    ''')
+    # Os totais por período (sql_totais_mensais) filtram as movimentações vivas pela data
+    cur.execute(f'''
+    CREATE INDEX IF NOT EXISTS idx_movimentacoes_{username}_data
+    ON movimentacoes_{username} (data)
+    ''')
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS resumo_mensal_{username} (
+        mes DATE NOT NULL,
+        categoria_id INTEGER NOT NULL,
+        tipo TEXT NOT NULL,
+        total REAL NOT NULL,
+        quantidade INTEGER NOT NULL,
+        FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id)
+    )
+    ''')
+
+def migracao_usuario_5(cur, username):
+    # Orçamento mensal por categoria e contadores de gasto por mês
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS orcamentos_{username} (
+        categoria_id INTEGER PRIMARY KEY,
+        valor_mensal REAL NOT NULL,
+        FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id) ON DELETE CASCADE
+    )
+    ''')
+    cur.execute(f'''
+    CREATE TABLE IF NOT EXISTS gastos_mensais_{username} (
+        categoria_id INTEGER NOT NULL,
+        mes DATE NOT NULL,
+        total NUMERIC(14, 2) NOT NULL,
+        PRIMARY KEY (categoria_id, mes),
+        FOREIGN KEY (categoria_id) REFERENCES categorias_{username} (id) ON DELETE CASCADE
+    )
+    ''')
     
-    # Adicionando algumas categorias padrão se não existirem
-    categorias_padrao = [
-        ('Salário', 'entrada'),
-        ('Alimentação', 'saida'),
-        ('Transporte', 'saida'),
-        ('Lazer', 'saida'),
-        ('Saúde', 'saida'),
-        ('Educação', 'saida'),
-        ('Moradia', 'saida'),
-        ('Diversos', 'saida')
-    ]
+    # Triggers antes da carga inicial: o CREATE TRIGGER bloqueia as escritas
+    # nas tabelas até o fim da transação, então nenhuma fica de fora da conta.
+    # O arquivo também conta: arquivar_anos move linhas sem alterar os gastos.
+    for tabela, funcao in [('movimentacoes', 'gasto_movimentacao'),
+                           ('movimentacoes_arquivo', 'gasto_movimentacao'),
+                           ('parcelamentos', 'gasto_parcelamento')]:
+        cur.execute(f"DROP TRIGGER IF EXISTS gastos_mensais ON {tabela}_{username}")
+        cur.execute(f"""
+            CREATE TRIGGER gastos_mensais
+            AFTER INSERT OR UPDATE OR DELETE ON {tabela}_{username}
+            FOR EACH ROW EXECUTE FUNCTION {funcao}('{username}')
+        """)
     
-    for cat in categorias_padrao:
-        try:
-            cur.execute(f"INSERT INTO categorias_{username} (nome, tipo) VALUES (%s, %s) ON CONFLICT (nome) DO NOTHING", cat)
-        except psycopg2.IntegrityError:
-            conn.rollback()  # Categoria já existe
+    cur.execute(f"DELETE FROM gastos_mensais_{username}")
+    cur.execute(f"""
+        INSERT INTO gastos_mensais_{username} (categoria_id, mes, total)
+        SELECT categoria_id, date_trunc('month', data)::date, SUM(round(valor::float8::numeric, 2))
+        FROM (
+            SELECT categoria_id, valor, data, tipo FROM movimentacoes_{username}
+            UNION ALL
+            SELECT categoria_id, valor, data, tipo FROM movimentacoes_arquivo_{username}
+            UNION ALL
+            SELECT p.categoria_id, (p.valor_total / p.total_parcelas)::real,
+                   p.data_inicio + (g.parcela - 1) * 30, p.tipo
+            FROM parcelamentos_{username} p
+            CROSS JOIN LATERAL generate_series(1, p.total_parcelas) AS g(parcela)
+            WHERE g.parcela <> ALL(p.parcelas_canceladas)
+        ) m
+        WHERE tipo = 'saida'
+        GROUP BY 1, 2
+    """)
+
+def migracao_usuario_6(cur, username):
+    # Registro de alterações das tabelas editadas pelo usuário (ver
+    # migracao_global_4). Arquivo e resumos só mudam por arquivar_anos.
+    for tabela, chave in [('categorias', 'id'), ('movimentacoes', 'id'),
+                          ('parcelamentos', 'id'), ('orcamentos', 'categoria_id')]:
+        criar_triggers_alteracoes(cur, f"{tabela}_{username}", tabela, username, chave)
+
+def migracao_usuario_7(cur, username):
+    # Limite de parcelas do id virtual (ver MAX_PARCELAS). NOT VALID: só
+    # vale para planos novos ou alterados, sem varrer os existentes.
+    cur.execute(f"""
+        ALTER TABLE parcelamentos_{username}
+        ADD CONSTRAINT parcelamentos_{username}_total_parcelas_check CHECK (total_parcelas <= 99) NOT VALID
+    """)
+
+MIGRACOES_USUARIO = [migracao_usuario_1, migracao_usuario_2, migracao_usuario_3, migracao_usuario_4,
+                     migracao_usuario_5, migracao_usuario_6, migracao_usuario_7]
+
+def versao_schema(cur, escopo):
+    cur.execute("SELECT versao FROM schema_version WHERE escopo = %s", (escopo,))
+    result = cur.fetchone()
+    return result[0] if result else 0
+
+def registrar_versao(cur, escopo, versao):
+    cur.execute("""
+        INSERT INTO schema_version (escopo, versao) VALUES (%s, %s)
+        ON CONFLICT (escopo) DO UPDATE SET versao = EXCLUDED.versao, aplicada_em = CURRENT_TIMESTAMP
+    """, (escopo, versao))
+
+def migrar_usuario(cur, username):
+    # Aplica as migrações pendentes de um usuário na transação corrente.
+    # O lock por usuário evita que o cadastro e o executor migrem o mesmo usuário.
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))", (CHAVE_MIGRACAO, username))
+    versao = versao_schema(cur, f"usuario:{username}")
+    for migracao in MIGRACOES_USUARIO[versao:]:
+        migracao(cur, username)
+    if versao < len(MIGRACOES_USUARIO):
+        registrar_versao(cur, f"usuario:{username}", len(MIGRACOES_USUARIO))
+
+def executar_migracoes(lote=LOTE_MIGRACAO):
+    # Executado uma vez por implantação (python app_sql.py migrar) e, como
+    # garantia, uma vez por processo em preparar_banco. Conexão própria: o lock
+    # de sessão impede dois executores ao mesmo tempo e é liberado no close.
+    conn = conectar(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    migrados = 0
+    falhas = []
+    try:
+        cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (CHAVE_MIGRACAO,))
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            escopo TEXT PRIMARY KEY,
+            versao INTEGER NOT NULL,
+            aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        versao = versao_schema(cur, 'global')
+        for migracao in MIGRACOES_GLOBAIS[versao:]:
+            migracao(cur)
+        if versao < len(MIGRACOES_GLOBAIS):
+            registrar_versao(cur, 'global', len(MIGRACOES_GLOBAIS))
+        conn.commit()
         
-    conn.commit()
-    conn.close()
+        # Usuários com tabelas próprias e versão atrasada, em lotes; cada
+        # usuário em sua transação, para que uma falha não desfaça os demais
+        while True:
+            cur.execute("""
+                SELECT u.username
+                FROM users u
+                LEFT JOIN schema_version s ON s.escopo = 'usuario:' || u.username
+                WHERE COALESCE(s.versao, 0) < %s
+                  AND to_regclass('categorias_' || lower(u.username)) IS NOT NULL
+                  AND u.username <> ALL(%s)
+                ORDER BY u.username
+                LIMIT %s
+            """, (len(MIGRACOES_USUARIO), falhas, lote))
+            usernames = [r[0] for r in cur.fetchall()]
+            conn.commit()
+            if not usernames:
+                break
+            
+            for username in usernames:
+                try:
+                    migrar_usuario(cur, username)
+                    conn.commit()
+                    migrados += 1
+                except psycopg2.Error:
+                    conn.rollback()
+                    falhas.append(username)
+    finally:
+        conn.close()
     
+    return migrados, falhas
+
+@st.cache_resource
+def preparar_banco():
+    # Uma vez por processo: depois das migrações, o caminho das requisições
+    # não executa DDL
+    return executar_migracoes()
+
+def init_user_db(username):
+    # Cadastro: cria as tabelas do usuário já na versão atual do esquema
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        migrar_usuario(cur, username)
+
+        # Adicionando algumas categorias padrão se não existirem
+        categorias_padrao = [
+            ('Salário', 'entrada'),
+            ('Alimentação', 'saida'),
+            ('Transporte', 'saida'),
+            ('Lazer', 'saida'),
+            ('Saúde', 'saida'),
+            ('Educação', 'saida'),
+            ('Moradia', 'saida'),
+            ('Diversos', 'saida')
+        ]
+        
+        for cat in categorias_padrao:
+            cur.execute(f"INSERT INTO categorias_{username} (nome, tipo) VALUES (%s, %s) ON CONFLICT (nome) DO NOTHING", cat)
+            
+        conn.commit()
+
     return username
 
+def sql_movimentacoes(username, arquivo=False, periodo=False):
+    # Movimentações avulsas mais as parcelas expandidas a partir dos planos.
+    # Parcelas virtuais recebem id negativo: -(id_plano * 100 + parcela).
+    # Com arquivo=True inclui também as linhas dos anos arquivados.
+    # Com periodo=True cada parte já filtra data >= %(inicio)s e < %(fim)s:
+    # um filtro sobre uma coluna calculada fora da união não usa o índice da data.
+    filtro = "WHERE data >= %(inicio)s AND data < %(fim)s" if periodo else ""
+    arquivadas = f"""
+        SELECT id, categoria_id, valor, data, tipo, descricao,
+               parcela, total_parcelas, NULL::integer
+        FROM movimentacoes_arquivo_{username}
+        {filtro}
+        UNION ALL""" if arquivo else ""
+    filtro_planos = """
+          AND p.data_inicio < %(fim)s AND p.data_inicio + (p.total_parcelas - 1) * 30 >= %(inicio)s
+          AND p.data_inicio + (g.parcela - 1) * 30 >= %(inicio)s
+          AND p.data_inicio + (g.parcela - 1) * 30 < %(fim)s""" if periodo else ""
+    return f"""(
+        SELECT id, categoria_id, valor, data, tipo, descricao,
+               parcela, total_parcelas, id_grupo_parcela
+        FROM movimentacoes_{username}
+        {filtro}
+        UNION ALL{arquivadas}
+        SELECT -(p.id * 100 + g.parcela), p.categoria_id,
+               (p.valor_total / p.total_parcelas)::real,
+               p.data_inicio + (g.parcela - 1) * 30, p.tipo,
+               COALESCE(p.descricao, '') || ' (' || g.parcela || '/' || p.total_parcelas || ')',
+               g.parcela, p.total_parcelas, p.id
+        FROM parcelamentos_{username} p
+        CROSS JOIN LATERAL generate_series(1, p.total_parcelas) AS g(parcela)
+        WHERE g.parcela <> ALL(p.parcelas_canceladas){filtro_planos}
+    )"""
+
+# O id virtual reserva dois dígitos para a parcela
+MAX_PARCELAS = 99
+
+def decodificar_id_parcela(id):
+    # Retorna (id_plano, parcela) para ids de parcelas virtuais, ou None
+    id = int(id)
+    if id >= 0:
+        return None
+    return divmod(-id, 100)
+
+# Arquivamento de anos encerrados
+def get_limite_arquivo(username):
+    # Último dia arquivado (ou None), mantido no cache do usuário
+    def calcular():
+        with get_connection(somente_leitura=True, username=username) as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT (MAX(mes) + interval '1 month' - interval '1 day')::date FROM resumo_mensal_{username}")
+            limite = cur.fetchone()[0]
+        return limite
+    return em_cache(username, 'arquivo', calcular)
+
+def alcanca_arquivo(username, data_inicio=None):
+    # O arquivo só entra na consulta quando o período começa antes do último
+    # dia arquivado (ou não tem início)
+    limite = get_limite_arquivo(username)
+    if limite is None:
+        return False
+    if not data_inicio:
+        return True
+    return datetime.date.fromisoformat(str(data_inicio)[:10]) <= limite
+
+def sql_totais_mensais(username):
+    # Valores por mês (categoria_id, tipo, mes, total) de %(inicio)s até
+    # %(fim)s (exclusivo): movimentações e parcelas vivas mais os totais
+    # mensais guardados no arquivamento. Os parâmetros vão por nome.
+    return f"""(
+        SELECT categoria_id, tipo, date_trunc('month', data)::date AS mes, valor AS total
+        FROM {sql_movimentacoes(username, periodo=True)} m
+        UNION ALL
+        SELECT categoria_id, tipo, mes, total
+        FROM resumo_mensal_{username}
+        WHERE mes >= date_trunc('month', %(inicio)s::date) AND mes < %(fim)s
+    )"""
+
+def arquivar_anos(username, ate_ano, autor=None):
+    # Move as movimentações avulsas até o fim de ate_ano para o arquivo e grava
+    # os totais por mês, categoria e tipo, tudo em uma única instrução.
+    # Parcelas editadas (com id_grupo_parcela) ficam junto do seu plano.
+    # No registro de alterações entra uma linha de resumo, não cada movimentação.
+    if ate_ano >= datetime.date.today().year:
+        return 0
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT set_config('app.auditoria', 'desligada', true);
+            WITH movidas AS (
+                DELETE FROM movimentacoes_{username}
+                WHERE data < %s AND id_grupo_parcela IS NULL
+                RETURNING id, categoria_id, valor, data, tipo, descricao, parcela, total_parcelas
+            ), arquivadas AS (
+                INSERT INTO movimentacoes_arquivo_{username}
+                (id, categoria_id, valor, data, tipo, descricao, parcela, total_parcelas)
+                SELECT * FROM movidas ORDER BY data, id
+                RETURNING 1
+            ), resumo AS (
+                INSERT INTO resumo_mensal_{username} (mes, categoria_id, tipo, total, quantidade)
+                SELECT date_trunc('month', data)::date, categoria_id, tipo, SUM(valor), COUNT(*)
+                FROM movidas
+                GROUP BY 1, 2, 3
+                RETURNING quantidade
+            ), registro AS (
+                INSERT INTO alteracoes (usuario, autor, tabela, operacao, depois)
+                SELECT %s, %s, 'movimentacoes', 'ARQUIVAR',
+                       jsonb_build_object('ate_ano', %s, 'quantidade', COUNT(*))
+                FROM movidas
+                HAVING COUNT(*) > 0
+            )
+            SELECT COALESCE(SUM(quantidade), 0) FROM resumo
+        """, (datetime.date(ate_ano + 1, 1, 1), username, autor or username, ate_ano))
+        arquivadas = cur.fetchone()[0]
+
+        if arquivadas:
+            notificar_alteracao(cur, username)
+        conn.commit()
+    return arquivadas
+
 def verify_password(username, password):
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    cur.execute("SELECT is_active, is_admin FROM users WHERE username = %s AND password = %s", 
-             (username, hashed_password))
-    result = cur.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        executar_preparado(cur, "SELECT is_active, is_admin FROM users WHERE username = %s AND password = %s", 
+                           (username, hashed_password))
+        result = cur.fetchone()
     
     if result:
         is_active, is_admin = result
         if is_active:
+            contar_metrica('app_financas_logins_total', resultado='sucesso')
             return True, is_admin
         else:
+            contar_metrica('app_financas_logins_total', resultado='inativo')
             return False, False
+    contar_metrica('app_financas_logins_total', resultado='recusado')
     return False, False
 
-def register_user(username, password, is_admin=False):
-    conn = get_connection()
-    cur = conn.cursor()
-    
+# Autor das alterações feitas pelo admin em nome de outro usuário, enviado na
+# mesma ida ao servidor da escrita e lido pelo trigger do registro de alterações
+SQL_AUTOR = "SELECT set_config('app.autor', %s, true); "
+
+def register_user(username, password, is_admin=False, autor=None):
     hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    try:
-        cur.execute("INSERT INTO users (username, password, is_admin) VALUES (%s, %s, %s)", 
-                 (username, hashed_password, is_admin))
-        conn.commit()
-        # Inicializar o banco de dados do usuário
-        init_user_db(username)
-        return True
-    except psycopg2.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(SQL_AUTOR + "INSERT INTO users (username, password, is_admin) VALUES (%s, %s, %s)", 
+                     (autor or '', username, hashed_password, is_admin))
+            conn.commit()
+        except psycopg2.IntegrityError:
+            return False
+    # Inicializar o banco de dados do usuário
+    init_user_db(username)
+    return True
 
 def get_all_users():
-    conn = get_connection()
-    query = "SELECT id, username, is_admin, is_active FROM users"
-    users = pd.read_sql_query(query, conn)
-    conn.close()
+    with get_connection() as conn:
+        query = "SELECT id, username, is_admin, is_active FROM users"
+        users = pd.read_sql_query(query, conn)
     return users
 
-def toggle_user_status(user_id, status):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET is_active = %s WHERE id = %s", (status, user_id))
-    conn.commit()
-    conn.close()
+def search_users(busca="", is_active=None, is_admin=None, limite=20, offset=0):
+    # Busca paginada no servidor; retorna a página e o total de resultados
+    with get_connection() as conn:
 
-def change_password(username, new_password):
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
-    cur.execute("UPDATE users SET password = %s WHERE username = %s", (hashed_password, username))
-    conn.commit()
-    conn.close()
+        condicoes = []
+        params = []
+        if busca:
+            # Escapar curingas do LIKE digitados pelo usuário
+            termo = busca.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            condicoes.append("username ILIKE %s")
+            params.append(f"%{termo}%")
+        if is_active is not None:
+            condicoes.append("is_active = %s")
+            params.append(int(is_active))
+        if is_admin is not None:
+            condicoes.append("is_admin = %s")
+            params.append(int(is_admin))
+
+        query = "SELECT id, username, is_admin, is_active, COUNT(*) OVER() AS total FROM users"
+        if condicoes:
+            query += " WHERE " + " AND ".join(condicoes)
+        query += " ORDER BY username LIMIT %s OFFSET %s"
+        params.extend([limite, offset])
+
+        users = pd.read_sql_query(query, conn, params=params)
+
+    total = int(users['total'].iloc[0]) if not users.empty else 0
+    return users.drop(columns=['total']), total
+
+def toggle_user_status(user_id, status, autor=None):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_AUTOR + "UPDATE users SET is_active = %s WHERE id = %s RETURNING username",
+                    (autor or '', status, user_id))
+        result = cur.fetchone()
+        if result:
+            notificar_alteracao(cur, result[0])
+        conn.commit()
+
+def change_password(username, new_password, autor=None):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
+        cur.execute(SQL_AUTOR + "UPDATE users SET password = %s WHERE username = %s",
+                    (autor or '', hashed_password, username))
+        conn.commit()
+
+# Estatísticas de armazenamento por usuário (uma única consulta ao catálogo)
+ORDENACAO_ESTATISTICAS = {
+    'Tamanho total': 'tamanho_total DESC',
+    'Linhas': 'linhas DESC',
+    'Escritas': 'escritas DESC',
+    'Última atividade': 'ultima_atividade DESC NULLS LAST',
+    'Proporção de linhas mortas': 'proporcao_mortas DESC NULLS LAST',
+    'Usuário': 'username'
+}
+
+def get_estatisticas_usuarios(ordem='Tamanho total'):
+    # Fica no primário: contadores de pg_stat_* não são replicados
+    with get_connection() as conn:
+        
+        # Identificadores sem aspas são gravados em minúsculas no catálogo.
+        # A última atividade é a escrita mais recente do usuário no registro
+        # de alterações; o MAX sai do índice (usuario, momento).
+        query = f"""
+        SELECT u.username,
+               COALESCE(SUM(s.n_live_tup), 0) AS linhas,
+               COALESCE(SUM(pg_table_size(s.relid)), 0) AS tamanho_tabelas,
+               COALESCE(SUM(pg_indexes_size(s.relid)), 0) AS tamanho_indices,
+               COALESCE(SUM(pg_total_relation_size(s.relid)), 0) AS tamanho_total,
+               COALESCE(SUM(s.n_tup_ins + s.n_tup_upd + s.n_tup_del), 0) AS escritas,
+               (SELECT MAX(a.momento) FROM alteracoes a WHERE a.usuario = u.username) AS ultima_atividade,
+               SUM(s.n_dead_tup)::float / NULLIF(SUM(s.n_live_tup + s.n_dead_tup), 0) AS proporcao_mortas
+        FROM users u
+        LEFT JOIN pg_stat_user_tables s
+               ON s.schemaname = 'public'
+              AND s.relname IN ('categorias_' || lower(u.username),
+                                'movimentacoes_' || lower(u.username),
+                                'parcelamentos_' || lower(u.username),
+                                'movimentacoes_arquivo_' || lower(u.username),
+                                'resumo_mensal_' || lower(u.username),
+                                'orcamentos_' || lower(u.username),
+                                'gastos_mensais_' || lower(u.username))
+        GROUP BY u.username
+        ORDER BY {ORDENACAO_ESTATISTICAS[ordem]}
+        """
+        estatisticas = pd.read_sql_query(query, conn)
+    return estatisticas
+
+# Backup e restauração por usuário. O arquivo é um gzip com uma linha de
+# cabeçalho e, para cada usuário, uma seção "#{json}" com os dados do login
+# seguida de uma seção por tabela: "#{json}", as linhas no formato texto do
+# COPY e o terminador "\." (que nunca aparece como linha de dados nesse formato).
+DIRETORIO_BACKUP = os.environ.get('BACKUP_DIR', 'backups')
+CABECALHO_BACKUP = b'APP_FINANCAS_BACKUP 1\n'
+TERMINADOR_COPY = b'\\.\n'
+# Em ordem de dependência: categorias antes das tabelas que apontam para elas
+TABELAS_BACKUP = ['categorias', 'orcamentos', 'parcelamentos', 'movimentacoes', 'movimentacoes_arquivo',
+                  'resumo_mensal']
+
+def escrever_secao(saida, secao):
+    saida.write(b'#' + json.dumps(secao).encode() + b'\n')
+
+def gerar_backup(usernames, caminho):
+    # Snapshot consistente de todos os usuários pedidos (uma transação
+    # REPEATABLE READ). O COPY escreve direto no gzip, com memória constante.
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+        try:
+            with gzip.open(caminho, 'wb') as saida:
+                saida.write(CABECALHO_BACKUP)
+                for username in usernames:
+                    cur.execute("SELECT password, is_admin, is_active FROM users WHERE username = %s", (username,))
+                    result = cur.fetchone()
+                    if not result:
+                        continue
+                    escrever_secao(saida, {'usuario': username, 'senha': result[0],
+                                           'is_admin': result[1], 'is_active': result[2]})
+
+                    for tabela in TABELAS_BACKUP:
+                        cur.execute("SELECT to_regclass(%s)", (f"{tabela}_{username}",))
+                        if cur.fetchone()[0] is None:
+                            continue
+                        cur.execute(f"SELECT * FROM {tabela}_{username} LIMIT 0")
+                        escrever_secao(saida, {'tabela': tabela, 'colunas': [c[0] for c in cur.description]})
+                        cur.copy_expert(f"COPY {tabela}_{username} TO STDOUT", saida)
+                        saida.write(TERMINADOR_COPY)
+        except BaseException:
+            # Disco cheio ou consulta cancelada: o arquivo parcial não é um
+            # backup, e a conexão pode ter ficado no meio do COPY (ver ler_copy)
+            cur.connection.descartar = True
+            if os.path.exists(caminho):
+                os.remove(caminho)
+            raise
+    return os.path.getsize(caminho)
+
+class SecaoCopy:
+    # Arquivo lido pelo copy_expert: entrega as linhas de uma seção do backup
+    # em blocos, até o terminador, sem carregar a seção inteira
+    def __init__(self, entrada):
+        self.entrada = entrada
+        self.fim = False
+
+    def read(self, tamanho=8192):
+        partes = []
+        lidos = 0
+        while not self.fim and lidos < tamanho:
+            linha = self.entrada.readline()
+            if linha in (TERMINADOR_COPY, b''):
+                self.fim = True
+                break
+            partes.append(linha)
+            lidos += len(linha)
+        return b''.join(partes)
+
+def restaurar_backup(caminho, autor=None):
+    # Cada usuário do arquivo é restaurado em uma transação (inclusive o
+    # login): as tabelas são truncadas e recarregadas com COPY FREEZE, e as
+    # sequências são ajustadas.
+    # Usuários que não existem são recriados com a mesma senha. No registro de
+    # alterações fica uma linha por usuário com as linhas carregadas por tabela.
+    restaurados = []
+    with gzip.open(caminho, 'rb') as entrada:
+        if entrada.readline() != CABECALHO_BACKUP:
+            raise ValueError("Arquivo de backup inválido.")
+
+        linha = entrada.readline()
+        while linha:
+            usuario = json.loads(linha[1:])
+            username = usuario['usuario']
+            # O nome entra nos nomes das tabelas; não aceitar nada além de \w
+            if not re.fullmatch(r"\w+", username):
+                raise ValueError(f"Nome de usuário inválido no backup: {username!r}")
+
+            # Tabelas criadas (ou migradas) antes, em outra conexão: o TRUNCATE
+            # na mesma transação do COPY é o que permite o FREEZE
+            init_user_db(username)
+
+            # Login, tabelas e registro na mesma transação: um erro no arquivo
+            # (seção corrompida) sai daqui sem commit, o close() desfaz tudo e
+            # nem o login nem os dados do usuário são alterados
+            with get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(SQL_AUTOR + """
+                    INSERT INTO users (username, password, is_admin, is_active)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (username) DO NOTHING
+                """, (autor or '', username, usuario['senha'], usuario['is_admin'], usuario['is_active']))
+
+                linha = entrada.readline()
+                truncadas = False
+                carregadas = {}
+                while linha and 'tabela' in (secao := json.loads(linha[1:])):
+                    if secao['tabela'] not in TABELAS_BACKUP:
+                        raise ValueError(f"Tabela desconhecida no backup: {secao['tabela']!r}")
+                    if not truncadas:
+                        # Os gastos mensais são refeitos pelos triggers durante a carga
+                        cur.execute("SELECT set_config('app.auditoria', 'desligada', true); "
+                                    "TRUNCATE " + ", ".join(f"{t}_{username}" for t in TABELAS_BACKUP)
+                                    + f", gastos_mensais_{username}")
+                        truncadas = True
+                    colunas = ", ".join(c for c in secao['colunas'] if re.fullmatch(r"\w+", c))
+                    cur.copy_expert(f"COPY {secao['tabela']}_{username} ({colunas}) FROM STDIN WITH (FREEZE)",
+                                    SecaoCopy(entrada))
+                    carregadas[secao['tabela']] = cur.rowcount
+                    linha = entrada.readline()
+
+                if truncadas:
+                    # Próximo id depois do maior restaurado (movimentações arquivadas mantêm o id)
+                    cur.execute(f"""
+                        SELECT setval(pg_get_serial_sequence('categorias_{username}', 'id'),
+                                      (SELECT COALESCE(MAX(id), 0) + 1 FROM categorias_{username}), false),
+                               setval(pg_get_serial_sequence('parcelamentos_{username}', 'id'),
+                                      (SELECT COALESCE(MAX(id), 0) + 1 FROM parcelamentos_{username}), false),
+                               setval(pg_get_serial_sequence('movimentacoes_{username}', 'id'),
+                                      GREATEST((SELECT COALESCE(MAX(id), 0) FROM movimentacoes_{username}),
+                                               (SELECT COALESCE(MAX(id), 0) FROM movimentacoes_arquivo_{username})) + 1,
+                                      false)
+                    """)
+                    cur.execute("""
+                        INSERT INTO alteracoes (usuario, autor, tabela, operacao, depois)
+                        VALUES (%s, %s, 'backup', 'RESTAURAR', %s)
+                    """, (username, autor or username,
+                          json.dumps({'arquivo': os.path.basename(caminho), 'linhas': carregadas})))
+                    notificar_alteracao(cur, username)
+                conn.commit()
+            restaurados.append(username)
+
+    return restaurados
 
 # Funções para gerenciar categorias
 def get_categorias(username):
-    conn = get_connection()
-    query = f"SELECT id, nome, tipo FROM categorias_{username} ORDER BY nome"
-    categorias = pd.read_sql_query(query, conn)
-    conn.close()
+    with get_connection(somente_leitura=True, username=username) as conn:
+        query = f"SELECT id, nome, tipo FROM categorias_{username} ORDER BY nome"
+        categorias = ler_preparado(conn, query)
     return categorias
 
+def get_indice_categorias(username):
+    # Mapas id→nome, nome→id e tipo→ids, montados uma vez e mantidos em cache
+    def calcular():
+        categorias = get_categorias(username)
+        ids = categorias['id'].astype(int).tolist()
+        return {
+            'df': categorias,
+            'nomes': dict(zip(ids, categorias['nome'])),
+            'ids': dict(zip(categorias['nome'], ids)),
+            'tipos': dict(zip(ids, categorias['tipo'])),
+            'por_tipo': {tipo: [i for i, t in zip(ids, categorias['tipo']) if t == tipo]
+                         for tipo in ('entrada', 'saida')}
+        }
+    return em_cache(username, 'categorias', calcular)
+
 def add_categoria(username, nome, tipo):
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(f"INSERT INTO categorias_{username} (nome, tipo) VALUES (%s, %s)", (nome, tipo))
-        conn.commit()
-        success = True
-    except psycopg2.IntegrityError:
-        conn.rollback()
-        success = False
-    conn.close()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"INSERT INTO categorias_{username} (nome, tipo) VALUES (%s, %s)", (nome, tipo))
+            notificar_alteracao(cur, username)
+            conn.commit()
+            success = True
+        except psycopg2.IntegrityError:
+            conn.rollback()
+            success = False
     return success
 
 def update_categoria(username, id, nome, tipo):
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(f"UPDATE categorias_{username} SET nome = %s, tipo = %s WHERE id = %s", (nome, tipo, id))
-        conn.commit()
-        success = True
-    except psycopg2.IntegrityError:
-        conn.rollback()
-        success = False
-    conn.close()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"UPDATE categorias_{username} SET nome = %s, tipo = %s WHERE id = %s", (nome, tipo, id))
+            notificar_alteracao(cur, username)
+            conn.commit()
+            success = True
+        except psycopg2.IntegrityError:
+            conn.rollback()
+            success = False
     return success
 
 def delete_categoria(username, id):
-    conn = get_connection()
-    cur = conn.cursor()
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        # Verificar se existe movimentação ou parcelamento associado
+        cur.execute(f"""
+            SELECT EXISTS (SELECT 1 FROM movimentacoes_{username} WHERE categoria_id = %s)
+                OR EXISTS (SELECT 1 FROM parcelamentos_{username} WHERE categoria_id = %s)
+                OR EXISTS (SELECT 1 FROM resumo_mensal_{username} WHERE categoria_id = %s)
+        """, (id, id, id))
+        em_uso = cur.fetchone()[0]
+        
+        if em_uso:
+            success = False
+        else:
+            cur.execute(f"DELETE FROM categorias_{username} WHERE id = %s", (id,))
+            notificar_alteracao(cur, username)
+            conn.commit()
+            success = True
+    return success
+
+def merge_categorias(username, origem_ids, destino_id):
+    # Move todas as movimentações e parcelamentos das categorias de origem
+    # para a de destino e exclui as origens, em uma única instrução
+    origem_ids = [int(i) for i in origem_ids if int(i) != int(destino_id)]
+    if not origem_ids:
+        return False, 0
     
-    # Verificar se existe movimentação associada
-    cur.execute(f"SELECT COUNT(*) FROM movimentacoes_{username} WHERE categoria_id = %s", (id,))
-    count = cur.fetchone()[0]
+    # As categorias precisam ser do mesmo tipo da categoria de destino
+    tipos = get_indice_categorias(username)['tipos']
+    if any(tipos.get(i) != tipos.get(int(destino_id)) for i in origem_ids):
+        return False, 0
     
-    if count > 0:
-        success = False
-    else:
-        cur.execute(f"DELETE FROM categorias_{username} WHERE id = %s", (id,))
+    with get_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"""
+                WITH movidas AS (
+                    UPDATE movimentacoes_{username} SET categoria_id = %(destino)s
+                    WHERE categoria_id = ANY(%(origens)s)
+                    RETURNING 1
+                ), planos AS (
+                    UPDATE parcelamentos_{username} SET categoria_id = %(destino)s
+                    WHERE categoria_id = ANY(%(origens)s)
+                    RETURNING 1
+                ), arquivadas AS (
+                    UPDATE movimentacoes_arquivo_{username} SET categoria_id = %(destino)s
+                    WHERE categoria_id = ANY(%(origens)s)
+                    RETURNING 1
+                ), resumo AS (
+                    UPDATE resumo_mensal_{username} SET categoria_id = %(destino)s
+                    WHERE categoria_id = ANY(%(origens)s)
+                    RETURNING 1
+                ), excluidas AS (
+                    DELETE FROM categorias_{username}
+                    WHERE id = ANY(%(origens)s)
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM movidas) + (SELECT COUNT(*) FROM planos)
+                           + (SELECT COUNT(*) FROM arquivadas),
+                       (SELECT COUNT(*) FROM excluidas)
+            """, {'destino': int(destino_id), 'origens': origem_ids})
+            movidas, excluidas = cur.fetchone()
+            notificar_alteracao(cur, username)
+            conn.commit()
+            success = excluidas > 0
+        except psycopg2.IntegrityError:
+            conn.rollback()
+            success, movidas = False, 0
+    return success, movidas
+
+# Funções para gerenciar orçamentos
+def get_orcamentos(username, mes=None):
+    # Orçamento e gasto do mês por categoria de saída, lidos dos contadores
+    # mantidos pelos triggers: uma linha por categoria, sem somar o extrato
+    mes = (mes or datetime.date.today()).replace(day=1)
+    with get_connection(somente_leitura=True, username=username) as conn:
+        query = f"""
+        SELECT c.id, c.nome, o.valor_mensal AS orcamento, COALESCE(g.total, 0) AS gasto
+        FROM categorias_{username} c
+        LEFT JOIN orcamentos_{username} o ON o.categoria_id = c.id
+        LEFT JOIN gastos_mensais_{username} g ON g.categoria_id = c.id AND g.mes = %s
+        WHERE c.tipo = 'saida'
+        ORDER BY c.nome
+        """
+        orcamentos = ler_preparado(conn, query, [mes])
+    return orcamentos
+
+def salvar_orcamentos(username, valores):
+    # valores: {categoria_id: valor mensal}; valores vazios ou zero removem o orçamento
+    definidos = [(int(c), float(v)) for c, v in valores.items() if v and v > 0]
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM orcamentos_{username} WHERE categoria_id <> ALL(%s)",
+                    ([c for c, _ in definidos],))
+        cur.executemany(f"""
+            INSERT INTO orcamentos_{username} (categoria_id, valor_mensal) VALUES (%s, %s)
+            ON CONFLICT (categoria_id) DO UPDATE SET valor_mensal = EXCLUDED.valor_mensal
+        """, definidos)
+        notificar_alteracao(cur, username, 'orcamentos')
         conn.commit()
-        success = True
-    
-    conn.close()
-    return success
+    return len(definidos)
 
 # Funções para gerenciar movimentações
 def add_movimentacao(username, categoria_id, valor, data, tipo, descricao="", parcela=0, total_parcelas=0):
-    conn = get_connection()
-    cur = conn.cursor()
+    if total_parcelas > MAX_PARCELAS:
+        return False
     
-    # Se for uma movimentação parcelada
-    if total_parcelas > 1:
-        # Gerar um ID único para o grupo de parcelas
-        cur.execute(f"SELECT MAX(id_grupo_parcela) FROM movimentacoes_{username}")
-        max_id = cur.fetchone()[0]
-        id_grupo = 1 if max_id is None else max_id + 1
-        
-        data_obj = datetime.datetime.strptime(data, "%Y-%m-%d")
+    with get_connection() as conn:
+        cur = conn.cursor()
         
-        # Inserir cada parcela
-        for i in range(1, total_parcelas + 1):
-            parcela_data = data_obj + datetime.timedelta(days=(i-1)*30)  # Aproximadamente um mês entre parcelas
-            parcela_valor = valor / total_parcelas
+        # Se for uma movimentação parcelada, gravar apenas o plano;
+        # as parcelas são expandidas na leitura (ver sql_movimentacoes)
+        if total_parcelas > 1:
             cur.execute(f"""
-                INSERT INTO movimentacoes_{username} 
-                (categoria_id, valor, data, tipo, descricao, parcela, total_parcelas, id_grupo_parcela) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (categoria_id, parcela_valor, parcela_data.strftime("%Y-%m-%d"), 
-                      tipo, f"{descricao} ({i}/{total_parcelas})", i, total_parcelas, id_grupo))
+                INSERT INTO parcelamentos_{username}
+                (categoria_id, valor_total, data_inicio, tipo, descricao, total_parcelas)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """, (categoria_id, valor, data, tipo, descricao, total_parcelas))
+        else:
+            # Movimentação normal (não parcelada)
+            cur.execute(f"""
+                INSERT INTO movimentacoes_{username}
+                (categoria_id, valor, data, tipo, descricao) 
+                VALUES (%s, %s, %s, %s, %s)
+                """, (categoria_id, valor, data, tipo, descricao))
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return True
+
+def get_movimentacoes(username, data_inicio=None, data_fim=None, saldo_acumulado=False, limite=None, offset=0,
+                      via_copy=False):
+    colunas = """m.id, c.nome as categoria, m.valor, m.data, m.tipo, m.descricao, 
+           m.parcela, m.total_parcelas, m.id_grupo_parcela"""
+    params = []
+    filtro = ""
+    if data_inicio and data_fim:
+        filtro = " WHERE m.data BETWEEN %s AND %s"
+        params.extend([data_inicio, data_fim])
+    
+    # Anos arquivados só são lidos quando o período chega até eles
+    arquivo = alcanca_arquivo(username, data_inicio if data_fim else None)
+    fonte = sql_movimentacoes(username, arquivo)
+    
+    if saldo_acumulado:
+        # Saldo acumulado calculado no banco: saldo de abertura (tudo antes do
+        # período, em um único agregado) mais a soma móvel dentro do período.
+        # A janela é calculada antes do LIMIT, então cada página já vem correta.
+        # Fora do arquivo, os anos arquivados entram na abertura pelo resumo mensal
+        valores = f"SELECT tipo, valor, data FROM {fonte} v"
+        if not arquivo:
+            valores += f" UNION ALL SELECT tipo, total, mes FROM resumo_mensal_{username}"
+        query = f"""
+        WITH abertura AS (
+            SELECT COALESCE(SUM(CASE WHEN tipo = 'entrada' THEN valor ELSE -valor END), 0) AS saldo
+            FROM ({valores}) m
+            WHERE %s::date IS NOT NULL AND m.data < %s::date
+        )
+        SELECT {colunas},
+               a.saldo + SUM(CASE WHEN m.tipo = 'entrada' THEN m.valor ELSE -m.valor END)
+                   OVER (ORDER BY m.data, m.id ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS saldo_acumulado
+        FROM {fonte} m
+        JOIN categorias_{username} c ON m.categoria_id = c.id
+        CROSS JOIN abertura a
+        """ + filtro
+        inicio_abertura = data_inicio if data_inicio and data_fim else None
+        params = [inicio_abertura, inicio_abertura] + params
     else:
-        # Movimentação normal (não parcelada)
+        query = f"""
+        SELECT {colunas}
+        FROM {fonte} m
+        JOIN categorias_{username} c ON m.categoria_id = c.id
+        """ + filtro
+    
+    query += " ORDER BY m.data DESC, m.id DESC"
+    
+    if limite:
+        query += " LIMIT %s OFFSET %s"
+        params.extend([limite, offset])
+    
+    with get_connection(somente_leitura=True, username=username) as conn:
+        if via_copy:
+            # Períodos longos: leitura em massa via COPY, já com os tipos compactos
+            # nas colunas de texto
+            dados = ler_copy(conn, query, params,
+                             tipos={'categoria': 'category', 'tipo': 'category', 'descricao': object},
+                             datas=['data'])
+        else:
+            dados = ler_preparado(conn, query, params)
+    return compactar_movimentacoes(dados)
+
+def compactar_movimentacoes(movimentacoes):
+    # Tipos compactos: categorias repetidas viram category, datas viram
+    # datetime64 e os campos de parcela cabem em inteiros pequenos
+    if movimentacoes.empty:
+        movimentacoes['id'] = movimentacoes['id'].astype(int)
+        return movimentacoes
+    
+    return movimentacoes.fillna({'parcela': 0, 'total_parcelas': 0}).astype({
+        'id': 'int32',
+        'categoria': 'category',
+        'tipo': 'category',
+        'data': 'datetime64[ns]',
+        'parcela': 'int8',
+        'total_parcelas': 'int8',
+        'id_grupo_parcela': 'Int32'
+    })
+
+def uso_memoria(df):
+    # Memória ocupada pelo DataFrame, incluindo o conteúdo das strings
+    return int(df.memory_usage(deep=True).sum())
+
+def update_movimentacao(username, id, categoria_id, valor, data, tipo, descricao=""):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        parcela_virtual = decodificar_id_parcela(id)
+        if parcela_virtual:
+            # Parcela expandida de um plano: gravar a versão editada como linha
+            # própria e retirar a parcela do plano
+            id_plano, parcela = parcela_virtual
+            st.warning("Esta é uma movimentação parcelada. As alterações afetarão apenas esta parcela.")
+            cur.execute(f"""
+                UPDATE parcelamentos_{username}
+                SET parcelas_canceladas = array_append(parcelas_canceladas, %s)
+                WHERE id = %s
+                RETURNING total_parcelas
+            """, (parcela, id_plano))
+            result = cur.fetchone()
+            if result:
+                cur.execute(f"""
+                    INSERT INTO movimentacoes_{username}
+                    (categoria_id, valor, data, tipo, descricao, parcela, total_parcelas, id_grupo_parcela)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """, (categoria_id, valor, data, tipo, descricao, parcela, result[0], id_plano))
+            notificar_alteracao(cur, username, 'movimentacoes')
+            conn.commit()
+            return result is not None
+        
+        # Verificar se é parte de um grupo de parcelas
+        cur.execute(f"""
+            SELECT id_grupo_parcela, total_parcelas 
+            FROM movimentacoes_{username} 
+            WHERE id = %s
+        """, (id,))
+        result = cur.fetchone()
+        
+        if result and result[0] is not None and result[1] > 1:
+            # É uma parcela, perguntar se quer atualizar todas ou apenas esta
+            st.warning("Esta é uma movimentação parcelada. As alterações afetarão apenas esta parcela.")
+        
+        cur.execute(f"""
+            UPDATE movimentacoes_{username} 
+            SET categoria_id = %s, valor = %s, data = %s, tipo = %s, descricao = %s
+            WHERE id = %s
+        """, (categoria_id, valor, data, tipo, descricao, id))
+        # Movimentações de anos arquivados não estão mais nesta tabela
+        alterada = cur.rowcount > 0
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return alterada
+
+def update_grupo_parcelas(username, id_grupo, escopo, parcela=1, categoria_id=None,
+                          valor_total=None, tipo=None, descricao=None):
+    # Atualiza várias parcelas de um parcelamento em uma instrução.
+    # escopo: 'todas', 'restantes' (a partir de `parcela`) ou 'futuras' (após hoje).
+    # Quando nem todas as parcelas mudam, o plano é dividido: as parcelas
+    # alteradas passam para um novo plano com a mesma data inicial.
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            WITH plano AS (
+                SELECT p.id, p.total_parcelas,
+                       CASE %(escopo)s
+                           WHEN 'todas' THEN 1
+                           WHEN 'restantes' THEN %(parcela)s
+                           ELSE CASE WHEN CURRENT_DATE < p.data_inicio THEN 1
+                                     ELSE (CURRENT_DATE - p.data_inicio) / 30 + 2 END
+                       END AS inicio
+                FROM parcelamentos_{username} p
+                WHERE p.id = %(grupo)s
+            ), no_lugar AS (
+                UPDATE parcelamentos_{username} p
+                SET categoria_id = COALESCE(%(categoria_id)s, p.categoria_id),
+                    valor_total = COALESCE(%(valor_total)s::real, p.valor_total),
+                    tipo = COALESCE(%(tipo)s, p.tipo),
+                    descricao = COALESCE(%(descricao)s, p.descricao)
+                FROM plano pl
+                WHERE p.id = pl.id AND pl.inicio <= 1
+                RETURNING p.id
+            ), novo AS (
+                INSERT INTO parcelamentos_{username}
+                (categoria_id, valor_total, data_inicio, tipo, descricao, total_parcelas, parcelas_canceladas)
+                SELECT COALESCE(%(categoria_id)s, p.categoria_id), COALESCE(%(valor_total)s::real, p.valor_total),
+                       p.data_inicio, COALESCE(%(tipo)s, p.tipo), COALESCE(%(descricao)s, p.descricao),
+                       p.total_parcelas,
+                       ARRAY(SELECT i FROM generate_series(1, p.total_parcelas) AS i
+                             WHERE i < pl.inicio OR i = ANY(p.parcelas_canceladas))
+                FROM parcelamentos_{username} p
+                JOIN plano pl ON p.id = pl.id
+                WHERE pl.inicio > 1 AND pl.inicio <= p.total_parcelas
+                RETURNING id
+            ), antigo AS (
+                UPDATE parcelamentos_{username} p
+                SET parcelas_canceladas = p.parcelas_canceladas
+                    || ARRAY(SELECT generate_series(pl.inicio, p.total_parcelas))
+                FROM plano pl
+                WHERE p.id = pl.id AND pl.inicio > 1 AND pl.inicio <= p.total_parcelas
+                RETURNING p.id
+            ), sobrescritas AS (
+                UPDATE movimentacoes_{username} m
+                SET categoria_id = COALESCE(%(categoria_id)s, m.categoria_id),
+                    valor = COALESCE((%(valor_total)s::real / m.total_parcelas)::real, m.valor),
+                    tipo = COALESCE(%(tipo)s, m.tipo),
+                    descricao = COALESCE(%(descricao)s || ' (' || m.parcela || '/' || m.total_parcelas || ')',
+                                         m.descricao),
+                    id_grupo_parcela = COALESCE((SELECT id FROM novo), m.id_grupo_parcela)
+                FROM plano pl
+                WHERE m.id_grupo_parcela = pl.id AND m.parcela >= pl.inicio
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM no_lugar) + (SELECT COUNT(*) FROM novo)
+                 + (SELECT COUNT(*) FROM sobrescritas)
+        """, {'grupo': int(id_grupo), 'escopo': escopo, 'parcela': int(parcela),
+              'categoria_id': categoria_id, 'valor_total': valor_total,
+              'tipo': tipo, 'descricao': descricao})
+        alterados = cur.fetchone()[0]
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return alterados > 0
+
+def delete_movimentacao(username, id):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        
+        parcela_virtual = decodificar_id_parcela(id)
+        if parcela_virtual:
+            id_plano, parcela = parcela_virtual
+            result = (id_plano, 2)
+        else:
+            # Verificar se é parte de um grupo de parcelas
+            cur.execute(f"""
+                SELECT id_grupo_parcela, total_parcelas 
+                FROM movimentacoes_{username} 
+                WHERE id = %s
+            """, (id,))
+            result = cur.fetchone()
+        
+        if result and result[0] is not None and result[1] > 1:
+            # É uma parcela, perguntar se quer excluir todas ou apenas esta
+            if st.session_state.get('excluir_todas_parcelas', False):
+                cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id_grupo_parcela = %s", (result[0],))
+                cur.execute(f"DELETE FROM parcelamentos_{username} WHERE id = %s", (result[0],))
+            elif parcela_virtual:
+                cur.execute(f"""
+                    UPDATE parcelamentos_{username}
+                    SET parcelas_canceladas = array_append(parcelas_canceladas, %s)
+                    WHERE id = %s
+                """, (parcela, id_plano))
+            else:
+                cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id = %s", (id,))
+        else:
+            cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id = %s", (id,))
+        # Movimentações de anos arquivados não estão mais nesta tabela
+        excluida = cur.rowcount > 0
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return excluida
+
+def separar_ids(ids):
+    # Separa ids de linhas gravadas (positivos) e de parcelas virtuais (negativos)
+    ids = [int(i) for i in ids]
+    return [i for i in ids if i > 0], [i for i in ids if i < 0]
+
+def sql_cancelar_parcelas(username):
+    # Retira as parcelas virtuais informadas em %(virtuais)s dos seus planos
+    return f"""
+        UPDATE parcelamentos_{username} p
+        SET parcelas_canceladas = p.parcelas_canceladas || v.parcelas
+        FROM (
+            SELECT -id / 100 AS id_plano, array_agg(-id %% 100) AS parcelas
+            FROM unnest(%(virtuais)s::int[]) AS id
+            GROUP BY 1
+        ) v
+        WHERE p.id = v.id_plano
+        RETURNING cardinality(v.parcelas) AS total
+    """
+
+def bulk_update_movimentacoes(username, ids, categoria_id=None, data=None, tipo=None):
+    # Aplica categoria, data e/ou tipo a várias movimentações em uma instrução.
+    # Parcelas virtuais selecionadas passam a ser linhas próprias já alteradas.
+    fisicos, virtuais = separar_ids(ids)
+    if not fisicos and not virtuais:
+        return 0
+    
+    with get_connection() as conn:
+        cur = conn.cursor()
         cur.execute(f"""
-            INSERT INTO movimentacoes_{username}
-            (categoria_id, valor, data, tipo, descricao) 
-            VALUES (%s, %s, %s, %s, %s)
-            """, (categoria_id, valor, data, tipo, descricao))
+            WITH fisicas AS (
+                UPDATE movimentacoes_{username}
+                SET categoria_id = COALESCE(%(categoria_id)s, categoria_id),
+                    data = COALESCE(%(data)s::date, data),
+                    tipo = COALESCE(%(tipo)s, tipo)
+                WHERE id = ANY(%(fisicos)s)
+                RETURNING 1
+            ), materializadas AS (
+                INSERT INTO movimentacoes_{username}
+                (categoria_id, valor, data, tipo, descricao, parcela, total_parcelas, id_grupo_parcela)
+                SELECT COALESCE(%(categoria_id)s, v.categoria_id), v.valor,
+                       COALESCE(%(data)s::date, v.data), COALESCE(%(tipo)s, v.tipo),
+                       v.descricao, v.parcela, v.total_parcelas, v.id_grupo_parcela
+                FROM {sql_movimentacoes(username)} v
+                WHERE v.id = ANY(%(virtuais)s)
+                RETURNING 1
+            ), canceladas AS ({sql_cancelar_parcelas(username)})
+            SELECT (SELECT COUNT(*) FROM fisicas) + (SELECT COUNT(*) FROM materializadas)
+        """, {'categoria_id': categoria_id, 'data': data, 'tipo': tipo,
+              'fisicos': fisicos, 'virtuais': virtuais})
+        alteradas = cur.fetchone()[0]
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return alteradas
+
+def bulk_delete_movimentacoes(username, ids, grupos=()):
+    # Exclui várias movimentações (e, opcionalmente, grupos de parcelas inteiros)
+    # em uma instrução
+    fisicos, virtuais = separar_ids(ids)
+    grupos = [int(g) for g in grupos]
+    # Parcelas de planos que serão excluídos inteiros não precisam ser canceladas
+    virtuais = [i for i in virtuais if -i // 100 not in grupos]
+    if not fisicos and not virtuais and not grupos:
+        return 0
     
-    conn.commit()
-    conn.close()
-    return True
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            WITH fisicas AS (
+                DELETE FROM movimentacoes_{username}
+                WHERE id = ANY(%(fisicos)s) OR id_grupo_parcela = ANY(%(grupos)s)
+                RETURNING 1
+            ), planos AS (
+                DELETE FROM parcelamentos_{username}
+                WHERE id = ANY(%(grupos)s)
+                RETURNING 1
+            ), canceladas AS ({sql_cancelar_parcelas(username)})
+            SELECT (SELECT COUNT(*) FROM fisicas) + (SELECT COALESCE(SUM(total), 0) FROM canceladas)
+        """, {'fisicos': fisicos, 'virtuais': virtuais, 'grupos': grupos})
+        excluidas = cur.fetchone()[0]
+        
+        notificar_alteracao(cur, username, 'movimentacoes')
+        conn.commit()
+    return excluidas
 
-def get_movimentacoes(username, data_inicio=None, data_fim=None):
-    conn = get_connection()
+def buscar_movimentacoes(username, termo, data_inicio=None, data_fim=None, categoria_id=None,
+                         tipo=None, limite=50, offset=0):
+    # Busca parcial e aproximada na descrição, sem diferenciar acentos e maiúsculas.
+    # Usa o índice trigram criado em migracao_usuario_3.
+    termo_like = termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    params = {'termo': termo, 'padrao': f"%{termo_like}%", 'limite': limite, 'offset': offset}
+    
+    # Anos arquivados (sem índice trigram) só entram se o período chegar a eles
+    fonte = sql_movimentacoes(username, alcanca_arquivo(username, data_inicio if data_fim else None))
     
     query = f"""
-    SELECT m.id, c.nome as categoria, m.valor, m.data, m.tipo, m.descricao, 
-           m.parcela, m.total_parcelas, m.id_grupo_parcela
-    FROM movimentacoes_{username} m
+    SELECT m.id, c.nome as categoria, m.valor, m.data, m.tipo, m.descricao,
+           m.parcela, m.total_parcelas, m.id_grupo_parcela,
+           COUNT(*) OVER() AS total_resultados
+    FROM {fonte} m
     JOIN categorias_{username} c ON m.categoria_id = c.id
+    WHERE (f_unaccent(lower(m.descricao)) LIKE f_unaccent(lower(%(padrao)s))
+           OR f_unaccent(lower(%(termo)s)) <%% f_unaccent(lower(m.descricao)))
     """
     
-    params = []
     if data_inicio and data_fim:
-        query += " WHERE m.data BETWEEN %s AND %s"
-        params.extend([data_inicio, data_fim])
+        query += " AND m.data BETWEEN %(data_inicio)s AND %(data_fim)s"
+        params.update(data_inicio=data_inicio, data_fim=data_fim)
+    if categoria_id is not None:
+        query += " AND m.categoria_id = %(categoria_id)s"
+        params['categoria_id'] = int(categoria_id)
+    if tipo:
+        query += " AND m.tipo = %(tipo)s"
+        params['tipo'] = tipo
     
-    query += " ORDER BY m.data DESC"
+    query += """
+    ORDER BY word_similarity(f_unaccent(lower(%(termo)s)), f_unaccent(lower(m.descricao))) DESC,
+             m.data DESC, m.id DESC
+    LIMIT %(limite)s OFFSET %(offset)s
+    """
     
-    movimentacoes = pd.read_sql_query(query, conn, params=params)
-    movimentacoes['id'] = movimentacoes['id'].astype(int)
+    with get_connection(somente_leitura=True, username=username) as conn:
+        resultados = pd.read_sql_query(query, conn, params=params)
     
-    conn.close()
-    return movimentacoes
+    total = int(resultados['total_resultados'].iloc[0]) if not resultados.empty else 0
+    return resultados.drop(columns=['total_resultados']), total
 
-def update_movimentacao(username, id, categoria_id, valor, data, tipo, descricao=""):
-    conn = get_connection()
-    cur = conn.cursor()
+# Funções para análise e dashboard
+def get_dados_dashboard(username, data_inicio=None, data_fim=None):
+    # Se não especificado, usar mês atual
+    if not data_inicio or not data_fim:
+        hoje = datetime.date.today()
+        primeiro_dia = datetime.date(hoje.year, hoje.month, 1)
+        ultimo_dia = datetime.date(hoje.year, hoje.month, calendar.monthrange(hoje.year, hoje.month)[1])
+        data_inicio = primeiro_dia.strftime("%Y-%m-%d")
+        data_fim = ultimo_dia.strftime("%Y-%m-%d")
     
-    # Verificar se é parte de um grupo de parcelas
-    cur.execute(f"""
-        SELECT id_grupo_parcela, total_parcelas 
-        FROM movimentacoes_{username} 
-        WHERE id = %s
-    """, (id,))
-    result = cur.fetchone()
+    # Períodos que chegam aos anos arquivados também leem o arquivo
+    fonte = sql_movimentacoes(username, alcanca_arquivo(username, data_inicio))
+    
+    with get_connection(somente_leitura=True, username=username) as conn:
+        
+        # Total de entradas e saídas
+        query_totais = f"""
+        SELECT tipo, SUM(valor) as total
+        FROM {fonte} m
+        WHERE data BETWEEN %s AND %s
+        GROUP BY tipo
+        """
+        totais = ler_preparado(conn, query_totais, [data_inicio, data_fim])
+        
+        # Gastos por categoria
+        query_categorias = f"""
+        SELECT c.nome, SUM(m.valor) as total
+        FROM {fonte} m
+        JOIN categorias_{username} c ON m.categoria_id = c.id
+        WHERE m.tipo = 'saida' AND m.data BETWEEN %s AND %s
+        GROUP BY c.nome
+        ORDER BY total DESC
+        """
+        gastos_categoria = ler_preparado(conn, query_categorias, [data_inicio, data_fim])
+        
+        # Evolução diária
+        query_diaria = f"""
+        SELECT m.data, m.tipo, SUM(m.valor) as total
+        FROM {fonte} m
+        WHERE m.data BETWEEN %s AND %s
+        GROUP BY m.data, m.tipo
+        ORDER BY m.data
+        """
+        evolucao_diaria = ler_preparado(conn, query_diaria, [data_inicio, data_fim])
+        
+        # Gastos do dia atual
+        hoje = datetime.date.today().strftime("%Y-%m-%d")
+        query_hoje = f"""
+        SELECT c.nome, SUM(m.valor) as total
+        FROM {sql_movimentacoes(username)} m
+        JOIN categorias_{username} c ON m.categoria_id = c.id
+        WHERE m.tipo = 'saida' AND m.data = %s
+        GROUP BY c.nome
+        ORDER BY total DESC
+        """
+        gastos_hoje = ler_preparado(conn, query_hoje, [hoje])
+        
+        # Gastos do próximo mês
+        hoje = datetime.date.today()
+        proximo_mes = hoje.month + 1 if hoje.month < 12 else 1
+        proximo_ano = hoje.year if hoje.month < 12 else hoje.year + 1
+        primeiro_dia_prox = datetime.date(proximo_ano, proximo_mes, 1)
+        ultimo_dia_prox = datetime.date(proximo_ano, proximo_mes, 
+                                       calendar.monthrange(proximo_ano, proximo_mes)[1])
+        
+        query_prox_mes = f"""
+        SELECT tipo, SUM(valor) as total
+        FROM {sql_movimentacoes(username)} m
+        WHERE data BETWEEN %s AND %s
+        GROUP BY tipo
+        """
+        gastos_prox_mes = ler_preparado(conn, query_prox_mes, 
+                                        [primeiro_dia_prox.strftime("%Y-%m-%d"), 
+                                         ultimo_dia_prox.strftime("%Y-%m-%d")])
     
-    if result and result[0] is not None and result[1] > 1:
-        # É uma parcela, perguntar se quer atualizar todas ou apenas esta
-        st.warning("Esta é uma movimentação parcelada. As alterações afetarão apenas esta parcela.")
+    return {
+        'totais': totais,
+        'gastos_categoria': gastos_categoria,
+        'evolucao_diaria': evolucao_diaria,
+        'gastos_hoje': gastos_hoje,
+        'gastos_prox_mes': gastos_prox_mes,
+        'periodo': {'inicio': data_inicio, 'fim': data_fim}
+    }
+
+def get_dados_mes(username, ano, mes):
+    primeiro_dia = datetime.date(ano, mes, 1)
+    ultimo_dia = datetime.date(ano, mes, calendar.monthrange(ano, mes)[1])
     
-    cur.execute(f"""
-        UPDATE movimentacoes_{username} 
-        SET categoria_id = %s, valor = %s, data = %s, tipo = %s, descricao = %s
-        WHERE id = %s
-    """, (categoria_id, valor, data, tipo, descricao, id))
+    with get_connection(somente_leitura=True, username=username) as conn:
+        
+        # Total de entradas e saídas (meses arquivados vêm do resumo mensal)
+        query_totais = f"""
+        SELECT tipo, SUM(total) as total
+        FROM {sql_totais_mensais(username)} m
+        GROUP BY tipo
+        """
+        totais = ler_preparado(conn, query_totais,
+                               {'inicio': primeiro_dia, 'fim': ultimo_dia + datetime.timedelta(days=1)})
     
-    conn.commit()
-    conn.close()
-    return True
+    return totais
+
+def get_fluxo_mensal(username, ano):
+    # Entradas e saídas de cada mês do ano em uma consulta agrupada
+    # (meses arquivados vêm do resumo mensal)
+    with get_connection(somente_leitura=True, username=username) as conn:
+        
+        query = f"""
+        SELECT EXTRACT(MONTH FROM mes)::int AS mes, tipo, SUM(total) AS total
+        FROM {sql_totais_mensais(username)} m
+        GROUP BY 1, tipo
+        """
+        totais = ler_preparado(conn, query, {'inicio': datetime.date(ano, 1, 1), 'fim': datetime.date(ano + 1, 1, 1)})
+    
+    return totais
+
+def get_categorias_por_mes(username, ano, tipo='saida'):
+    # Matriz categoria x mês do ano escolhido e do ano anterior, em uma consulta.
+    # Retorna (atual, anterior), com as colunas do ano anterior já alinhadas
+    # aos meses do ano atual para a comparação ano a ano. São no máximo
+    # categorias x 24 linhas: instrução preparada, sem o custo fixo do COPY.
+    with get_connection(somente_leitura=True, username=username) as conn:
+        
+        query = f"""
+        SELECT c.nome, m.mes, SUM(m.total) AS total
+        FROM {sql_totais_mensais(username)} m
+        JOIN categorias_{username} c ON m.categoria_id = c.id
+        WHERE m.tipo = %(tipo)s
+        GROUP BY m.categoria_id, c.nome, m.mes
+        """
+        dados = ler_preparado(conn, query,
+                              {'tipo': tipo, 'inicio': datetime.date(ano - 1, 1, 1),
+                               'fim': datetime.date(ano + 1, 1, 1)})
+    dados['mes'] = pd.to_datetime(dados['mes'])
+    
+    meses = pd.date_range(datetime.date(ano, 1, 1), periods=12, freq='MS')
+    if dados.empty:
+        vazio = pd.DataFrame(columns=meses, dtype=float)
+        return vazio, vazio.copy()
+    
+    matriz = dados.pivot_table(index='nome', columns='mes', values='total', aggfunc='sum', fill_value=0)
+    
+    anterior = matriz.loc[:, matriz.columns.year == ano - 1].copy()
+    anterior.columns = anterior.columns + pd.DateOffset(years=1)
+    
+    atual = matriz.reindex(columns=meses, fill_value=0)
+    anterior = anterior.reindex(index=atual.index, columns=meses, fill_value=0)
+    return atual, anterior
+
+# Registro de alterações (ver migracao_global_4)
+TABELAS_ALTERACOES = {
+    'movimentacoes': 'Movimentações',
+    'parcelamentos': 'Parcelamentos',
+    'categorias': 'Categorias',
+    'orcamentos': 'Orçamentos',
+    'users': 'Conta',
+    'backup': 'Backup'
+}
+OPERACOES_ALTERACOES = {
+    'INSERT': 'Inclusão',
+    'UPDATE': 'Alteração',
+    'DELETE': 'Exclusão',
+    'ARQUIVAR': 'Arquivamento',
+    'RESTAURAR': 'Restauração'
+}
+
+def get_alteracoes(username, tabela=None, antes_de=None, limite=50):
+    # Página do registro, da alteração mais recente para a mais antiga.
+    # Paginação pelo id (antes_de = menor id da página anterior), que usa o
+    # índice (usuario, id) sem percorrer as páginas já vistas como o OFFSET.
+    with get_connection(somente_leitura=True, username=username) as conn:
+
+        query = "SELECT id, momento, autor, tabela, operacao, antes, depois FROM alteracoes WHERE usuario = %s"
+        params = [username]
+        if tabela:
+            query += " AND tabela = %s"
+            params.append(tabela)
+        if antes_de:
+            query += " AND id < %s"
+            params.append(antes_de)
+        query += " ORDER BY id DESC LIMIT %s"
+        params.append(limite)
+
+        alteracoes = ler_preparado(conn, query, params)
+    return alteracoes
+
+def descrever_alteracao(antes, depois):
+    # Inclusões e exclusões mostram a linha; alterações só os campos que mudaram
+    if antes and depois:
+        campos = [f"{campo}: {antes.get(campo)} → {valor}" for campo, valor in depois.items()
+                  if campo != 'senha_alterada' and antes.get(campo) != valor]
+        if depois.get('senha_alterada'):
+            campos.append("senha alterada")
+        return "; ".join(campos)
+    return "; ".join(f"{campo}: {valor}" for campo, valor in (antes or depois or {}).items())
+
+# Relatórios em segundo plano: a sessão só grava o pedido em tarefas e o envia
+# ao pool de processos. O relatório continua mesmo que a aba seja recarregada
+# e o arquivo gerado fica em DIRETORIO_TAREFAS para download por
+# TAREFAS_RETENCAO_DIAS dias. Com vários servidores atrás de um balanceador,
+# TAREFAS_DIR precisa ser um diretório compartilhado entre eles (ex.: NFS);
+# senão o download só aparece nas sessões do servidor que gerou o arquivo.
+DIRETORIO_TAREFAS = os.environ.get('TAREFAS_DIR', 'tarefas')
+TEMPO_LIMITE_TAREFA = int(os.environ.get('TAREFAS_TEMPO_LIMITE', '600'))
+RETENCAO_TAREFAS_DIAS = int(os.environ.get('TAREFAS_RETENCAO_DIAS', '7'))
+CHAVE_TAREFAS = 'app_financas_tarefas'
+LIMITE_TAREFAS_POR_USUARIO = 3
+STATUS_TAREFA = {
+    'pendente': 'Na fila',
+    'executando': 'Em execução',
+    'concluida': 'Concluída',
+    'falhou': 'Falhou',
+    'cancelada': 'Cancelada'
+}
+
+class ReferenciaPrincipal:
+    # Função deste arquivo enviada ao pool pelo nome. O pickle de uma função
+    # do script guarda __main__.nome e confere que é o mesmo objeto, mas o
+    # Streamlit troca sys.modules['__main__'] a cada rerun de qualquer sessão
+    # e a serialização acontece depois, numa thread do executor. No processo
+    # da tarefa o spawn carrega este arquivo como __main__ (ou o importa, fora
+    # do Streamlit) e o nome é resolvido lá.
+    def __init__(self, nome=None, modulo=__name__):
+        self.nome = nome
+        self.modulo = modulo
+    
+    def __reduce__(self):
+        if self.nome is None:
+            return (importlib.import_module, (self.modulo,))
+        return (getattr, (ReferenciaPrincipal(modulo=self.modulo), self.nome))
+
+def enviar_tarefa(executor, id_tarefa):
+    futuro = executor.submit(ReferenciaPrincipal('executar_tarefa'), id_tarefa)
+    futuro.add_done_callback(lambda futuro: registrar_falha_tarefa(id_tarefa, futuro))
+
+def registrar_falha_tarefa(id_tarefa, futuro):
+    # Executado numa thread do executor quando o processo da tarefa termina.
+    # Uma exceção aqui (erro ao serializar, processo morto) quer dizer que
+    # executar_tarefa não gravou o resultado; sem isso a tarefa ficaria na
+    # fila para sempre ocupando uma das vagas do usuário. Conexão própria:
+    # a thread não tem o contexto do Streamlit para usar o pool.
+    if futuro.cancelled() or futuro.exception() is None:
+        return
+    conn = conectar(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE tarefas SET status = 'falhou', mensagem = %s, pid = NULL, concluida_em = CURRENT_TIMESTAMP
+            WHERE id = %s AND status IN ('pendente', 'executando')
+        """, (f"Erro ao executar: {futuro.exception()}", id_tarefa))
+        conn.commit()
+    finally:
+        conn.close()
+
+@st.cache_resource
+def get_executor_tarefas():
+    # spawn: os processos não herdam conexões nem threads do servidor. Um
+    # processo novo por tarefa devolve ao sistema a memória do relatório.
+    # Sem initializer: as funções do script não podem ser serializadas por
+    # referência (ver ReferenciaPrincipal).
+    executor = ProcessPoolExecutor(max_workers=int(os.environ.get('TAREFAS_PROCESSOS', '2')),
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   max_tasks_per_child=1)
+
+    # Tarefas deixadas por um servidor anterior: as que estavam em execução em
+    # um processo do banco que não existe mais falharam; as da fila são
+    # reenviadas (executar_tarefa garante uma única execução de cada)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE tarefas SET status = 'falhou', mensagem = 'Interrompida.', concluida_em = CURRENT_TIMESTAMP
+            WHERE status = 'executando' AND pid NOT IN (SELECT pid FROM pg_stat_activity)
+        """)
+        cur.execute("SELECT id FROM tarefas WHERE status = 'pendente' ORDER BY id")
+        pendentes = [r[0] for r in cur.fetchall()]
+        conn.commit()
+    for id_tarefa in pendentes:
+        enviar_tarefa(executor, id_tarefa)
+    return executor
+
+def iniciar_tarefa(username, tipo, parametros):
+    # Retorna o id da tarefa, ou None se o usuário já tem
+    # LIMITE_TAREFAS_POR_USUARIO tarefas na fila ou em execução
+    with get_connection() as conn:
+        cur = conn.cursor()
+        # A trava por usuário (até o commit) impede que dois pedidos simultâneos
+        # contem as mesmas tarefas e passem juntos do limite
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))", (CHAVE_TAREFAS, username))
+        cur.execute("""
+            INSERT INTO tarefas (usuario, tipo, parametros)
+            SELECT %s, %s, %s
+            WHERE (SELECT COUNT(*) FROM tarefas
+                   WHERE usuario = %s AND status IN ('pendente', 'executando')) < %s
+            RETURNING id
+        """, (username, tipo, json.dumps(parametros), username, LIMITE_TAREFAS_POR_USUARIO))
+        result = cur.fetchone()
+        conn.commit()
+
+    if not result:
+        return None
+    try:
+        enviar_tarefa(get_executor_tarefas(), result[0])
+    except BrokenProcessPool:
+        # Um processo morreu de forma abrupta: o executor novo reenvia a fila
+        get_executor_tarefas.clear()
+        get_executor_tarefas()
+    return result[0]
+
+def executar_tarefa(id_tarefa):
+    # Executado nos processos do pool. A tarefa só começa se ainda estiver na
+    # fila e só é concluída se ainda estiver em execução: uma tarefa cancelada
+    # mantém o status e o arquivo parcial é apagado.
+    # O processo (novo a cada tarefa) usa uma única conexão, sempre com o
+    # primário: assim a consulta em andamento está no pid registrado na tarefa.
+    global pool_processo
+    pool_processo = psycopg2.pool.SimpleConnectionPool(1, 1, **parametros_conexao(os.environ['DATABASE_URL']))
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s", (TEMPO_LIMITE_TAREFA * 1000,))
+        cur.execute("""
+            UPDATE tarefas SET status = 'executando', pid = pg_backend_pid(), iniciada_em = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'pendente'
+            RETURNING usuario, tipo, parametros
+        """, (id_tarefa,))
+        tarefa = cur.fetchone()
+        conn.commit()
+    if not tarefa:
+        return
+
+    username, tipo, parametros = tarefa
+    os.makedirs(DIRETORIO_TAREFAS, exist_ok=True)
+    caminho = os.path.join(DIRETORIO_TAREFAS, f"{tipo}_{username}_{id_tarefa}.csv")
+    try:
+        mensagem = TIPOS_TAREFA[tipo][1](id_tarefa, username, parametros, caminho)
+        status = 'concluida'
+    except psycopg2.errors.QueryCanceled:
+        # O cancelamento pelo usuário também chega aqui, mas já mudou o status
+        mensagem = f"Tempo limite de {TEMPO_LIMITE_TAREFA} s excedido."
+        status = 'falhou'
+    except Exception as e:
+        mensagem = str(e)
+        status = 'falhou'
+
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE tarefas SET status = %s, mensagem = %s, arquivo = %s, pid = NULL,
+                               progresso = CASE WHEN %s = 'concluida' THEN 1 ELSE progresso END,
+                               concluida_em = CURRENT_TIMESTAMP
+            WHERE id = %s AND status = 'executando'
+        """, (status, mensagem, caminho if status == 'concluida' else None, status, id_tarefa))
+        finalizada = cur.rowcount > 0
+        conn.commit()
+
+    if (status != 'concluida' or not finalizada) and os.path.exists(caminho):
+        os.remove(caminho)
+    limpar_tarefas_antigas()
+
+    # O processo termina junto com a tarefa: os valores vão para o servidor somar
+    if metricas_processo is not None:
+        entregar_metricas_tarefa(metricas_processo)
+
+def limpar_tarefas_antigas():
+    # Retenção dos relatórios: feita no processo da tarefa, fora do caminho das
+    # páginas. O registro fica no histórico, só o arquivo expira. Arquivos sem
+    # tarefa (processo morto no meio da exportação) saem pela data de alteração.
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH expirados AS (
+                SELECT id, arquivo FROM tarefas
+                WHERE arquivo IS NOT NULL AND concluida_em < CURRENT_TIMESTAMP - make_interval(days => %s)
+                FOR UPDATE
+            )
+            UPDATE tarefas SET arquivo = NULL, mensagem = concat_ws(' ', tarefas.mensagem, 'Arquivo expirado.')
+            FROM expirados WHERE tarefas.id = expirados.id
+            RETURNING expirados.arquivo
+        """, (RETENCAO_TAREFAS_DIAS,))
+        expirados = [row[0] for row in cur.fetchall()]
+        conn.commit()
+
+    limite = time.time() - RETENCAO_TAREFAS_DIAS * 86400
+    for nome in os.listdir(DIRETORIO_TAREFAS):
+        caminho = os.path.join(DIRETORIO_TAREFAS, nome)
+        try:
+            if caminho in expirados or os.path.getmtime(caminho) < limite:
+                os.remove(caminho)
+        except OSError:
+            # Outro servidor com o mesmo diretório pode ter removido antes
+            pass
+
+def atualizar_tarefa(id_tarefa, progresso, mensagem):
+    # Chamado pelos relatórios entre uma etapa e outra; False quando a tarefa
+    # foi cancelada e o relatório deve parar
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE tarefas SET progresso = %s, mensagem = %s WHERE id = %s AND status = 'executando'",
+                    (progresso, mensagem, id_tarefa))
+        continuar = cur.rowcount > 0
+        conn.commit()
+    return continuar
+
+def cancelar_tarefa(username, id_tarefa):
+    # Na fila, a tarefa não chega a começar. Em execução, a consulta em
+    # andamento é interrompida e o relatório para na próxima etapa.
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE tarefas SET status = 'cancelada', concluida_em = CURRENT_TIMESTAMP
+            WHERE id = %s AND usuario = %s AND status IN ('pendente', 'executando')
+            RETURNING pid
+        """, (id_tarefa, username))
+        result = cur.fetchone()
+        # O status precisa estar gravado antes do sinal (ver executar_tarefa)
+        conn.commit()
+        if result and result[0]:
+            cur.execute("SELECT pg_cancel_backend(%s)", (result[0],))
+    return result is not None
+
+def get_tarefas(username, limite=10):
+    with get_connection() as conn:
+        tarefas = ler_preparado(conn, """
+            SELECT id, tipo, parametros, status, progresso, mensagem, arquivo, criada_em
+            FROM tarefas
+            WHERE usuario = %s
+            ORDER BY id DESC
+            LIMIT %s
+        """, [username, limite])
+    return tarefas
+
+def tarefa_exportar(id_tarefa, username, parametros, caminho):
+    # Exportação em blocos de um ano, na ordem de get_movimentacoes (mais
+    # recentes primeiro), gravados no CSV à medida que são lidos
+    data_inicio = datetime.date.fromisoformat(parametros['data_inicio'])
+    data_fim = datetime.date.fromisoformat(parametros['data_fim'])
+    anos = list(range(data_fim.year, data_inicio.year - 1, -1))
+
+    # Só um bloco fica em memória por vez: o maior deles é o pico da exportação
+    total = 0
+    maior_bloco = 0
+    with open(caminho, 'w', newline='', encoding='utf-8') as saida:
+        for i, ano in enumerate(anos):
+            bloco = get_movimentacoes(username,
+                                      max(data_inicio, datetime.date(ano, 1, 1)).strftime("%Y-%m-%d"),
+                                      min(data_fim, datetime.date(ano, 12, 31)).strftime("%Y-%m-%d"),
+                                      via_copy=True)
+            bloco.to_csv(saida, index=False, header=i == 0)
+            total += len(bloco)
+            memoria = uso_memoria(bloco)
+            maior_bloco = max(maior_bloco, memoria)
+            mensagem = f"{ano}: {len(bloco)} movimentação(ões), {memoria / 1024:,.1f} KB em memória."
+            if not atualizar_tarefa(id_tarefa, (i + 1) / len(anos),
+                                    mensagem.replace(',', 'X').replace('.', ',').replace('X', '.')):
+                return None
+    mensagem = f"{total} movimentação(ões) exportada(s); maior bloco com {maior_bloco / 1024:,.1f} KB em memória."
+    return mensagem.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+def tarefa_categorias(id_tarefa, username, parametros, caminho):
+    # Matriz categoria x mês de todo o histórico, incluindo os anos arquivados,
+    # em uma única consulta agrupada (uma linha por categoria e mês)
+    ano_atual = datetime.date.today().year
+    with get_connection() as conn:
+        dados = ler_preparado(conn, f"""
+            SELECT c.nome, m.mes, SUM(m.total) AS total
+            FROM {sql_totais_mensais(username)} m
+            JOIN categorias_{username} c ON m.categoria_id = c.id
+            WHERE m.tipo = %(tipo)s
+            GROUP BY m.categoria_id, c.nome, m.mes
+        """, {'tipo': parametros['tipo'], 'inicio': datetime.date.min, 'fim': datetime.date(ano_atual + 1, 1, 1)})
+    if not atualizar_tarefa(id_tarefa, 0.5, f"{len(dados)} total(is) mensal(is) lido(s)."):
+        return None
+
+    dados['mes'] = pd.to_datetime(dados['mes'])
+    primeiro_ano = dados['mes'].min().year if not dados.empty else ano_atual
+    anos = list(range(primeiro_ano, ano_atual + 1))
+    matriz = dados.pivot_table(index='nome', columns='mes', values='total', aggfunc='sum', fill_value=0).reindex(
+        columns=pd.date_range(datetime.date(primeiro_ano, 1, 1), periods=12 * len(anos), freq='MS'), fill_value=0)
+    matriz.columns = matriz.columns.strftime('%Y-%m')
+    matriz['total'] = matriz.sum(axis=1)
+    matriz.sort_values('total', ascending=False).round(2).to_csv(caminho, index_label='categoria')
+    return f"{len(matriz)} categoria(s) em {len(anos)} ano(s)."
+
+# Tipo da tarefa: (descrição, função que gera o arquivo)
+TIPOS_TAREFA = {
+    'exportar': ("Exportação de movimentações", tarefa_exportar),
+    'categorias': ("Análise de categorias (histórico completo)", tarefa_categorias)
+}
+
+# Perfil de execução sob demanda: o admin marca os próximos N reruns de um
+# usuário, que rodam sob cProfile e tracemalloc em qualquer processo que os
+# atenda. Cada captura guarda as funções mais caras, as linhas deste arquivo
+# que mais alocaram memória, o pstats completo e amostras da pilha no formato
+# "collapsed" usado pelos flame graphs (flamegraph.pl, speedscope).
+# O tracemalloc guarda QUADROS_TRACEMALLOC quadros por alocação e cada uma é
+# atribuída à linha deste arquivo mais próxima dela na pilha: o que pandas e
+# psycopg2 alocam conta para a linha do app que os chamou.
+LIMITE_FUNCOES_PERFIL = 40
+LIMITE_ALOCACOES_PERFIL = 20
+QUADROS_TRACEMALLOC = 25
+LIMITE_PERFIS_POR_USUARIO = 50
+INTERVALO_AMOSTRAS_PERFIL = 0.005
+
+@st.cache_resource
+def get_trava_perfil():
+    # O tracemalloc é global no processo: uma captura de memória por vez
+    return threading.Lock()
+
+def solicitar_perfil(username, reruns, autor):
+    # reruns=0 encerra a captura em andamento
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO capturas_perfil (usuario, restantes, solicitada_por) VALUES (%s, %s, %s)
+            ON CONFLICT (usuario) DO UPDATE SET restantes = EXCLUDED.restantes,
+                                                solicitada_por = EXCLUDED.solicitada_por,
+                                                solicitada_em = CURRENT_TIMESTAMP
+        """, (username, reruns, autor))
+        notificar_alteracao(cur, username, 'perfil')
+        conn.commit()
+
+def get_captura_perfil(username):
+    # Reruns que ainda serão capturados (0 sem captura ativa)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT restantes FROM capturas_perfil WHERE usuario = %s", (username,))
+        result = cur.fetchone()
+    return result[0] if result else 0
+
+def captura_pendente(username):
+    # Verificado em todo rerun, mas só vai ao banco quando a chave 'perfil'
+    # sai do cache (solicitar_perfil e fim da captura notificam os processos)
+    return em_cache(username, 'perfil', lambda: get_captura_perfil(username) > 0)
+
+def reservar_captura(username):
+    # Decremento atômico: sessões do mesmo usuário em vários processos não
+    # capturam mais reruns que o pedido
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE capturas_perfil SET restantes = restantes - 1
+            WHERE usuario = %s AND restantes > 0
+            RETURNING restantes
+        """, (username,))
+        result = cur.fetchone()
+        if not result or result[0] == 0:
+            notificar_alteracao(cur, username, 'perfil')
+        conn.commit()
+    return result is not None
+
+def amostrar_pilhas(id_thread, parar, pilhas):
+    # Pilha da thread do rerun a cada INTERVALO_AMOSTRAS_PERFIL, da raiz para
+    # a função em execução, com as funções separadas por ';'
+    while not parar.wait(INTERVALO_AMOSTRAS_PERFIL):
+        frame = sys._current_frames().get(id_thread)
+        quadros = []
+        while frame is not None:
+            codigo = frame.f_code
+            quadros.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+            frame = frame.f_back
+        if quadros:
+            pilha = ";".join(reversed(quadros))
+            pilhas[pilha] = pilhas.get(pilha, 0) + 1
 
-def delete_movimentacao(username, id):
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    # Verificar se é parte de um grupo de parcelas
-    cur.execute(f"""
-        SELECT id_grupo_parcela, total_parcelas 
-        FROM movimentacoes_{username} 
-        WHERE id = %s
-    """, (id,))
-    result = cur.fetchone()
-    
-    if result and result[0] is not None and result[1] > 1:
-        # É uma parcela, perguntar se quer excluir todas ou apenas esta
-        if st.session_state.get('excluir_todas_parcelas', False):
-            cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id_grupo_parcela = %s", (result[0],))
-        else:
-            cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id = %s", (id,))
-    else:
-        cur.execute(f"DELETE FROM movimentacoes_{username} WHERE id = %s", (id,))
-    
-    conn.commit()
-    conn.close()
-    return True
+def capturar_perfil(username, funcao):
+    perfil = cProfile.Profile()
+    trava = get_trava_perfil()
+    # Sem a trava (outra captura em andamento) o rerun é capturado sem memória
+    com_memoria = trava.acquire(blocking=False)
+    iniciou_tracemalloc = com_memoria and not tracemalloc.is_tracing()
+    if iniciou_tracemalloc:
+        tracemalloc.start(QUADROS_TRACEMALLOC)
 
-# Funções para análise e dashboard
-def get_dados_dashboard(username, data_inicio=None, data_fim=None):
-    # Se não especificado, usar mês atual
-    if not data_inicio or not data_fim:
-        hoje = datetime.date.today()
-        primeiro_dia = datetime.date(hoje.year, hoje.month, 1)
-        ultimo_dia = datetime.date(hoje.year, hoje.month, calendar.monthrange(hoje.year, hoje.month)[1])
-        data_inicio = primeiro_dia.strftime("%Y-%m-%d")
-        data_fim = ultimo_dia.strftime("%Y-%m-%d")
-    
-    conn = get_connection()
-    
-    # Total de entradas e saídas
-    query_totais = f"""
-    SELECT tipo, SUM(valor) as total
-    FROM movimentacoes_{username}
-    WHERE data BETWEEN %s AND %s
-    GROUP BY tipo
-    """
-    totais = pd.read_sql_query(query_totais, conn, params=[data_inicio, data_fim])
-    
-    # Gastos por categoria
-    query_categorias = f"""
-    SELECT c.nome, SUM(m.valor) as total
-    FROM movimentacoes_{username} m
-    JOIN categorias_{username} c ON m.categoria_id = c.id
-    WHERE m.tipo = 'saida' AND m.data BETWEEN %s AND %s
-    GROUP BY c.nome
-    ORDER BY total DESC
-    """
-    gastos_categoria = pd.read_sql_query(query_categorias, conn, params=[data_inicio, data_fim])
-    
-    # Evolução diária
-    query_diaria = f"""
-    SELECT m.data, m.tipo, SUM(m.valor) as total
-    FROM movimentacoes_{username} m
-    WHERE m.data BETWEEN %s AND %s
-    GROUP BY m.data, m.tipo
-    ORDER BY m.data
-    """
-    evolucao_diaria = pd.read_sql_query(query_diaria, conn, params=[data_inicio, data_fim])
-    
-    # Gastos do dia atual
-    hoje = datetime.date.today().strftime("%Y-%m-%d")
-    query_hoje = f"""
-    SELECT c.nome, SUM(m.valor) as total
-    FROM movimentacoes_{username} m
-    JOIN categorias_{username} c ON m.categoria_id = c.id
-    WHERE m.tipo = 'saida' AND m.data = %s
-    GROUP BY c.nome
-    ORDER BY total DESC
-    """
-    gastos_hoje = pd.read_sql_query(query_hoje, conn, params=[hoje])
-    
-    # Gastos do próximo mês
-    hoje = datetime.date.today()
-    proximo_mes = hoje.month + 1 if hoje.month < 12 else 1
-    proximo_ano = hoje.year if hoje.month < 12 else hoje.year + 1
-    primeiro_dia_prox = datetime.date(proximo_ano, proximo_mes, 1)
-    ultimo_dia_prox = datetime.date(proximo_ano, proximo_mes, 
-                                   calendar.monthrange(proximo_ano, proximo_mes)[1])
-    
-    query_prox_mes = f"""
-    SELECT tipo, SUM(valor) as total
-    FROM movimentacoes_{username}
-    WHERE data BETWEEN %s AND %s
-    GROUP BY tipo
-    """
-    gastos_prox_mes = pd.read_sql_query(query_prox_mes, conn, 
-                                       params=[primeiro_dia_prox.strftime("%Y-%m-%d"), 
-                                              ultimo_dia_prox.strftime("%Y-%m-%d")])
-    
-    conn.close()
-    
+    parar = threading.Event()
+    pilhas = {}
+    amostrador = threading.Thread(target=amostrar_pilhas, args=(threading.get_ident(), parar, pilhas), daemon=True)
+    amostrador.start()
+    inicio = time.perf_counter()
+    try:
+        # st.rerun e st.stop interrompem o script com exceções; a captura é
+        # gravada do mesmo jeito
+        perfil.runcall(funcao)
+    finally:
+        duracao = time.perf_counter() - inicio
+        parar.set()
+        amostrador.join()
+
+        alocacoes = []
+        memoria_pico = None
+        if com_memoria:
+            instantaneo = tracemalloc.take_snapshot()
+            memoria_pico = tracemalloc.get_traced_memory()[1]
+            if iniciou_tracemalloc:
+                tracemalloc.stop()
+            trava.release()
+            # Cada pilha vai para o quadro mais recente deste arquivo; as do
+            # próprio amostrador e as que não passam pelo app ficam de fora
+            linhas_amostrador = {linha for _, _, linha in amostrar_pilhas.__code__.co_lines() if linha}
+            por_linha = {}
+            for estatistica in instantaneo.statistics('traceback'):
+                quadro = next((q for q in reversed(estatistica.traceback) if q.filename == __file__), None)
+                if quadro is None or quadro.lineno in linhas_amostrador:
+                    continue
+                tamanho, blocos = por_linha.get(quadro.lineno, (0, 0))
+                por_linha[quadro.lineno] = (tamanho + estatistica.size, blocos + estatistica.count)
+            for linha, (tamanho, blocos) in sorted(por_linha.items(), key=lambda item: item[1][0],
+                                                   reverse=True)[:LIMITE_ALOCACOES_PERFIL]:
+                alocacoes.append({'linha': linha, 'codigo': linecache.getline(__file__, linha).strip(),
+                                  'tamanho': tamanho, 'blocos': blocos})
+
+        estatisticas = pstats.Stats(perfil)
+        mais_caras = sorted(estatisticas.stats.items(), key=lambda item: item[1][3], reverse=True)
+        funcoes = [{'funcao': f"{os.path.basename(arquivo)}:{linha}({nome})", 'chamadas': chamadas,
+                    'tempo_proprio': proprio, 'tempo_acumulado': acumulado}
+                   for (arquivo, linha, nome), (_, chamadas, proprio, acumulado, _)
+                   in mais_caras[:LIMITE_FUNCOES_PERFIL]]
+
+        salvar_perfil(username, st.session_state.get('menu'), duracao, memoria_pico, funcoes, alocacoes,
+                      marshal.dumps(estatisticas.stats),
+                      "".join(f"{pilha} {amostras}\n" for pilha, amostras in pilhas.items()))
+
+def salvar_perfil(username, pagina, duracao, memoria_pico, funcoes, alocacoes, estatisticas, pilhas):
+    # Mantém só as LIMITE_PERFIS_POR_USUARIO capturas mais recentes do usuário
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO perfis (usuario, pagina, duracao, memoria_pico, funcoes, alocacoes, estatisticas, pilhas)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (username, pagina, duracao, memoria_pico, json.dumps(funcoes), json.dumps(alocacoes),
+              psycopg2.Binary(estatisticas), pilhas))
+        cur.execute("""
+            DELETE FROM perfis
+            WHERE usuario = %s AND id <= (SELECT id FROM perfis WHERE usuario = %s
+                                          ORDER BY id DESC OFFSET %s LIMIT 1)
+        """, (username, username, LIMITE_PERFIS_POR_USUARIO))
+        conn.commit()
+
+def get_perfis(username):
+    with get_connection() as conn:
+        perfis = ler_preparado(conn, """
+            SELECT id, momento, pagina, duracao, memoria_pico
+            FROM perfis
+            WHERE usuario = %s
+            ORDER BY id DESC
+        """, [username])
+    return perfis
+
+def get_perfil(id_perfil):
+    # Sem o pstats e as pilhas, lidos só para download (get_arquivos_perfil)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT funcoes, alocacoes FROM perfis WHERE id = %s", (id_perfil,))
+        result = cur.fetchone()
+    if not result:
+        return None
+    funcoes, alocacoes = result
     return {
-        'totais': totais,
-        'gastos_categoria': gastos_categoria,
-        'evolucao_diaria': evolucao_diaria,
-        'gastos_hoje': gastos_hoje,
-        'gastos_prox_mes': gastos_prox_mes,
-        'periodo': {'inicio': data_inicio, 'fim': data_fim}
+        'funcoes': pd.DataFrame(funcoes),
+        'alocacoes': pd.DataFrame(alocacoes)
     }
 
-def get_dados_mes(username, ano, mes):
-    primeiro_dia = datetime.date(ano, mes, 1)
-    ultimo_dia = datetime.date(ano, mes, calendar.monthrange(ano, mes)[1])
-    
-    conn = get_connection()
-    
-    # Total de entradas e saídas
-    query_totais = f"""
-    SELECT tipo, SUM(valor) as total
-    FROM movimentacoes_{username}
-    WHERE data BETWEEN %s AND %s
-    GROUP BY tipo
-    """
-    totais = pd.read_sql_query(query_totais, conn, 
-                              params=[primeiro_dia.strftime("%Y-%m-%d"), 
-                                     ultimo_dia.strftime("%Y-%m-%d")])
-    
-    conn.close()
-    
-    return totais
+def get_arquivos_perfil(id_perfil):
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT estatisticas, pilhas FROM perfis WHERE id = %s", (id_perfil,))
+        result = cur.fetchone()
+    if not result:
+        return None
+    return bytes(result[0]), result[1]
+
+# Downloads de arquivos do servidor (backups, relatórios gerados e capturas de
+# perfil). O conteúdo só é lido para a memória depois do clique em "Preparar"
+# e sai da sessão ao baixar; acima de DOWNLOAD_MAX_MB é copiado direto do
+# servidor.
+LIMITE_DOWNLOAD_MB = int(os.environ.get('DOWNLOAD_MAX_MB', '200'))
+
+def download_preparado(rotulo, origem, chave):
+    # origem identifica o conteúdo (caminho do arquivo, captura de perfil)
+    if st.session_state.get('download_preparado') == origem:
+        return True
+    if st.button(f"Preparar {rotulo}", key=f"preparar_{chave}"):
+        st.session_state.download_preparado = origem
+        st.rerun()
+    return False
+
+def fim_download():
+    st.session_state.pop('download_preparado', None)
+
+def download_sob_demanda(rotulo, caminho, mime, chave):
+    tamanho = os.path.getsize(caminho)
+    if tamanho > LIMITE_DOWNLOAD_MB * 1024 * 1024:
+        st.caption(f"Arquivo com {tamanho / (1024 * 1024):,.0f} MB: copie direto do servidor ({caminho}).")
+        return
+    if not download_preparado(rotulo, caminho, chave):
+        return
+    with open(caminho, 'rb') as arquivo:
+        st.download_button(rotulo, data=arquivo.read(), file_name=os.path.basename(caminho), mime=mime, key=chave,
+                           on_click=fim_download)
+
+def executar_rerun():
+    # Reruns marcados pelo admin para o usuário logado rodam sob o perfil
+    username = st.session_state.get('username')
+    inicio = time.perf_counter()
+    try:
+        # Banco fora do ar (ou ainda sem migrações): roda sem perfil e main()
+        # mostra o erro de conexão
+        try:
+            capturar = bool(username) and captura_pendente(username) and reservar_captura(username)
+        except psycopg2.Error:
+            capturar = False
+        if capturar:
+            capturar_perfil(username, main)
+        else:
+            main()
+    finally:
+        pagina = st.session_state.get('menu') if st.session_state.get('logged_in') else 'Login'
+        observar_metrica('app_financas_rerun_segundos', time.perf_counter() - inicio, pagina=pagina or 'Login')
 
 # Interface do usuário com Streamlit
 def main():
-    # Inicializar banco de dados
+    # Aplicar migrações pendentes (uma vez por processo)
     try:
-        init_db()
+        preparar_banco()
+        iniciar_ouvinte_cache()
     except Exception as e:
         st.error(f"Erro ao conectar ao banco de dados: {e}")
         st.write("Verifique se as configurações do PostgreSQL estão corretas.")
@@ -546,7 +2981,7 @@ def main():
             if st.session_state.is_admin:
                 menu.append("Administração")
             
-            choice = st.sidebar.selectbox("Menu", menu)
+            choice = st.sidebar.selectbox("Menu", menu, key="menu")
             
             if st.button("Sair"):
                 st.session_state.logged_in = False
@@ -558,23 +2993,29 @@ def main():
         if choice == "Visão Geral":
             st.markdown("<h1 class='main-header'>Visão Geral</h1>", unsafe_allow_html=True)
             
-            # Filtro de período
-            col1, col2 = st.columns(2)
-            with col1:
-                data_inicio = st.date_input("Data Inicial", 
-                                          value=datetime.date.today().replace(day=1),
-                                          format="DD/MM/YYYY")
-            with col2:
-                ultimo_dia = calendar.monthrange(datetime.date.today().year, 
-                                              datetime.date.today().month)[1]
-                data_fim = st.date_input("Data Final", 
-                                       value=datetime.date.today().replace(day=ultimo_dia),
-                                       format="DD/MM/YYYY")
+            # Filtro de período em formulário: as datas só disparam o rerun ao aplicar
+            with st.form("filtro_visao_geral"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    data_inicio = st.date_input("Data Inicial", 
+                                              value=datetime.date.today().replace(day=1),
+                                              format="DD/MM/YYYY")
+                with col2:
+                    ultimo_dia = calendar.monthrange(datetime.date.today().year, 
+                                                  datetime.date.today().month)[1]
+                    data_fim = st.date_input("Data Final", 
+                                           value=datetime.date.today().replace(day=ultimo_dia),
+                                           format="DD/MM/YYYY")
+                st.form_submit_button("Aplicar")
             
-            # Obter dados para o dashboard
-            dados = get_dados_dashboard(st.session_state.username, 
-                                       data_inicio.strftime("%Y-%m-%d"),
-                                       data_fim.strftime("%Y-%m-%d"))
+            # Obter dados para o dashboard. Os resultados ficam no cache do
+            # usuário até a próxima alteração, então reruns de outros cards
+            # (ex.: a previsão) não repetem estas consultas. A data de hoje
+            # entra na chave por causa dos gastos de hoje e do próximo mês.
+            periodo = (data_inicio.strftime("%Y-%m-%d"), data_fim.strftime("%Y-%m-%d"))
+            dados = em_cache(st.session_state.username,
+                             ('movimentacoes', 'dashboard', datetime.date.today()) + periodo,
+                             lambda: get_dados_dashboard(st.session_state.username, *periodo))
             
             # Cards de resumo
             col1, col2, col3 = st.columns(3)
@@ -708,20 +3149,24 @@ def main():
                 
                 anos = list(range(hoje.year - 2, hoje.year + 3))
                 
-                col_mes, col_ano = st.columns(2)
-                with col_mes:
-                    mes_selecionado = st.selectbox("Mês", 
-                                                  options=list(meses.keys()),
-                                                  format_func=lambda x: meses[x],
-                                                  index=list(meses.keys()).index(proximo_mes))
-                
-                with col_ano:
-                    ano_selecionado = st.selectbox("Ano", 
-                                                  options=anos,
-                                                  index=anos.index(proximo_ano))
+                with st.form("previsao_form"):
+                    col_mes, col_ano = st.columns(2)
+                    with col_mes:
+                        mes_selecionado = st.selectbox("Mês", 
+                                                      options=list(meses.keys()),
+                                                      format_func=lambda x: meses[x],
+                                                      index=list(meses.keys()).index(proximo_mes))
+                    
+                    with col_ano:
+                        ano_selecionado = st.selectbox("Ano", 
+                                                      options=anos,
+                                                      index=anos.index(proximo_ano))
+                    st.form_submit_button("Ver Previsão")
                 
-                # Obter dados do mês selecionado
-                dados_mes = get_dados_mes(st.session_state.username, ano_selecionado, mes_selecionado)
+                # Obter dados do mês selecionado (única consulta nova ao trocar o mês)
+                dados_mes = em_cache(st.session_state.username,
+                                     ('movimentacoes', 'mes', ano_selecionado, mes_selecionado),
+                                     lambda: get_dados_mes(st.session_state.username, ano_selecionado, mes_selecionado))
                 
                 entrada_mes = dados_mes[dados_mes['tipo'] == 'entrada']['total'].sum() if not dados_mes.empty and 'entrada' in dados_mes['tipo'].values else 0
                 saida_mes = dados_mes[dados_mes['tipo'] == 'saida']['total'].sum() if not dados_mes.empty and 'saida' in dados_mes['tipo'].values else 0
@@ -739,30 +3184,50 @@ def main():
                 
                 st.markdown("</div>", unsafe_allow_html=True)
             
+            # Orçamentos do mês atual, lidos dos contadores por categoria
+            orcamentos = get_orcamentos(st.session_state.username)
+            orcamentos = orcamentos[orcamentos['orcamento'].notna()]
+            if not orcamentos.empty:
+                st.markdown("<div class='dashboard-card'>", unsafe_allow_html=True)
+                st.markdown("<div class='card-title'>Orçamentos do Mês</div>", unsafe_allow_html=True)
+                
+                for idx, row in orcamentos.iterrows():
+                    texto = f"{row['nome']}: R$ {row['gasto']:,.2f} de R$ {row['orcamento']:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+                    st.progress(min(max(row['gasto'] / row['orcamento'], 0.0), 1.0), text=texto)
+                    if row['gasto'] > row['orcamento']:
+                        excesso = f"R$ {row['gasto'] - row['orcamento']:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+                        st.warning(f"Orçamento de {row['nome']} estourado em {excesso}.")
+                
+                st.markdown("</div>", unsafe_allow_html=True)
+            
             # Tabela de movimentações recentes
             st.markdown("<div class='dashboard-card'>", unsafe_allow_html=True)
             st.markdown("<div class='card-title'>Movimentações Recentes</div>", unsafe_allow_html=True)
             
-            movimentacoes = get_movimentacoes(st.session_state.username, 
-                                            data_inicio.strftime("%Y-%m-%d"),
-                                            data_fim.strftime("%Y-%m-%d"))
+            # Cópia: as colunas formatadas abaixo não devem ir para o cache
+            movimentacoes = em_cache(st.session_state.username, ('movimentacoes', 'recentes') + periodo,
+                                     lambda: get_movimentacoes(st.session_state.username, *periodo,
+                                                               saldo_acumulado=True)).copy()
             
             if not movimentacoes.empty:
                 # Formatando valores e datas
                 movimentacoes['valor_formatado'] = movimentacoes['valor'].apply(
                     lambda x: f"R$ {x:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.'))
+                movimentacoes['saldo_formatado'] = movimentacoes['saldo_acumulado'].apply(
+                    lambda x: f"R$ {x:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.'))
                 
-                movimentacoes['data_formatada'] = pd.to_datetime(movimentacoes['data']).dt.strftime('%d/%m/%Y')
+                movimentacoes['data_formatada'] = movimentacoes['data'].dt.strftime('%d/%m/%Y')
                 
                 # Exibir tabela de movimentações
                 st.dataframe(
-                    movimentacoes[['id', 'data_formatada', 'categoria', 'descricao', 'valor_formatado', 'tipo']].rename(
+                    movimentacoes[['id', 'data_formatada', 'categoria', 'descricao', 'valor_formatado', 'tipo', 'saldo_formatado']].rename(
                         columns={
                             'data_formatada': 'Data',
                             'categoria': 'Categoria',
                             'descricao': 'Descrição',
                             'valor_formatado': 'Valor',
-                            'tipo': 'Tipo'
+                            'tipo': 'Tipo',
+                            'saldo_formatado': 'Saldo Acumulado'
                         }
                     ),
                     hide_index=True,
@@ -772,12 +3237,39 @@ def main():
                 st.info("Sem movimentações neste período.")
             
             st.markdown("</div>", unsafe_allow_html=True)
+            
+            # Evolução do saldo da conta no período
+            if not movimentacoes.empty:
+                st.markdown("<div class='dashboard-card'>", unsafe_allow_html=True)
+                st.markdown("<div class='card-title'>Saldo ao Longo do Tempo</div>", unsafe_allow_html=True)
+                
+                # A consulta vem em ordem decrescente; o primeiro registro de cada dia é o saldo final do dia
+                saldo_diario = movimentacoes.drop_duplicates('data', keep='first').sort_values('data')
+                
+                fig = go.Figure()
+                fig.add_trace(go.Scatter(
+                    x=saldo_diario['data'],
+                    y=saldo_diario['saldo_acumulado'],
+                    mode='lines+markers',
+                    name='Saldo',
+                    line=dict(color='#2196F3', width=2, shape='hv'),
+                    marker=dict(size=6)
+                ))
+                fig.update_layout(
+                    xaxis_title="Data",
+                    yaxis_title="Saldo (R$)",
+                    margin=dict(l=20, r=20, t=30, b=0)
+                )
+                st.plotly_chart(fig, use_container_width=True)
+                
+                st.markdown("</div>", unsafe_allow_html=True)
         
         elif choice == "Cadastro":
             st.markdown("<h1 class='main-header'>Cadastro de Categorias</h1>", unsafe_allow_html=True)
             
             # Obter todas as categorias
-            categorias = get_categorias(st.session_state.username)
+            indice_categorias = get_indice_categorias(st.session_state.username)
+            categorias = indice_categorias['df']
             
             # Formulário para adicionar nova categoria
             with st.expander("Adicionar Nova Categoria", expanded=False):
@@ -797,6 +3289,59 @@ def main():
                     else:
                         st.warning("Preencha o nome da categoria.")
             
+            # Mesclar categorias
+            with st.expander("Mesclar Categorias", expanded=False):
+                tipo_mesclar = st.selectbox("Tipo", ["entrada", "saida"], key="mesclar_tipo")
+                ids_tipo = indice_categorias['por_tipo'].get(tipo_mesclar, [])
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    destino_id = st.selectbox("Categoria de destino", options=ids_tipo,
+                                              format_func=indice_categorias['nomes'].get,
+                                              key="mesclar_destino")
+                with col2:
+                    origem_ids = st.multiselect("Categorias a mesclar",
+                                                options=[i for i in ids_tipo if i != destino_id],
+                                                format_func=indice_categorias['nomes'].get,
+                                                key="mesclar_origens")
+                
+                if st.button("Mesclar"):
+                    if destino_id is not None and origem_ids:
+                        success, movidas = merge_categorias(st.session_state.username, origem_ids, destino_id)
+                        if success:
+                            st.success(f"{len(origem_ids)} categoria(s) mesclada(s). {movidas} lançamento(s) movido(s).")
+                            st.rerun()
+                        else:
+                            st.error("Erro ao mesclar categorias.")
+                    else:
+                        st.warning("Selecione a categoria de destino e ao menos uma categoria a mesclar.")
+            
+            # Orçamento mensal por categoria de saída
+            with st.expander("Orçamentos Mensais", expanded=False):
+                orcamentos = get_orcamentos(st.session_state.username)
+                if not orcamentos.empty:
+                    orcamentos_editados = st.data_editor(
+                        orcamentos[['id', 'nome', 'orcamento']],
+                        column_config={
+                            'id': None,
+                            'nome': st.column_config.TextColumn("Categoria", disabled=True),
+                            'orcamento': st.column_config.NumberColumn("Orçamento Mensal (R$)", min_value=0.0,
+                                                                       step=10.0, format="%.2f")
+                        },
+                        hide_index=True,
+                        use_container_width=True,
+                        key="orcamentos_grade"
+                    )
+                    
+                    if st.button("Salvar Orçamentos"):
+                        valores = dict(zip(orcamentos_editados['id'],
+                                           orcamentos_editados['orcamento'].fillna(0)))
+                        definidos = salvar_orcamentos(st.session_state.username, valores)
+                        st.success(f"{definidos} orçamento(s) salvo(s).")
+                        st.rerun()
+                else:
+                    st.info("Cadastre categorias de saída para definir orçamentos.")
+            
             # Exibir categorias existentes
             st.subheader("Categorias Existentes")
             
@@ -872,8 +3417,8 @@ def main():
         elif choice == "Lançar Movimentação":
             st.markdown("<h1 class='main-header'>Lançar Movimentação</h1>", unsafe_allow_html=True)
             
-            # Obter todas as categorias
-            categorias = get_categorias(st.session_state.username)
+            # Obter o índice de categorias (em cache)
+            indice_categorias = get_indice_categorias(st.session_state.username)
             
             # Formulário para adicionar nova movimentação
             col1, col2 = st.columns(2)
@@ -882,12 +3427,12 @@ def main():
                 tipo = st.selectbox("Tipo de Movimentação", ["entrada", "saida"])
                 
                 # Filtrar categorias pelo tipo selecionado
-                categorias_filtradas = categorias[categorias['tipo'] == tipo]
+                ids_filtrados = indice_categorias['por_tipo'].get(tipo, [])
                 
-                if not categorias_filtradas.empty:
+                if ids_filtrados:
                     categoria_id = st.selectbox("Categoria", 
-                                             options=categorias_filtradas['id'].tolist(),
-                                             format_func=lambda x: categorias_filtradas[categorias_filtradas['id'] == x]['nome'].iloc[0])
+                                             options=ids_filtrados,
+                                             format_func=indice_categorias['nomes'].get)
                 else:
                     st.error(f"Não há categorias do tipo '{tipo}' cadastradas. Crie uma categoria primeiro.")
                     categoria_id = None
@@ -944,7 +3489,7 @@ def main():
                 movimentacoes['valor_formatado'] = movimentacoes['valor'].apply(
                     lambda x: f"R$ {x:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.'))
                 
-                movimentacoes['data_formatada'] = pd.to_datetime(movimentacoes['data']).dt.strftime('%d/%m/%Y')
+                movimentacoes['data_formatada'] = movimentacoes['data'].dt.strftime('%d/%m/%Y')
                 
                 # Adicionar colunas de ação
                 movimentacoes_exibir = movimentacoes[['id', 'data_formatada', 'categoria', 'descricao', 'valor_formatado', 'tipo']].copy()
@@ -958,23 +3503,105 @@ def main():
                     }, inplace=True
                 )
                 
-                # Exibir tabela
-                st.dataframe(movimentacoes_exibir, hide_index=True, use_container_width=True)
+                # Exibir tabela com seleção de linhas para ações em lote
+                movimentacoes_exibir.insert(0, 'Selecionar', False)
+                versao_grade = st.session_state.get('mov_grade_versao', 0)
+                grade = st.data_editor(movimentacoes_exibir, hide_index=True, use_container_width=True,
+                                       disabled=[c for c in movimentacoes_exibir.columns if c != 'Selecionar'],
+                                       key=f"mov_grade_{versao_grade}")
+                selecionados = grade.loc[grade['Selecionar'], 'id'].tolist()
+                
+                if selecionados:
+                    st.markdown(f"**{len(selecionados)} movimentação(ões) selecionada(s)**")
+                    movs_selecionadas = movimentacoes[movimentacoes['id'].isin(selecionados)]
+                    
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        acao_lote = st.selectbox("Ação em lote", 
+                                                 ["Alterar categoria", "Alterar data", "Alterar tipo", "Excluir"],
+                                                 key="acao_lote")
+                    
+                    alteracoes = None
+                    with col2:
+                        if acao_lote == "Alterar categoria":
+                            tipos_selecionados = movs_selecionadas['tipo'].unique()
+                            if len(tipos_selecionados) == 1:
+                                nova_categoria = st.selectbox("Nova categoria",
+                                                              options=indice_categorias['por_tipo'].get(tipos_selecionados[0], []),
+                                                              format_func=indice_categorias['nomes'].get,
+                                                              key="lote_categoria")
+                                if nova_categoria is not None:
+                                    alteracoes = {'categoria_id': nova_categoria}
+                            else:
+                                st.warning("Selecione movimentações de um único tipo para alterar a categoria.")
+                        
+                        elif acao_lote == "Alterar data":
+                            nova_data = st.date_input("Nova data", value=datetime.date.today(),
+                                                      format="DD/MM/YYYY", key="lote_data")
+                            alteracoes = {'data': nova_data.strftime("%Y-%m-%d")}
+                        
+                        elif acao_lote == "Alterar tipo":
+                            # O tipo muda junto com a categoria para manter os dois consistentes
+                            novo_tipo = st.selectbox("Novo tipo", ["entrada", "saida"], key="lote_tipo")
+                            nova_categoria = st.selectbox("Categoria",
+                                                          options=indice_categorias['por_tipo'].get(novo_tipo, []),
+                                                          format_func=indice_categorias['nomes'].get,
+                                                          key="lote_tipo_categoria")
+                            if nova_categoria is not None:
+                                alteracoes = {'tipo': novo_tipo, 'categoria_id': nova_categoria}
+                        
+                        else:
+                            grupos_selecionados = movs_selecionadas['id_grupo_parcela'].dropna().astype(int).unique().tolist()
+                            excluir_grupos = False
+                            if grupos_selecionados:
+                                excluir_grupos = st.checkbox("Excluir também as demais parcelas dos parcelamentos selecionados?",
+                                                             key="lote_excluir_grupos")
+                    
+                    if st.button("Aplicar às selecionadas"):
+                        if acao_lote == "Excluir" or alteracoes:
+                            if acao_lote == "Excluir":
+                                total = bulk_delete_movimentacoes(st.session_state.username, selecionados,
+                                                                  grupos_selecionados if excluir_grupos else ())
+                                st.success(f"{total} movimentação(ões) excluída(s).")
+                            else:
+                                total = bulk_update_movimentacoes(st.session_state.username, selecionados, **alteracoes)
+                                st.success(f"{total} movimentação(ões) atualizada(s).")
+                            
+                            # Nova chave limpa a seleção da grade
+                            st.session_state.mov_grade_versao = versao_grade + 1
+                            st.rerun()
+                        else:
+                            st.warning("Preencha todos os campos corretamente.")
                 
                 # Ações de edição
                 col1, col2 = st.columns(2)
                 with col1:
-                    mov_id_edit = st.number_input("ID para Editar/Excluir", min_value=1, step=1)
+                    # Parcelas de planos de parcelamento possuem id negativo
+                    mov_id_edit = st.number_input("ID para Editar/Excluir", value=0, step=1)
                 
                 with col2:
                     acao = st.selectbox("Ação", ["Selecione uma ação", "Editar", "Excluir"])
                 
-                if acao == "Editar" and mov_id_edit > 0:
+                if acao == "Editar" and mov_id_edit != 0:
                     if mov_id_edit in movimentacoes['id'].values:
                         mov = movimentacoes[movimentacoes['id'] == mov_id_edit].iloc[0]
                         
                         st.subheader(f"Editar Movimentação #{mov_id_edit}")
                         
+                        # Parcelas podem ser alteradas em conjunto com o restante do parcelamento
+                        escopos_parcela = {
+                            "Somente esta parcela": None,
+                            "Esta e as seguintes": 'restantes',
+                            "Parcelas futuras": 'futuras',
+                            "Todas as parcelas": 'todas'
+                        }
+                        escopo_edit = None
+                        if pd.notna(mov['id_grupo_parcela']) and mov['total_parcelas'] > 1:
+                            escopo_edit = escopos_parcela[st.radio("Aplicar alterações a",
+                                                                   list(escopos_parcela.keys()),
+                                                                   horizontal=True,
+                                                                   key=f"edit_escopo_{mov_id_edit}")]
+                        
                         col1, col2 = st.columns(2)
                         
                         with col1:
@@ -983,44 +3610,65 @@ def main():
                                                   key=f"edit_tipo_{mov_id_edit}")
                             
                             # Filtrar categorias pelo tipo selecionado
-                            categorias_filtradas = categorias[categorias['tipo'] == tipo_edit]
+                            ids_filtrados = indice_categorias['por_tipo'].get(tipo_edit, [])
                             
-                            if not categorias_filtradas.empty:
+                            if ids_filtrados:
                                 # Encontrar o ID da categoria atual
-                                cat_atual_id = categorias[categorias['nome'] == mov['categoria']]['id'].iloc[0] if mov['categoria'] in categorias['nome'].values else categorias_filtradas['id'].iloc[0]
+                                cat_atual_id = indice_categorias['ids'].get(mov['categoria'])
                                 
                                 categoria_id_edit = st.selectbox("Categoria", 
-                                                            options=categorias_filtradas['id'].tolist(),
-                                                            index=list(categorias_filtradas['id']).index(cat_atual_id) if cat_atual_id in categorias_filtradas['id'].values else 0,
-                                                            format_func=lambda x: categorias_filtradas[categorias_filtradas['id'] == x]['nome'].iloc[0],
+                                                            options=ids_filtrados,
+                                                            index=ids_filtrados.index(cat_atual_id) if cat_atual_id in ids_filtrados else 0,
+                                                            format_func=indice_categorias['nomes'].get,
                                                             key=f"edit_cat_{mov_id_edit}")
                             else:
                                 st.error(f"Não há categorias do tipo '{tipo_edit}' cadastradas.")
                                 categoria_id_edit = None
                             
-                            valor_edit = st.number_input("Valor", 
-                                                      min_value=0.01, 
-                                                      value=float(mov['valor']),
-                                                      step=0.01,
-                                                      key=f"edit_valor_{mov_id_edit}")
-                            
-                            data_edit = st.date_input("Data", 
-                                                    value=pd.to_datetime(mov['data']).date(),
-                                                    format="DD/MM/YYYY",
-                                                    key=f"edit_data_{mov_id_edit}")
+                            if escopo_edit:
+                                # O valor de cada parcela é recalculado a partir do total
+                                valor_edit = st.number_input("Valor Total do Parcelamento", 
+                                                          min_value=0.01, 
+                                                          value=float(mov['valor']) * int(mov['total_parcelas']),
+                                                          step=0.01,
+                                                          key=f"edit_valor_total_{mov_id_edit}")
+                            else:
+                                valor_edit = st.number_input("Valor", 
+                                                          min_value=0.01, 
+                                                          value=float(mov['valor']),
+                                                          step=0.01,
+                                                          key=f"edit_valor_{mov_id_edit}")
+                                
+                                data_edit = st.date_input("Data", 
+                                                        value=pd.to_datetime(mov['data']).date(),
+                                                        format="DD/MM/YYYY",
+                                                        key=f"edit_data_{mov_id_edit}")
                         
                         with col2:
+                            descricao_atual = mov['descricao'] if pd.notna(mov['descricao']) else ""
+                            if escopo_edit:
+                                # O sufixo "(parcela/total)" é gerado para cada parcela
+                                descricao_atual = re.sub(r" \(\d+/\d+\)$", "", descricao_atual)
                             descricao_edit = st.text_area("Descrição", 
-                                                       value=mov['descricao'] if pd.notna(mov['descricao']) else "",
+                                                       value=descricao_atual,
                                                        height=100,
-                                                       key=f"edit_desc_{mov_id_edit}")
+                                                       key=f"edit_desc_{mov_id_edit}_{escopo_edit is not None}")
                             
                             if st.button("Salvar Alterações"):
                                 if categoria_id_edit is not None and valor_edit > 0:
-                                    if update_movimentacao(st.session_state.username, mov_id_edit, 
-                                                         categoria_id_edit, valor_edit, 
-                                                         data_edit.strftime("%Y-%m-%d"), 
-                                                         tipo_edit, descricao_edit):
+                                    if escopo_edit:
+                                        atualizado = update_grupo_parcelas(st.session_state.username, 
+                                                                           mov['id_grupo_parcela'], escopo_edit,
+                                                                           parcela=mov['parcela'],
+                                                                           categoria_id=categoria_id_edit,
+                                                                           valor_total=valor_edit,
+                                                                           tipo=tipo_edit, descricao=descricao_edit)
+                                    else:
+                                        atualizado = update_movimentacao(st.session_state.username, mov_id_edit, 
+                                                                         categoria_id_edit, valor_edit, 
+                                                                         data_edit.strftime("%Y-%m-%d"), 
+                                                                         tipo_edit, descricao_edit)
+                                    if atualizado:
                                         st.success("Movimentação atualizada com sucesso!")
                                         st.rerun()
                                     else:
@@ -1030,7 +3678,7 @@ def main():
                     else:
                         st.error("ID de movimentação não encontrado.")
                 
-                elif acao == "Excluir" and mov_id_edit > 0:
+                elif acao == "Excluir" and mov_id_edit != 0:
                     if mov_id_edit in movimentacoes['id'].values:
                         mov = movimentacoes[movimentacoes['id'] == mov_id_edit].iloc[0]
                         
@@ -1060,7 +3708,8 @@ def main():
             st.markdown("<h1 class='main-header'>Relatórios e Auditoria</h1>", unsafe_allow_html=True)
             
             # Abas para diferentes relatórios
-            tab1, tab2, tab3 = st.tabs(["Fluxo Mensal", "Análise de Categorias", "Exportar Dados"])
+            tab1, tab2, tab3, tab4, tab5 = st.tabs(["Fluxo Mensal", "Análise de Categorias", "Exportar Dados", "Buscar",
+                                                    "Alterações"])
             
             with tab1:
                 st.subheader("Fluxo de Caixa Mensal")
@@ -1076,20 +3725,14 @@ def main():
                         mes = st.selectbox("Mês", options=list(range(1, 13)), 
                                          format_func=lambda x: calendar.month_name[x])
                 
-                # Obter dados para cada mês
+                # Totais de todos os meses do ano em uma consulta
+                fluxo = get_fluxo_mensal(st.session_state.username, ano)
                 dados_meses = {}
                 meses_para_analisar = list(range(1, 13)) if todos_meses else [mes]
                 
                 for m in meses_para_analisar:
-                    primeiro_dia = datetime.date(ano, m, 1)
-                    ultimo_dia = datetime.date(ano, m, calendar.monthrange(ano, m)[1])
-                    
-                    dados = get_dados_dashboard(st.session_state.username, 
-                                              primeiro_dia.strftime("%Y-%m-%d"),
-                                              ultimo_dia.strftime("%Y-%m-%d"))
-                    
-                    entrada = dados['totais'][dados['totais']['tipo'] == 'entrada']['total'].sum() if not dados['totais'].empty and 'entrada' in dados['totais']['tipo'].values else 0
-                    saida = dados['totais'][dados['totais']['tipo'] == 'saida']['total'].sum() if not dados['totais'].empty and 'saida' in dados['totais']['tipo'].values else 0
+                    entrada = fluxo[(fluxo['mes'] == m) & (fluxo['tipo'] == 'entrada')]['total'].sum() if not fluxo.empty else 0
+                    saida = fluxo[(fluxo['mes'] == m) & (fluxo['tipo'] == 'saida')]['total'].sum() if not fluxo.empty else 0
                     saldo = entrada - saida
                     
                     dados_meses[m] = {
@@ -1228,6 +3871,62 @@ def main():
                     ), hide_index=True, use_container_width=True)
                 else:
                     st.info("Nenhum gasto registrado no período selecionado.")
+                
+                # Mapa de calor categoria x mês e comparação com o ano anterior
+                st.subheader("Gastos por Categoria e Mês")
+                ano_mapa = st.selectbox("Ano", options=list(range(datetime.date.today().year, datetime.date.today().year - 5, -1)),
+                                        key="cat_mapa_ano")
+                atual, anterior = get_categorias_por_mes(st.session_state.username, ano_mapa)
+                
+                if not atual.empty and atual.values.sum() > 0:
+                    nomes_meses = ["Jan", "Fev", "Mar", "Abr", "Mai", "Jun", "Jul", "Ago", "Set", "Out", "Nov", "Dez"]
+                    fig = px.imshow(
+                        atual.values,
+                        x=nomes_meses,
+                        y=atual.index.tolist(),
+                        labels={'x': 'Mês', 'y': 'Categoria', 'color': 'Valor (R$)'},
+                        color_continuous_scale='Reds',
+                        aspect='auto'
+                    )
+                    fig.update_layout(height=max(300, 40 * len(atual.index)))
+                    st.plotly_chart(fig, use_container_width=True)
+                    
+                    # Comparação ano a ano (mesmos meses)
+                    st.subheader(f"Comparação {ano_mapa} x {ano_mapa - 1}")
+                    comparacao = pd.DataFrame({
+                        'atual': atual.sum(axis=1),
+                        'anterior': anterior.sum(axis=1)
+                    })
+                    comparacao['variacao'] = comparacao['atual'] - comparacao['anterior']
+                    comparacao['percentual'] = (comparacao['variacao'] / comparacao['anterior'].where(comparacao['anterior'] != 0)) * 100
+                    comparacao = comparacao.sort_values('variacao', ascending=False)
+                    
+                    df_exibir = comparacao.copy()
+                    for coluna in ['atual', 'anterior', 'variacao']:
+                        df_exibir[coluna] = df_exibir[coluna].apply(lambda x: f"R$ {x:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.'))
+                    df_exibir['percentual'] = df_exibir['percentual'].apply(lambda x: f"{x:+.2f}%".replace('.', ',') if pd.notna(x) else "-")
+                    
+                    st.dataframe(df_exibir.reset_index().rename(
+                        columns={
+                            'nome': 'Categoria',
+                            'atual': str(ano_mapa),
+                            'anterior': str(ano_mapa - 1),
+                            'variacao': 'Variação',
+                            'percentual': 'Variação (%)'
+                        }
+                    ), hide_index=True, use_container_width=True)
+                else:
+                    st.info(f"Nenhum gasto registrado em {ano_mapa}.")
+                
+                # Todos os anos de uma vez podem demorar: gerado em segundo plano
+                st.subheader("Histórico Completo")
+                st.caption("Gera um CSV com os gastos por categoria e mês de todos os anos. "
+                           "Acompanhe o andamento e baixe o arquivo na aba Exportar Dados.")
+                if st.button("Gerar Análise Completa", key="tarefa_categorias"):
+                    if iniciar_tarefa(st.session_state.username, 'categorias', {'tipo': 'saida'}):
+                        st.success("Análise adicionada à fila.")
+                    else:
+                        st.error(f"Você já tem {LIMITE_TAREFAS_POR_USUARIO} relatórios em andamento.")
             
             with tab3:
                 st.subheader("Exportar Dados")
@@ -1245,26 +3944,176 @@ def main():
                                            format="DD/MM/YYYY",
                                            key="exp_data_fim")
                 
-                # Obter movimentações
-                movimentacoes = get_movimentacoes(st.session_state.username, 
-                                                data_inicio.strftime("%Y-%m-%d"),
-                                                data_fim.strftime("%Y-%m-%d"))
+                # A exportação roda em segundo plano (ver executar_tarefa)
+                if st.button("Gerar Exportação", key="tarefa_exportar"):
+                    if data_inicio > data_fim:
+                        st.error("A data inicial deve ser anterior à data final.")
+                    elif iniciar_tarefa(st.session_state.username, 'exportar',
+                                        {'data_inicio': data_inicio.strftime("%Y-%m-%d"),
+                                         'data_fim': data_fim.strftime("%Y-%m-%d")}):
+                        st.success("Exportação adicionada à fila.")
+                    else:
+                        st.error(f"Você já tem {LIMITE_TAREFAS_POR_USUARIO} relatórios em andamento.")
+                
+                st.subheader("Relatórios Gerados")
+                tarefas = get_tarefas(st.session_state.username)
                 
-                if not movimentacoes.empty:
-                    # Converter para CSV
-                    csv = movimentacoes.to_csv(index=False).encode('utf-8')
+                if not tarefas.empty:
+                    st.button("Atualizar", key="tarefas_atualizar")
                     
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv,
-                        file_name=f"financas_{st.session_state.username}_{data_inicio.strftime('%Y%m%d')}_{data_fim.strftime('%Y%m%d')}.csv",
-                        mime="text/csv",
-                    )
+                    for tarefa in tarefas.itertuples():
+                        descricao = TIPOS_TAREFA.get(tarefa.tipo, (tarefa.tipo,))[0]
+                        if tarefa.tipo == 'exportar':
+                            periodo_tarefa = [datetime.date.fromisoformat(tarefa.parametros[c]).strftime('%d/%m/%Y')
+                                              for c in ('data_inicio', 'data_fim')]
+                            descricao += f" de {periodo_tarefa[0]} a {periodo_tarefa[1]}"
+                        texto = f"#{tarefa.id} {descricao} — {STATUS_TAREFA.get(tarefa.status, tarefa.status)}"
+                        if tarefa.mensagem:
+                            texto += f": {tarefa.mensagem}"
+                        
+                        col1, col2 = st.columns([4, 1])
+                        with col1:
+                            st.progress(min(max(float(tarefa.progresso), 0.0), 1.0), text=texto)
+                        with col2:
+                            if tarefa.status in ('pendente', 'executando'):
+                                if st.button("Cancelar", key=f"cancelar_tarefa_{tarefa.id}"):
+                                    cancelar_tarefa(st.session_state.username, tarefa.id)
+                                    st.rerun()
+                            elif tarefa.status == 'concluida' and tarefa.arquivo:
+                                if os.path.exists(tarefa.arquivo):
+                                    download_sob_demanda("Download CSV", tarefa.arquivo, "text/csv",
+                                                         f"baixar_tarefa_{tarefa.id}")
+                                else:
+                                    st.caption("Arquivo gerado em outro servidor.")
+                else:
+                    st.info("Nenhum relatório gerado ainda.")
+            
+            with tab4:
+                st.subheader("Buscar Movimentações")
+                
+                termo_busca = st.text_input("Descrição contém", key="busca_termo",
+                                            placeholder="Ex.: mercado, farmacia, uber")
+                
+                # Filtros combinados com a busca
+                indice_categorias = get_indice_categorias(st.session_state.username)
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    data_inicio = st.date_input("Data Inicial", 
+                                              value=datetime.date.today().replace(month=1, day=1),
+                                              format="DD/MM/YYYY",
+                                              key="busca_data_inicio")
+                with col2:
+                    data_fim = st.date_input("Data Final", 
+                                           value=datetime.date.today(),
+                                           format="DD/MM/YYYY",
+                                           key="busca_data_fim")
+                with col3:
+                    tipo_busca = st.selectbox("Tipo", ["Todos", "entrada", "saida"], key="busca_tipo")
+                with col4:
+                    ids_busca = (indice_categorias['por_tipo'].get(tipo_busca, []) if tipo_busca != "Todos"
+                                 else list(indice_categorias['nomes'].keys()))
+                    categoria_busca = st.selectbox("Categoria", [None] + ids_busca,
+                                                   format_func=lambda x: "Todas" if x is None else indice_categorias['nomes'][x],
+                                                   key="busca_categoria")
+                
+                if termo_busca:
+                    resultados_por_pagina = 50
+                    pagina_busca = st.session_state.get('busca_pagina', 1)
+                    try:
+                        resultados, total_resultados = buscar_movimentacoes(
+                            st.session_state.username, termo_busca,
+                            data_inicio.strftime("%Y-%m-%d"), data_fim.strftime("%Y-%m-%d"),
+                            categoria_id=categoria_busca,
+                            tipo=None if tipo_busca == "Todos" else tipo_busca,
+                            limite=resultados_por_pagina,
+                            offset=(pagina_busca - 1) * resultados_por_pagina
+                        )
+                    except Exception as e:
+                        st.error(f"Erro ao buscar movimentações: {e}")
+                        resultados, total_resultados = pd.DataFrame(), 0
+                    
+                    if resultados.empty and pagina_busca > 1:
+                        # Filtros mudaram e a página atual deixou de existir
+                        st.session_state.busca_pagina = 1
+                        st.rerun()
+                    
+                    if not resultados.empty:
+                        resultados['valor'] = resultados['valor'].apply(
+                            lambda x: f"R$ {x:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.'))
+                        resultados['data'] = pd.to_datetime(resultados['data']).dt.strftime('%d/%m/%Y')
+                        
+                        st.dataframe(resultados[['id', 'data', 'categoria', 'descricao', 'valor', 'tipo']].rename(
+                            columns={
+                                'data': 'Data',
+                                'categoria': 'Categoria',
+                                'descricao': 'Descrição',
+                                'valor': 'Valor',
+                                'tipo': 'Tipo'
+                            }
+                        ), hide_index=True, use_container_width=True)
+                        
+                        total_paginas_busca = max(1, -(-total_resultados // resultados_por_pagina))
+                        col1, col2 = st.columns([1, 3])
+                        with col1:
+                            st.number_input(f"Página (de {total_paginas_busca})", min_value=1,
+                                            max_value=total_paginas_busca, step=1, key="busca_pagina")
+                        with col2:
+                            st.caption(f"{total_resultados} movimentação(ões) encontrada(s).")
+                    else:
+                        st.info("Nenhuma movimentação encontrada para a busca.")
+            
+            with tab5:
+                st.subheader("Histórico de Alterações")
+                
+                tabela_alteracoes = st.selectbox("Tabela", [None] + list(TABELAS_ALTERACOES),
+                                                 format_func=lambda x: "Todas" if x is None else TABELAS_ALTERACOES[x],
+                                                 key="alteracoes_tabela")
+                
+                # Pilha com o início de cada página já aberta (None = mais recentes);
+                # volta ao começo quando o filtro muda
+                if ('alteracoes_paginas' not in st.session_state
+                        or st.session_state.alteracoes_filtro != tabela_alteracoes):
+                    st.session_state.alteracoes_filtro = tabela_alteracoes
+                    st.session_state.alteracoes_paginas = [None]
+                paginas_alteracoes = st.session_state.alteracoes_paginas
+                
+                alteracoes_por_pagina = 50
+                alteracoes = get_alteracoes(st.session_state.username, tabela_alteracoes,
+                                            antes_de=paginas_alteracoes[-1], limite=alteracoes_por_pagina + 1)
+                ha_mais_antigas = len(alteracoes) > alteracoes_por_pagina
+                alteracoes = alteracoes.head(alteracoes_por_pagina)
+                
+                if not alteracoes.empty:
+                    alteracoes['momento'] = pd.to_datetime(alteracoes['momento']).dt.strftime('%d/%m/%Y %H:%M:%S')
+                    alteracoes['tabela'] = alteracoes['tabela'].map(TABELAS_ALTERACOES)
+                    alteracoes['operacao'] = alteracoes['operacao'].map(OPERACOES_ALTERACOES)
+                    alteracoes['detalhes'] = [descrever_alteracao(antes, depois) for antes, depois
+                                              in zip(alteracoes['antes'], alteracoes['depois'])]
+                    
+                    st.dataframe(alteracoes[['momento', 'autor', 'tabela', 'operacao', 'detalhes']].rename(
+                        columns={
+                            'momento': 'Data/Hora',
+                            'autor': 'Autor',
+                            'tabela': 'Tabela',
+                            'operacao': 'Operação',
+                            'detalhes': 'Detalhes'
+                        }
+                    ), hide_index=True, use_container_width=True)
                     
-                    # Exibir visualização
-                    st.dataframe(movimentacoes, use_container_width=True)
+                    col1, col2, col3 = st.columns([1, 1, 2])
+                    with col1:
+                        if st.button("Mais recentes", disabled=len(paginas_alteracoes) == 1,
+                                     key="alteracoes_recentes"):
+                            paginas_alteracoes.pop()
+                            st.rerun()
+                    with col2:
+                        if st.button("Mais antigas", disabled=not ha_mais_antigas, key="alteracoes_antigas"):
+                            paginas_alteracoes.append(int(alteracoes['id'].iloc[-1]))
+                            st.rerun()
+                    with col3:
+                        st.caption(f"Página {len(paginas_alteracoes)}.")
                 else:
-                    st.info("Nenhuma movimentação encontrada no período selecionado.")
+                    st.info("Nenhuma alteração registrada.")
         
         elif choice == "Administração" and st.session_state.is_admin:
             st.markdown("<h1 class='main-header'>Administração do Sistema</h1>", unsafe_allow_html=True)
@@ -1286,7 +4135,8 @@ def main():
                     
                     if st.button("Criar Usuário"):
                         if novo_username and nova_senha:
-                            if register_user(novo_username, nova_senha, is_admin):
+                            if register_user(novo_username, nova_senha, is_admin,
+                                             autor=st.session_state.username):
                                 st.success(f"Usuário '{novo_username}' criado com sucesso!")
                                 st.rerun()
                             else:
@@ -1296,41 +4146,179 @@ def main():
                 
                 # Lista de usuários
                 st.subheader("Usuários do Sistema")
-                users = get_all_users()
+                
+                # Filtros e busca executados no servidor
+                col1, col2, col3 = st.columns([2, 1, 1])
+                with col1:
+                    busca_usuario = st.text_input("Buscar por nome de usuário", key="admin_busca")
+                with col2:
+                    filtro_status = st.selectbox("Status", ["Todos", "Ativos", "Inativos"], key="admin_status")
+                with col3:
+                    filtro_admin = st.selectbox("Perfil", ["Todos", "Administradores", "Usuários"], key="admin_perfil")
+                
+                usuarios_por_pagina = 20
+                pagina = st.session_state.get('admin_pagina', 1)
+                users, total_users = search_users(
+                    busca_usuario,
+                    is_active={"Todos": None, "Ativos": True, "Inativos": False}[filtro_status],
+                    is_admin={"Todos": None, "Administradores": True, "Usuários": False}[filtro_admin],
+                    limite=usuarios_por_pagina,
+                    offset=(pagina - 1) * usuarios_por_pagina
+                )
+                total_paginas = max(1, -(-total_users // usuarios_por_pagina))
+                
+                if users.empty and pagina > 1:
+                    # Filtro mudou e a página atual deixou de existir
+                    st.session_state.admin_pagina = 1
+                    st.rerun()
                 
                 if not users.empty:
-                    for idx, user in users.iterrows():
-                        with st.expander(f"{user['username']} {'(Admin)' if user['is_admin'] else ''}"):
-                            user_id = user['id']
-                            user_status = "Ativo" if user['is_active'] else "Inativo"
-                            st.write(f"**Status:** {user_status}")
-                            
-                            # Não permitir desativar o próprio usuário
-                            if user['username'] != st.session_state.username:
-                                if user['is_active']:
-                                    if st.button("Desativar Usuário", key=f"deactivate_{user_id}"):
-                                        toggle_user_status(user_id, 0)
-                                        st.success(f"Usuário '{user['username']}' desativado.")
-                                        st.rerun()
-                                else:
-                                    if st.button("Ativar Usuário", key=f"activate_{user_id}"):
-                                        toggle_user_status(user_id, 1)
-                                        st.success(f"Usuário '{user['username']}' ativado.")
-                                        st.rerun()
+                    st.dataframe(
+                        users.assign(
+                            is_admin=users['is_admin'].map({1: "Sim", 0: "Não"}),
+                            is_active=users['is_active'].map({1: "Ativo", 0: "Inativo"})
+                        ).rename(columns={
+                            'id': 'ID',
+                            'username': 'Usuário',
+                            'is_admin': 'Administrador',
+                            'is_active': 'Status'
+                        }),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                    
+                    col1, col2 = st.columns([1, 3])
+                    with col1:
+                        st.number_input(f"Página (de {total_paginas})", min_value=1, max_value=total_paginas,
+                                        step=1, key="admin_pagina")
+                    with col2:
+                        st.caption(f"{total_users} usuário(s) encontrado(s).")
+                    
+                    # Controles criados apenas para o usuário selecionado
+                    user_id = st.selectbox("Selecionar usuário",
+                                           options=users['id'].tolist(),
+                                           format_func=dict(zip(users['id'], users['username'])).get,
+                                           key="admin_user_sel")
+                    user = users[users['id'] == user_id].iloc[0]
+                    
+                    st.markdown(f"#### {user['username']} {'(Admin)' if user['is_admin'] else ''}")
+                    user_status = "Ativo" if user['is_active'] else "Inativo"
+                    st.write(f"**Status:** {user_status}")
+                    
+                    # Não permitir desativar o próprio usuário
+                    if user['username'] != st.session_state.username:
+                        if user['is_active']:
+                            if st.button("Desativar Usuário", key=f"deactivate_{user_id}"):
+                                toggle_user_status(user_id, 0, autor=st.session_state.username)
+                                st.success(f"Usuário '{user['username']}' desativado.")
+                                st.rerun()
+                        else:
+                            if st.button("Ativar Usuário", key=f"activate_{user_id}"):
+                                toggle_user_status(user_id, 1, autor=st.session_state.username)
+                                st.success(f"Usuário '{user['username']}' ativado.")
+                                st.rerun()
+                    else:
+                        st.info("Você não pode desativar seu próprio usuário.")
+                    
+                    # Opção para redefinir senha
+                    with st.expander("Redefinir Senha"):
+                        nova_senha = st.text_input("Nova Senha", type="password", key=f"new_pass_{user_id}")
+                        confirmar_senha = st.text_input("Confirmar Senha", type="password", key=f"confirm_pass_{user_id}")
+                        
+                        if st.button("Alterar Senha", key=f"change_pass_{user_id}"):
+                            if nova_senha and nova_senha == confirmar_senha:
+                                change_password(user['username'], nova_senha, autor=st.session_state.username)
+                                st.success("Senha alterada com sucesso!")
                             else:
-                                st.info("Você não pode desativar seu próprio usuário.")
+                                st.error("As senhas não coincidem ou estão em branco.")
+
+                    # Arquivamento dos anos encerrados do usuário selecionado
+                    if not user['is_admin']:
+                        with st.expander("Arquivar Anos Encerrados"):
+                            limite_arquivo = get_limite_arquivo(user['username'])
+                            if limite_arquivo:
+                                st.caption(f"Arquivado até {limite_arquivo.strftime('%d/%m/%Y')}.")
+                            st.info("Movimentações arquivadas continuam nos relatórios e consultas, "
+                                    "mas não podem mais ser editadas.")
+                            ano_atual = datetime.date.today().year
+                            ate_ano = st.selectbox("Arquivar até o ano",
+                                                   options=list(range(ano_atual - 1, ano_atual - 21, -1)),
+                                                   key=f"arquivar_ano_{user_id}")
+                            if st.button("Arquivar", key=f"arquivar_{user_id}"):
+                                arquivadas = arquivar_anos(user['username'], ate_ano,
+                                                           autor=st.session_state.username)
+                                st.success(f"{arquivadas} movimentação(ões) arquivada(s) até {ate_ano}.")
+                    
+                    # Perfil dos próximos reruns do usuário selecionado
+                    with st.expander("Perfil de Execução"):
+                        restantes = get_captura_perfil(user['username'])
+                        if restantes:
+                            st.info(f"Captura ativa: {restantes} rerun(s) restante(s).")
+                            if st.button("Encerrar Captura", key=f"encerrar_perfil_{user_id}"):
+                                solicitar_perfil(user['username'], 0, st.session_state.username)
+                                st.rerun()
+                        else:
+                            reruns_perfil = st.number_input("Reruns a capturar", min_value=1, max_value=50, value=5,
+                                                            key=f"reruns_perfil_{user_id}")
+                            if st.button("Capturar Próximos Reruns", key=f"capturar_perfil_{user_id}"):
+                                solicitar_perfil(user['username'], int(reruns_perfil), st.session_state.username)
+                                st.rerun()
+                        
+                        perfis = get_perfis(user['username'])
+                        if not perfis.empty:
+                            rotulos_perfis = {
+                                p.id: f"{pd.to_datetime(p.momento).strftime('%d/%m/%Y %H:%M:%S')} — "
+                                      f"{p.pagina or 'Login'} — {p.duracao * 1000:.0f} ms"
+                                for p in perfis.itertuples()
+                            }
+                            id_perfil = st.selectbox("Captura", options=list(rotulos_perfis),
+                                                     format_func=rotulos_perfis.get,
+                                                     key=f"perfil_sel_{user_id}")
+                            perfil = get_perfil(id_perfil)
                             
-                            # Opção para redefinir senha
-                            with st.expander("Redefinir Senha"):
-                                nova_senha = st.text_input("Nova Senha", type="password", key=f"new_pass_{user_id}")
-                                confirmar_senha = st.text_input("Confirmar Senha", type="password", key=f"confirm_pass_{user_id}")
+                            if perfil:
+                                st.markdown("**Funções com maior tempo acumulado**")
+                                st.dataframe(perfil['funcoes'].rename(columns={
+                                    'funcao': 'Função',
+                                    'chamadas': 'Chamadas',
+                                    'tempo_proprio': 'Tempo próprio (s)',
+                                    'tempo_acumulado': 'Tempo acumulado (s)'
+                                }), hide_index=True, use_container_width=True)
                                 
-                                if st.button("Alterar Senha", key=f"change_pass_{user_id}"):
-                                    if nova_senha and nova_senha == confirmar_senha:
-                                        change_password(user['username'], nova_senha)
-                                        st.success("Senha alterada com sucesso!")
-                                    else:
-                                        st.error("As senhas não coincidem ou estão em branco.")
+                                if not perfil['alocacoes'].empty:
+                                    st.markdown("**Linhas do app que mais alocaram memória**")
+                                    st.caption("Cada linha inclui o que as bibliotecas (pandas, psycopg2) alocaram "
+                                               "a partir dela. O tracemalloc vale para o processo inteiro: as "
+                                               "alocações incluem as de outras sessões atendidas pelo mesmo "
+                                               "processo durante o rerun.")
+                                    st.dataframe(perfil['alocacoes'].assign(
+                                        tamanho=perfil['alocacoes']['tamanho'] / 1024
+                                    ).rename(columns={
+                                        'linha': 'Linha',
+                                        'codigo': 'Código',
+                                        'tamanho': 'Tamanho (KB)',
+                                        'blocos': 'Blocos'
+                                    }), hide_index=True, use_container_width=True)
+                                
+                                arquivos = None
+                                if download_preparado("pstats e flame graph", ('perfil', id_perfil),
+                                                      f"perfil_{id_perfil}"):
+                                    arquivos = get_arquivos_perfil(id_perfil)
+                                if arquivos:
+                                    estatisticas, pilhas = arquivos
+                                    col1, col2 = st.columns(2)
+                                    with col1:
+                                        st.download_button("Download pstats", data=estatisticas,
+                                                           file_name=f"perfil_{user['username']}_{id_perfil}.pstats",
+                                                           mime="application/octet-stream",
+                                                           key=f"baixar_pstats_{id_perfil}", on_click=fim_download)
+                                    with col2:
+                                        st.download_button("Download flame graph (collapsed)", data=pilhas,
+                                                           file_name=f"perfil_{user['username']}_{id_perfil}.folded",
+                                                           mime="text/plain",
+                                                           key=f"baixar_pilhas_{id_perfil}", on_click=fim_download)
+                        else:
+                            st.caption("Nenhuma captura registrada para este usuário.")
                 else:
                     st.info("Nenhum usuário encontrado.")
             
@@ -1340,39 +4328,128 @@ def main():
                 st.info("Seu banco de dados PostgreSQL está configurado corretamente.")
                 
                 # Mostrar informações do banco de dados
-                conn = get_connection()
-                cur = conn.cursor()
-                
-                try:
-                    # Versão do PostgreSQL
-                    cur.execute("SELECT version();")
-                    version = cur.fetchone()[0]
-                    st.write(f"**Versão do PostgreSQL:** {version}")
-                    
-                    # Tamanho do banco de dados
-                    cur.execute("SELECT pg_size_pretty(pg_database_size(current_database()));")
-                    db_size = cur.fetchone()[0]
-                    st.write(f"**Tamanho do Banco de Dados:** {db_size}")
-                    
-                    # Estatísticas de usuários
-                    cur.execute("SELECT COUNT(*) FROM users;")
-                    total_users = cur.fetchone()[0]
-                    st.write(f"**Total de Usuários:** {total_users}")
+                with get_connection(somente_leitura=True) as conn:
+                    cur = conn.cursor()
                     
-                    # Estatísticas de tabelas
-                    cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'public';")
-                    total_tables = cur.fetchone()[0]
-                    st.write(f"**Total de Tabelas:** {total_tables}")
+                    try:
+                        # Versão do PostgreSQL
+                        cur.execute("SELECT version();")
+                        version = cur.fetchone()[0]
+                        st.write(f"**Versão do PostgreSQL:** {version}")
+                        
+                        # Tamanho do banco de dados
+                        cur.execute("SELECT pg_size_pretty(pg_database_size(current_database()));")
+                        db_size = cur.fetchone()[0]
+                        st.write(f"**Tamanho do Banco de Dados:** {db_size}")
+                        
+                        # Estatísticas de usuários
+                        cur.execute("SELECT COUNT(*) FROM users;")
+                        total_users = cur.fetchone()[0]
+                        st.write(f"**Total de Usuários:** {total_users}")
+                        
+                        # Estatísticas de tabelas
+                        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = 'public';")
+                        total_tables = cur.fetchone()[0]
+                        st.write(f"**Total de Tabelas:** {total_tables}")
+                        
+                    except Exception as e:
+                        st.error(f"Erro ao obter informações do banco de dados: {e}")
+                
+                # Armazenamento e atividade por usuário
+                st.subheader("Armazenamento por Usuário")
+                ordem_estatisticas = st.selectbox("Ordenar por", list(ORDENACAO_ESTATISTICAS.keys()),
+                                                  key="estatisticas_ordem")
+                estatisticas = get_estatisticas_usuarios(ordem_estatisticas)
+                
+                if not estatisticas.empty:
+                    for coluna in ['tamanho_tabelas', 'tamanho_indices', 'tamanho_total']:
+                        estatisticas[coluna] = (estatisticas[coluna] / (1024 * 1024)).round(2)
+                    estatisticas['proporcao_mortas'] = (estatisticas['proporcao_mortas'] * 100).round(1)
                     
-                except Exception as e:
-                    st.error(f"Erro ao obter informações do banco de dados: {e}")
+                    st.dataframe(estatisticas.rename(
+                        columns={
+                            'username': 'Usuário',
+                            'linhas': 'Linhas (estimativa)',
+                            'tamanho_tabelas': 'Tabelas (MB)',
+                            'tamanho_indices': 'Índices (MB)',
+                            'tamanho_total': 'Total (MB)',
+                            'escritas': 'Escritas',
+                            'ultima_atividade': 'Última Atividade',
+                            'proporcao_mortas': 'Linhas Mortas (%)'
+                        }
+                    ), hide_index=True, use_container_width=True)
+                else:
+                    st.info("Nenhum usuário encontrado.")
                 
-                conn.close()
+                # Reuso de instruções preparadas neste processo
+                st.subheader("Instruções Preparadas")
+                estatisticas_preparadas = get_estatisticas_preparadas()
+                total_execucoes = estatisticas_preparadas['preparos'] + estatisticas_preparadas['acertos']
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Preparadas", estatisticas_preparadas['preparos'])
+                with col2:
+                    st.metric("Reusos", estatisticas_preparadas['acertos'])
+                with col3:
+                    taxa_acerto = estatisticas_preparadas['acertos'] / total_execucoes * 100 if total_execucoes else 0
+                    st.metric("Taxa de Reuso", f"{taxa_acerto:.1f}%".replace('.', ','))
+                with col4:
+                    st.metric("Tempo Economizado (estimativa)", f"{estatisticas_preparadas['tempo_economizado'] * 1000:.0f} ms",
+                              help="Parse e análise evitados no servidor. Não inclui a ida ao servidor, "
+                                   "que o EXECUTE continua fazendo.")
+                
+                # Backup e restauração por usuário
+                st.subheader("Backup dos Usuários")
+                st.info("Os backups ficam no diretório do servidor definido em BACKUP_DIR. Para restaurar um "
+                        "backup de outro servidor, copie o arquivo para esse diretório. "
+                        "Para o banco inteiro (tabela users e configurações), continue usando pg_dump.")
+                os.makedirs(DIRETORIO_BACKUP, exist_ok=True)
+                
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    usuario_backup = st.text_input("Usuário (vazio para todos)", key="backup_usuario")
+                with col2:
+                    st.write("")
+                    st.write("")
+                    gerar = st.button("Gerar Backup")
+                if gerar:
+                    if usuario_backup:
+                        usernames = [usuario_backup]
+                    else:
+                        usernames = get_all_users()['username'].tolist()
+                    nome_backup = f"backup_{usuario_backup or 'todos'}_{datetime.datetime.now():%Y%m%d_%H%M%S}.gz"
+                    try:
+                        tamanho = gerar_backup(usernames, os.path.join(DIRETORIO_BACKUP, nome_backup))
+                        st.success(f"Backup {nome_backup} gerado ({tamanho / (1024 * 1024):,.1f} MB).")
+                    except Exception as e:
+                        st.error(f"Erro ao gerar backup: {e}")
                 
-                # Opção para backup
-                st.subheader("Backup do Banco de Dados")
-                st.warning("O backup deve ser realizado pelo administrador do banco de dados PostgreSQL.")
-                st.info("Recomendamos utilizar ferramentas como pg_dump para realizar backups regulares.")
+                backups = sorted((f for f in os.listdir(DIRETORIO_BACKUP) if f.endswith('.gz')), reverse=True)
+                if backups:
+                    backup_sel = st.selectbox("Backups disponíveis", backups, key="backup_sel")
+                    caminho_backup = os.path.join(DIRETORIO_BACKUP, backup_sel)
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        download_sob_demanda("Download", caminho_backup, "application/gzip", "baixar_backup")
+                    with col2:
+                        confirmar_restauracao = st.checkbox("Substituir os dados atuais dos usuários do backup",
+                                                            key="backup_confirmar")
+                        if st.button("Restaurar", disabled=not confirmar_restauracao):
+                            try:
+                                restaurados = restaurar_backup(caminho_backup, autor=st.session_state.username)
+                                st.success(f"{len(restaurados)} usuário(s) restaurado(s).")
+                            except Exception as e:
+                                st.error(f"Erro ao restaurar backup: {e}")
+                else:
+                    st.info("Nenhum backup encontrado.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ['migrar']:
+        # Executar na implantação, antes de iniciar o Streamlit
+        migrados, falhas = executar_migracoes()
+        print(f"{migrados} usuário(s) migrado(s).")
+        if falhas:
+            print(f"Falha ao migrar: {', '.join(falhas)}")
+            sys.exit(1)
+    else:
+        executar_rerun()
\ No newline at end of file
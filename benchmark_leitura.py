@@ -0,0 +1,120 @@
+# Benchmark da leitura em massa: ler_copy (COPY ... TO STDOUT + read_csv)
+# contra pd.read_sql_query e ler_preparado, com linhas no formato das
+# movimentações (ver get_movimentacoes).
+#
+# Uso (DATABASE_URL apontando para um PostgreSQL local, só de testes):
+#     python benchmark_leitura.py --linhas 10000 100000 1000000 --repeticoes 3
+#
+# Os dados ficam numa tabela temporária da própria conexão, gerada no
+# servidor com generate_series; nada é gravado nas tabelas do app. Para cada
+# tamanho mostra a mediana do tempo de leitura e o pico de memória Python
+# (tracemalloc) numa leitura extra.
+#
+# Resultado de referência (PostgreSQL 16 local, 1 CPU, 3 repetições):
+#
+#     tamanho  método          tempo (ms)  pico (MB)
+#       10000  read_sql_query         172        6.1
+#       10000  ler_preparado          164        6.1
+#       10000  ler_copy               173        2.3
+#      100000  read_sql_query         678       63.4
+#      100000  ler_preparado          681       63.4
+#      100000  ler_copy               516       20.6
+#     1000000  read_sql_query        6913      636.4
+#     1000000  ler_preparado         6210      636.4
+#     1000000  ler_copy              4402      202.6
+#
+# ler_preparado só economiza o parse e o planejamento da consulta, que pesam
+# em resultados pequenos: num agregado de 71 linhas (get_categorias_por_mes)
+# ele leva ~3 ms contra ~12 ms do ler_copy, cujo custo fixo (thread, pipe e
+# read_csv) domina. Por isso o COPY fica para as leituras grandes
+# (get_movimentacoes com via_copy, exportações); com uma CPU a thread do COPY
+# disputa o processador com o parser, então em máquinas com mais núcleos a
+# diferença tende a ser maior.
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+import app_sql
+
+CONSULTA = """
+    SELECT id, categoria, valor, data, tipo, descricao, parcela, total_parcelas, id_grupo_parcela
+    FROM benchmark_movimentacoes
+    WHERE id <= %s
+    ORDER BY data DESC, id DESC
+"""
+TIPOS_COPY = {'categoria': 'category', 'tipo': 'category', 'descricao': object}
+
+def criar_dados(conn, linhas):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TEMPORARY TABLE benchmark_movimentacoes AS
+        SELECT g AS id,
+               'Categoria ' || mod(g, 25) AS categoria,
+               round((random() * 2000)::numeric, 2)::real AS valor,
+               DATE '2015-01-01' + (random() * 3650)::int AS data,
+               CASE WHEN mod(g, 3) = 0 THEN 'entrada' ELSE 'saida' END AS tipo,
+               CASE WHEN mod(g, 10) = 0 THEN '' ELSE 'Compra ' || (random() * 50000)::int END AS descricao,
+               CASE WHEN mod(g, 5) = 0 THEN 1 + mod(g, 12) ELSE 0 END AS parcela,
+               CASE WHEN mod(g, 5) = 0 THEN 12 ELSE 0 END AS total_parcelas,
+               CASE WHEN mod(g, 5) = 0 THEN g / 12 END AS id_grupo_parcela
+        FROM generate_series(1, %s) AS g
+    """, (linhas,))
+    cur.execute("ANALYZE benchmark_movimentacoes")
+    conn.commit()
+
+def medir(ler, repeticoes):
+    # Mediana do tempo das repetições; o pico de memória vem de uma leitura
+    # à parte, pois o tracemalloc deixa a leitura bem mais lenta
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        linhas = len(ler())
+        tempos.append(time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    ler()
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return linhas, statistics.median(tempos), pico
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ler_copy e ler_preparado contra read_sql_query")
+    parser.add_argument("--linhas", type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="tamanhos do resultado")
+    parser.add_argument("--repeticoes", type=int, default=3, help="leituras por tamanho e método")
+    args = parser.parse_args()
+
+    # pd.read_sql_query avisa que só testa conexões SQLAlchemy; o app usa psycopg2
+    warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy')
+    conn = app_sql.conectar(os.environ['DATABASE_URL'])
+    print(f"Gerando {max(args.linhas)} linha(s)...")
+    criar_dados(conn, max(args.linhas))
+
+    metodos = {
+        'read_sql_query': lambda n: pd.read_sql_query(CONSULTA, conn, params=(n,)),
+        'ler_preparado': lambda n: app_sql.ler_preparado(conn, CONSULTA, (n,)),
+        'ler_copy': lambda n: app_sql.ler_copy(conn, CONSULTA, (n,), tipos=TIPOS_COPY, datas=['data']),
+    }
+    resultados = []
+    for n in args.linhas:
+        for metodo, ler in metodos.items():
+            linhas, segundos, pico = medir(lambda: ler(n), args.repeticoes)
+            conn.rollback()
+            resultados.append((n, metodo, linhas, segundos * 1000, pico / 2**20))
+            print(f"  {n:>9} linhas  {metodo:<15} {segundos * 1000:>9.0f} ms")
+
+    relatorio = pd.DataFrame(resultados, columns=['tamanho', 'método', 'linhas', 'tempo (ms)', 'pico (MB)'])
+    base = relatorio[relatorio['método'] == 'read_sql_query'].set_index('tamanho')['tempo (ms)']
+    relatorio['vs read_sql_query'] = base.loc[relatorio['tamanho']].values / relatorio['tempo (ms)']
+
+    print()
+    print(relatorio.drop(columns='linhas').round(1).to_string(index=False))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Teste de carga do app com sessões simuladas pelo AppTest do Streamlit.
+#
+# Uso (DATABASE_URL apontando para um PostgreSQL local, só de testes):
+#     python teste_carga.py --sessoes 50 --reruns 30 --movimentacoes 2000
+#
+# Cria usuários sintéticos (carga_001, carga_002...) com movimentações
+# aleatórias e abre as sessões em paralelo. Cada sessão faz login e alterna
+# entre Visão Geral, Lançar Movimentação e Auditoria. No fim mostra a latência
+# dos reruns por página, a vazão e as conexões abertas no banco durante o teste.
+#
+# Cada sessão roda em um processo próprio: o AppTest troca o Runtime global a
+# cada run e não pode executar sessões em paralelo em threads. Por isso as
+# sessões não compartilham caches nem o pool de conexões como num servidor
+# único; o número de conexões medido é um limite superior.
+import argparse
+import datetime
+import io
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+import psycopg2
+from streamlit.testing.v1 import AppTest
+
+import app_sql
+
+ARQUIVO_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_sql.py')
+PAGINAS = ["Visão Geral", "Lançar Movimentação", "Auditoria"]
+SENHA_CARGA = 'carga123'
+
+def criar_usuarios(quantidade, movimentacoes):
+    # Usuários já existentes de execuções anteriores são reaproveitados
+    app_sql.executar_migracoes()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    hoje = datetime.date.today()
+    usernames = []
+
+    for i in range(1, quantidade + 1):
+        username = f"carga_{i:03d}"
+        usernames.append(username)
+        if not app_sql.register_user(username, SENHA_CARGA, 0):
+            continue
+
+        cur.execute(f"SELECT id, tipo FROM categorias_{username}")
+        categorias = cur.fetchall()
+        linhas = io.StringIO()
+        for _ in range(movimentacoes):
+            categoria_id, tipo = random.choice(categorias)
+            data = hoje - datetime.timedelta(days=random.randint(0, 730))
+            linhas.write(f"{categoria_id}\t{random.uniform(5, 2000):.2f}\t{data}\t{tipo}\t"
+                         f"Carga {random.randint(1, 5000)}\n")
+        linhas.seek(0)
+        cur.copy_from(linhas, f"movimentacoes_{username}",
+                      columns=('categoria_id', 'valor', 'data', 'tipo', 'descricao'))
+        conn.commit()
+
+    conn.close()
+    return usernames
+
+def monitorar_conexoes(parar, amostras):
+    # Amostra as conexões abertas no banco enquanto o teste roda
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    while not parar.is_set():
+        cur.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database()")
+        amostras.append(cur.fetchone()[0] - 1)
+        time.sleep(0.2)
+    conn.close()
+
+def sessoes_abertas_no_banco():
+    # Total de sessões abertas desde o início das estatísticas (PostgreSQL 14+)
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT sessions FROM pg_stat_database WHERE datname = current_database()")
+        total = cur.fetchone()[0]
+    except psycopg2.Error:
+        total = None
+    conn.close()
+    return total
+
+def botao(at, rotulo):
+    return next(b for b in at.button if b.label == rotulo)
+
+def ajustar_selectboxes(at):
+    # Limitação do AppTest: selectboxes com format_func não conseguem reenviar
+    # o próprio valor no rerun; nelas a sessão fica na opção padrão
+    for caixa in at.selectbox:
+        if caixa.value is not None and str(caixa.value) not in caixa.options:
+            caixa.select_index(caixa.proto.default)
+
+def executar_sessao(username, reruns, tempo_limite):
+    # Retorna [(página, segundos, erro)] de cada rerun da sessão
+    medicoes = []
+    at = AppTest.from_file(ARQUIVO_APP, default_timeout=tempo_limite)
+
+    inicio = time.perf_counter()
+    at.run()
+    medicoes.append(("Login", time.perf_counter() - inicio, bool(at.exception)))
+
+    at.text_input(key="login_username").input(username)
+    at.text_input(key="login_password").input(SENHA_CARGA)
+    inicio = time.perf_counter()
+    botao(at, "Entrar").click().run()
+    medicoes.append(("Entrar", time.perf_counter() - inicio, bool(at.exception)))
+
+    for i in range(reruns):
+        pagina = PAGINAS[i % len(PAGINAS)]
+        menu = next(s for s in at.selectbox if s.label == "Menu")
+        menu.select(pagina)
+        ajustar_selectboxes(at)
+        inicio = time.perf_counter()
+        at.run()
+        medicoes.append((pagina, time.perf_counter() - inicio, bool(at.exception)))
+
+    return medicoes
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do app de finanças")
+    parser.add_argument("--sessoes", type=int, default=50, help="sessões simultâneas (uma por usuário)")
+    parser.add_argument("--reruns", type=int, default=30, help="trocas de página por sessão")
+    parser.add_argument("--movimentacoes", type=int, default=2000, help="movimentações por usuário sintético")
+    parser.add_argument("--tempo-limite", type=float, default=120, help="tempo máximo de um rerun (s)")
+    args = parser.parse_args()
+
+    print(f"Preparando {args.sessoes} usuário(s)...")
+    usernames = criar_usuarios(args.sessoes, args.movimentacoes)
+
+    parar = threading.Event()
+    amostras = []
+    monitor = threading.Thread(target=monitorar_conexoes, args=(parar, amostras), daemon=True)
+    monitor.start()
+    sessoes_antes = sessoes_abertas_no_banco()
+
+    print(f"Executando {args.sessoes} sessão(ões) com {args.reruns} rerun(s) cada...")
+    inicio = time.perf_counter()
+    # spawn: os processos não herdam as conexões abertas ao criar os usuários
+    with ProcessPoolExecutor(max_workers=args.sessoes,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        resultados = list(executor.map(executar_sessao, usernames,
+                                       repeat(args.reruns), repeat(args.tempo_limite)))
+    duracao = time.perf_counter() - inicio
+
+    parar.set()
+    monitor.join()
+    sessoes_depois = sessoes_abertas_no_banco()
+
+    medicoes = pd.DataFrame([m for sessao in resultados for m in sessao],
+                            columns=['pagina', 'segundos', 'erro'])
+    relatorio = medicoes.groupby('pagina')['segundos'].describe(percentiles=[0.5, 0.95, 0.99])
+    relatorio['erros'] = medicoes.groupby('pagina')['erro'].sum()
+    relatorio = relatorio[['count', '50%', '95%', '99%', 'max', 'erros']] * [1, 1000, 1000, 1000, 1000, 1]
+    relatorio.columns = ['reruns', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'máx (ms)', 'erros']
+
+    print()
+    print(relatorio.round(0).astype(int).to_string())
+    print()
+    print(f"Duração: {duracao:.1f} s")
+    print(f"Vazão: {len(medicoes) / duracao:.1f} reruns/s")
+    if amostras:
+        print(f"Conexões no banco: pico {max(amostras)}, média {sum(amostras) / len(amostras):.1f}")
+    if sessoes_antes is not None and sessoes_depois is not None:
+        print(f"Conexões abertas durante o teste: {sessoes_depois - sessoes_antes}")
+
+if __name__ == "__main__":
+    main()